@@ -0,0 +1,88 @@
+import json
+import sys
+import time
+
+import pyhelix.statemodel as statemodel
+
+# Compares the memory per partition of StateModelFactory and
+# CompactStateModelFactory after every partition has gone OFFLINE -> ONLINE,
+# with partition names and states decoded from JSON as they are from
+# messages, and the time it takes to reset all partitions.
+#
+# Run from the repository root:
+#   PYTHONPATH=. python benchmarks/statemodel_benchmark.py
+
+NUM_PARTITIONS = 100000
+
+
+class PlainModel(statemodel.StateModel):
+    def on_become_online_from_offline(self, message):
+        pass
+
+
+class CompactModel(statemodel.CompactStateModel):
+    __slots__ = ()
+
+    def on_become_online_from_offline(self, message):
+        pass
+
+
+class PlainFactory(statemodel.StateModelFactory):
+    def create_state_model(self, partition_name):
+        return PlainModel()
+
+    def reset(self):
+        # the default reset of StateModel logs a warning per partition
+        for sm in self._state_models.itervalues():
+            sm._current_state = sm.DEFAULT_INIT_STATE
+
+
+class CompactFactory(statemodel.CompactStateModelFactory):
+    def create_state_model(self, partition_name):
+        return CompactModel()
+
+
+def populate(factory):
+    for i in xrange(NUM_PARTITIONS):
+        partition_name = json.loads('"myResource_{0}"'.format(i))
+        state_model = factory.create_state_model(partition_name)
+        state_model._current_state = json.loads('"ONLINE"')
+        factory.put_state_model(partition_name, state_model)
+
+
+def get_size(factory):
+    """
+    Bytes held by the factory's map, names, state models and states
+    """
+    seen = set()
+    total = sys.getsizeof(factory._state_models)
+    for partition_name, sm in factory._state_models.iteritems():
+        for obj in (partition_name, sm, getattr(sm, '__dict__', None),
+                    sm.get_current_state()):
+            if obj is not None and id(obj) not in seen:
+                seen.add(id(obj))
+                total += sys.getsizeof(obj)
+    return total
+
+
+def main():
+    for label, factory_class in (('StateModelFactory', PlainFactory),
+                                 ('CompactStateModelFactory',
+                                  CompactFactory)):
+        factory = factory_class()
+        populate(factory)
+        size = get_size(factory)
+        print('{0}: {1:.0f} bytes per partition'.format(
+            label, size / float(NUM_PARTITIONS)))
+        timings = []
+        for _ in xrange(3):
+            populate(factory)
+            start = time.time()
+            factory.reset()
+            timings.append(time.time() - start)
+        print('{0}: reset of {1} partitions in {2:.0f} ms'.format(
+            label, NUM_PARTITIONS, min(timings) * 1000))
+
+
+if __name__ == '__main__':
+    main()
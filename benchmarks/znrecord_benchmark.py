@@ -0,0 +1,49 @@
+import sys
+import timeit
+
+import pyhelix.znode as znode
+
+# Compares dictionary records with ZNRecord: the memory of the record
+# container itself (the field dictionaries are the same for both) and the
+# cost of reading a message field.
+#
+# Run from the repository root:
+#   PYTHONPATH=. python benchmarks/znrecord_benchmark.py
+
+NUM_RECORDS = 100000
+
+
+def make_dict(i):
+    return {'id': 'msg_{0}'.format(i),
+            'simpleFields': {'MSG_TYPE': 'STATE_TRANSITION'},
+            'listFields': {}, 'mapFields': {}}
+
+
+def main():
+    dicts = [make_dict(i) for i in xrange(NUM_RECORDS)]
+    records = [znode.ZNRecord.from_dict(d) for d in dicts]
+    dict_size = sum(sys.getsizeof(d) for d in dicts) / float(NUM_RECORDS)
+    record_size = sum(sys.getsizeof(r) for r in records) / float(NUM_RECORDS)
+    print('container bytes per record: dict {0:.0f}, ZNRecord {1:.0f}'.format(
+        dict_size, record_size))
+
+    setup = ('import pyhelix.znode as znode; '
+             'd = {"id": "m", "simpleFields": {"MSG_TYPE": "X"}, '
+             '"listFields": {}, "mapFields": {}}; '
+             'r = znode.ZNRecord.from_dict(d)')
+    for label, stmt in (
+            ('dict d["simpleFields"]["MSG_TYPE"]',
+             'd["simpleFields"]["MSG_TYPE"]'),
+            ('ZNRecord r.simple_fields["MSG_TYPE"]',
+             'r.simple_fields["MSG_TYPE"]'),
+            ('ZNRecord r.simple_fields.get("MSG_TYPE")',
+             'r.simple_fields.get("MSG_TYPE")'),
+            ('ZNRecord r.msg_type', 'r.msg_type'),
+            ('ZNRecord r["simpleFields"]["MSG_TYPE"]',
+             'r["simpleFields"]["MSG_TYPE"]')):
+        best = min(timeit.repeat(stmt, setup, number=1000000, repeat=3))
+        print('{0}: {1:.0f} ns'.format(label, best * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,207 @@
-import json
+import collections
+import concurrent.futures as futures
+import copy
+import functools
+import kazoo.client
 import kazoo.exceptions
 import kazoo.recipe.watchers
 import logging
 import os
+import random
+import threading
+import time
 import traceback
 
+import bucketizer
+import codec as codec_module
 import keybuilder
+import propertycache
+import znode
+
+
+def _merge(key, value, updated_value, sub):
+    """
+    Combine a stored property with an update (private)
+
+    Args:
+        key: KeyBuilder property
+        value: The stored data (python object), modified in place if merged
+        updated_value: The update (python object)
+        sub: True to subtract the updated value, False to add it
+
+    Returns:
+        (new value, True if it differs from the stored value) tuple, or
+        (None, False) if the update is not allowed
+    """
+    if key.merge_on_update:
+        # merge in if allowed
+        changed = False
+        for fields in ('simpleFields', 'listFields', 'mapFields'):
+            stored = value[fields]
+            for k, v in updated_value[fields].iteritems():
+                if not sub:
+                    if k not in stored or stored[k] != v:
+                        stored[k] = v
+                        changed = True
+                elif k in stored:
+                    stored.pop(k)
+                    changed = True
+        return value, changed
+    elif not sub:
+        # otherwise, replace entirely if not a subtraction
+        return updated_value, updated_value != value
+    # merge must be allowed to subtract
+    logging.warn(
+        'Tried to do a subtract on a property that doesn\'t allow merge')
+    return None, False
+
+
+def _backoff_delay(retries):
+    """
+    Get a randomized delay before retrying a conflicting write (private)
+
+    Args:
+        retries: Number of retries so far, including this one
+
+    Returns:
+        Delay in seconds
+    """
+    ceiling = min(
+        DataAccessor.MAX_UPDATE_BACKOFF,
+        DataAccessor.UPDATE_BACKOFF * (2 ** (retries - 1)))
+    return random.uniform(0, ceiling)
+
+
+def _serialize(codec, metrics, key, data):
+    """
+    Serialize data for a property, counting bytes if enabled (private)
+
+    Args:
+        codec: ZNRecord codec
+        metrics: MetricsRegistry, or None
+        key: KeyBuilder property
+        data: The data to write (python object)
+
+    Returns:
+        The serialized data
+    """
+    value = codec.serialize(data)
+    if metrics and value:
+        metrics.record_bytes(key.type, 'serialized', len(value))
+    return value
+
+
+def _deserialize(codec, metrics, key, value, lazy=False):
+    """
+    Deserialize the data of a property, counting bytes if enabled (private)
+
+    Args:
+        codec: ZNRecord codec
+        metrics: MetricsRegistry, or None
+        key: KeyBuilder property
+        value: The raw ZNode data
+        lazy: True to decode map and list fields of a record on demand
+
+    Returns:
+        The python object
+    """
+    if metrics and value:
+        metrics.record_bytes(key.type, 'deserialized', len(value))
+    return codec.deserialize(value, lazy=lazy)
+
+
+def _instrumented(operation):
+    """
+    Record the latency of an accessor operation if enabled (private)
+
+    Operations that return futures are timed until the future completes.
+
+    Args:
+        operation: Name of the operation
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def hidden_func(self, key, *args, **kwargs):
+            metrics = self._metrics
+            if not metrics:
+                return func(self, key, *args, **kwargs)
+            start = time.time()
+            result = func(self, key, *args, **kwargs)
+            if isinstance(result, futures.Future):
+                result.add_done_callback(
+                    lambda f: metrics.record_latency(
+                        key.type, operation, time.time() - start))
+            else:
+                metrics.record_latency(
+                    key.type, operation, time.time() - start)
+            return result
+        return hidden_func
+    return decorator
+
+
+def _merge_bucket(record, bucket):
+    """
+    Add the partitions of a bucket to a bucketized record (private)
+
+    Args:
+        record: The ZNRecord (python object), modified in place
+        bucket: The bucket ZNRecord (python object)
+    """
+    if not bucket:
+        return
+    record['listFields'].update(bucket['listFields'])
+    record['mapFields'].update(bucket['mapFields'])
 
 
 class DataAccessor(object):
     """
     Helix property accessor
     """
-    def __init__(self, cluster_id, zk_client):
+
+    DEFAULT_MAX_UPDATE_RETRIES = 50
+
+    # Backoff before the first retry of a conflicting update, in seconds
+    UPDATE_BACKOFF = 0.005
+
+    # Upper bound on the backoff between retries, in seconds
+    MAX_UPDATE_BACKOFF = 1.0
+
+    # Paths whose update counters are kept, least recently updated dropped
+    MAX_UPDATE_STATS = 1000
+
+    def __init__(self, cluster_id, zk_client, cache_size=0, codec=None,
+                 max_update_retries=None, metrics=None):
         """
         Initialze for a cluster and ZooKeeper connection
 
         Args:
             cluster_id: Unique clsuter identifier
             zk_client: A live connection to ZooKeeper
+            cache_size: (Optional) Number of cacheable properties to keep in
+                memory between reads, 0 (default) to disable caching
+            codec: (Optional) ZNRecord codec, compact JSON by default
+            max_update_retries: (Optional) Number of times a conflicting
+                update is retried before giving up
+            metrics: (Optional) MetricsRegistry to record latencies and sizes
+                in, None (default) to disable instrumentation
         """
+        if max_update_retries is None:
+            max_update_retries = self.DEFAULT_MAX_UPDATE_RETRIES
         self._cluster_id = cluster_id
         self._client = zk_client
+        self._codec = codec or codec_module.COMPACT_CODEC
+        self._max_update_retries = max_update_retries
+        self._metrics = metrics
+        self._update_stats = collections.OrderedDict()
+        self._update_stats_lock = threading.Lock()
+        self._builder = keybuilder.KeyBuilder(cluster_id)
+        self._async_accessor = None
+        self._cache = None
+        if cache_size:
+            self._cache = propertycache.PropertyCache(cache_size)
+            self._client.add_listener(self._cache_connection_listener)
 
+    @_instrumented('create')
     def create(self, key, data):
         """
         Create a property, creating parent nodes as necessary
@@ -34,15 +213,16 @@ class DataAccessor(object):
         Returns:
             True if successful, False otherwise
         """
-        path = key['path']
+        if self._get_bucket_size(key, data):
+            return self.set(key, data)
+        path = key.path
         try:
-            node = data
-            if data:
-                node = json.dumps(data, indent=2, sort_keys=True)
+            node = _serialize(self._codec, self._metrics, key, data)
             logging.info('creating {0} with {1}'.format(path, data))
             self._client.create(
-                path, node, ephemeral=key['ephemeral'],
-                sequence=key['sequential'], makepath=True)
+                path, node, ephemeral=key.ephemeral,
+                sequence=key.sequential, makepath=True)
+            self._invalidate(key)
             return True
         except kazoo.exceptions.NodeExistsError:
             logging.warn('{0} exists already'.format(path))
@@ -52,47 +232,119 @@ class DataAccessor(object):
             logging.error(traceback.format_exc())
         return False
 
-    def set(self, key, data):
+    @_instrumented('set')
+    def set(self, key, data, version=None):
         """
         Set a property, creating parent nodes as necessary
 
+        Records with a BUCKET_SIZE simple field are split into buckets when
+        the property allows it.
+
+        Args:
+            key: KeyBuilder property
+            data: The data to write (python object)
+            version: (Optional) Only write if the ZNode is at this version;
+                the ZNode must exist, and records are not split into buckets
+
+        Returns:
+            True if successful, False otherwise
+        """
+        if version is None:
+            bucket_size = self._get_bucket_size(key, data)
+            if bucket_size:
+                return self._set_buckets(key, data, bucket_size)
+        return self._set_record(key, data, version)
+
+    def _set_record(self, key, data, version=None):
+        """
+        Set a single ZNode, creating parent nodes as necessary (private)
+
         Args:
             key: KeyBuilder property
             data: The data to write (python object)
+            version: (Optional) Only write if the ZNode is at this version
 
         Returns:
             True if successful, False otherwise
         """
-        if data:
-            data = json.dumps(data, indent=2, sort_keys=True)
-        path = key['path']
+        data = _serialize(self._codec, self._metrics, key, data)
+        path = key.path
         try:
-            if not key['update_only_on_exists']:
+            if version is not None:
+                logging.info('setting {0} at version {1} with {2}'.format(
+                    path, version, data))
+                self._client.set(path, data, version=version)
+                self._invalidate(key)
+                return True
+            if not key.update_only_on_exists:
                 self._client.ensure_path(path)
             logging.info('setting {0} with {1}'.format(path, data))
             self._client.set(path, data)
+            self._invalidate(key)
             return True
         except kazoo.exceptions.NoNodeError:
             logging.info('{0} does not exist'.format(path))
+        except kazoo.exceptions.BadVersionError:
+            logging.info('{0} is no longer at version {1}'.format(
+                path, version))
         except kazoo.exceptions.KazooException:
             logging.error(path)
             logging.error(traceback.format_exc())
         return False
 
-    def get(self, key):
+    @_instrumented('get')
+    def get(self, key, lazy=False):
         """
         Get a property
 
+        The buckets of a bucketized record are read and reassembled.
+        Records carry the version of the ZNode they were read from.
+
         Args:
             key: KeyBuilder property
+            lazy: True to decode map and list fields of a record on demand
 
         Returns:
             The data that is persisted, or None
         """
-        path = key['path']
+        path = key.path
+        try:
+            value, version = self._get_data(key)
+            value = _deserialize(
+                self._codec, self._metrics, key, value, lazy=lazy)
+            if isinstance(value, znode.ZNRecord):
+                value.version = version
+            if key.bucketized and bucketizer.get_bucket_size(value):
+                bucket_keys = [
+                    self._builder.bucket(key, bucket_name)
+                    for bucket_name in self.get_children(key)]
+                async_accessor = self.get_async_accessor()
+                for bucket in async_accessor.get_many(bucket_keys):
+                    _merge_bucket(value, bucket)
+            return value
+        except kazoo.exceptions.NoNodeError:
+            logging.info('{0} does not exist'.format(path))
+        except kazoo.exceptions.KazooException:
+            logging.error(path)
+            logging.error(traceback.format_exc())
+        return None
+
+    @_instrumented('get')
+    def get_raw(self, key):
+        """
+        Get the data of a property without decoding it
+
+        Buckets of a bucketized record are not read.
+
+        Args:
+            key: KeyBuilder property
+
+        Returns:
+            The raw ZNode data, or None
+        """
+        path = key.path
         try:
-            value, stat = self._client.get(path)
-            return json.loads(value)
+            return self._get_data(key)[0]
         except kazoo.exceptions.NoNodeError:
             logging.info('{0} does not exist'.format(path))
         except kazoo.exceptions.KazooException:
@@ -100,6 +352,7 @@ class DataAccessor(object):
             logging.error(traceback.format_exc())
         return None
 
+    @_instrumented('children')
     def get_children(self, key):
         """
         Get the children of a property
@@ -110,7 +363,7 @@ class DataAccessor(object):
         Returns:
             List of child names
         """
-        path = key['path']
+        path = key.path
         try:
             return self._client.get_children(path)
         except kazoo.exceptions.NoNodeError:
@@ -120,10 +373,14 @@ class DataAccessor(object):
             logging.error(traceback.format_exc())
         return []
 
+    @_instrumented('update')
     def update(self, key, updated_value, sub=False):
         """
         Update a property
 
+        For bucketized records, only the buckets holding the updated
+        partitions are rewritten.
+
         Args:
             key: KeyBuilder property
             updated_value: The data to write (python object)
@@ -132,71 +389,105 @@ class DataAccessor(object):
         Returns:
             True if successful, False otherwise
         """
-        path = key['path']
-        done = False
-        while not done:
+        bucket_size = self._get_bucket_size(key, updated_value, sub=sub)
+        if bucket_size:
+            return self._update_buckets(key, updated_value, sub, bucket_size)
+        return self._update_record(key, updated_value, sub)
+
+    def _update_record(self, key, updated_value, sub=False, force=False):
+        """
+        Update a single ZNode (private)
+
+        Conflicting writes are retried with jittered exponential backoff, up
+        to the retry limit. Nothing is written if the update would not change
+        the stored value, unless forced.
+
+        Args:
+            key: KeyBuilder property
+            updated_value: The data to write (python object)
+            sub: True to subtract the updated value, False (default) to add it
+            force: True to write even if the value is unchanged
+
+        Returns:
+            True if successful, False otherwise
+        """
+        path = key.path
+        self._record_update(path, 'updates')
+        cached = None
+        if self._cache and key.cacheable:
+            cached = self._cache.get(path)
+        retries = 0
+        while True:
+            optimistic = cached is not None
             try:
-                exists_stat = self._client.exists(path)
-                if not exists_stat:
-                    if key['update_only_on_exists'] or sub:
-                        logging.info(
-                            '{0} does not exist, cannot update'.format(path))
-                        return False
-                    try:
-                        node = updated_value
-                        if updated_value:
-                            node = json.dumps(
-                                updated_value, indent=2, sort_keys=True)
-                        self._client.create(
-                            path, node, ephemeral=key['ephemeral'],
-                            sequence=key['sequential'], makepath=True)
-                        return True
-                    except kazoo.exceptions.NodeExistsError:
-                        pass  # ignore failure here
-                value, get_stat = self._client.get(path)
-                value = json.loads(value)
-                if key['merge_on_update']:
-                    # merge in if allowed
-                    if not sub:
-                        for k, v in updated_value['simpleFields'].iteritems():
-                            value['simpleFields'][k] = v
-                        for k, v in updated_value['listFields'].iteritems():
-                            value['listFields'][k] = v
-                        for k, v in updated_value['mapFields'].iteritems():
-                            value['mapFields'][k] = v
-                    else:
-                        for k, v in updated_value['simpleFields'].iteritems():
-                            if k in value['simpleFields']:
-                                value['simpleFields'].pop(k)
-                        for k, v in updated_value['listFields'].iteritems():
-                            if k in value['listFields']:
-                                value['listFields'].pop(k)
-                        for k, v in updated_value['mapFields'].iteritems():
-                            if k in value['mapFields']:
-                                value['mapFields'].pop(k)
-                elif not sub:
-                    # otherwise, replace entirely if not a subtraction
-                    value = updated_value
+                if optimistic:
+                    # write against the cached version, re-read on conflict
+                    value, version = cached
+                    cached = None
                 else:
-                    # merge must be allowed to subtract
-                    logging.warn(
-                        'Tried to do a subtract on a property that'
-                        ' doesn\'t allow merge')
+                    exists_stat = self._client.exists(path)
+                    if not exists_stat:
+                        if key.update_only_on_exists or sub:
+                            logging.info(
+                                '{0} does not exist, cannot update'.format(
+                                    path))
+                            return False
+                        try:
+                            node = _serialize(
+                                self._codec, self._metrics, key,
+                                updated_value)
+                            self._client.create(
+                                path, node, ephemeral=key.ephemeral,
+                                sequence=key.sequential, makepath=True)
+                            self._record_update(path, 'writes')
+                            self._invalidate(key)
+                            return True
+                        except kazoo.exceptions.NodeExistsError:
+                            pass  # ignore failure here
+                    value, get_stat = self._client.get(path)
+                    version = get_stat.version
+                value = _deserialize(self._codec, self._metrics, key, value)
+                value, changed = _merge(key, value, updated_value, sub)
+                if value is None:
                     return False
-                value = json.dumps(value, indent=2, sort_keys=True)
-                update_stat = self._client.set(
-                    path, value, version=get_stat.version)
-                if update_stat:
-                    done = True
+                if not changed and not force:
+                    if optimistic:
+                        continue  # the cache may be stale, check the node
+                    self._record_update(path, 'skipped')
+                    return True
+                value = _serialize(self._codec, self._metrics, key, value)
+                self._client.set(path, value, version=version)
+                self._record_update(path, 'writes')
+                break
             except kazoo.exceptions.BadVersionError:
+                if optimistic:
+                    continue  # the cached property is stale, read it again
+                self._record_update(path, 'conflicts')
+                if retries >= self._max_update_retries:
+                    logging.error('Giving up on updating {0} after {1}'
+                                  ' retries'.format(path, retries))
+                    self._record_update(path, 'failures')
+                    return False
+                retries += 1
+                self._record_update(path, 'retries')
+                if self._metrics:
+                    self._metrics.record_retry(key.type)
                 logging.info('trying again to update {0}'.format(path))
-                continue  # ignore this, try again
+                time.sleep(_backoff_delay(retries))
+            except kazoo.exceptions.NoNodeError:
+                if optimistic:
+                    continue  # the cached property is gone, read it again
+                logging.error(path)
+                logging.error(traceback.format_exc())
+                return False
             except kazoo.exceptions.KazooException:
                 logging.error(path)
                 logging.error(traceback.format_exc())
                 return False
+        self._invalidate(key)
         return True
 
+    @_instrumented('remove')
     def remove(self, key):
         """
         Remove a property
@@ -207,9 +498,12 @@ class DataAccessor(object):
         Returns:
             True if successful, False otherwise
         """
-        path = key['path']
+        path = key.path
         try:
             self._client.delete(path, recursive=True)
+            self._invalidate(key)
+            with self._update_stats_lock:
+                self._update_stats.pop(path, None)
             return True
         except kazoo.exceptions.NoNodeError:
             logging.warn('{0} does not exist'.format(path))
@@ -218,6 +512,7 @@ class DataAccessor(object):
             logging.error(traceback.format_exc())
         return False
 
+    @_instrumented('exists')
     def exists(self, key):
         """
         Check if a property exists
@@ -228,7 +523,7 @@ class DataAccessor(object):
         Returns:
             True if exists, False otherwise
         """
-        path = key['path']
+        path = key.path
         try:
             return self._client.exists(path) is not None
         except kazoo.exceptions.KazooException:
@@ -236,6 +531,17 @@ class DataAccessor(object):
             logging.error(traceback.format_exc())
         return False
 
+    def transaction(self):
+        """
+        Start a batch of operations that will be committed atomically
+
+        Returns:
+            Transaction instance
+        """
+        return Transaction(
+            self._client, self._codec, metrics=self._metrics,
+            max_update_retries=self._max_update_retries)
+
     def watch_children(self, key, func):
         """
         Watch children of a property
@@ -244,7 +550,7 @@ class DataAccessor(object):
             key: KeyBuilder property
             func: Single argument callback
         """
-        path = key['path']
+        path = key.path
         kazoo.recipe.watchers.ChildrenWatch(self._client, path, func=func)
 
     def watch_property(self, key, func):
@@ -255,9 +561,61 @@ class DataAccessor(object):
             key: KeyBuilder property
             func: Two-argument callback that takes data, stat
         """
-        path = key['path']
+        path = key.path
         kazoo.recipe.watchers.DataWatch(self._client, path, func=func)
 
+    def get_update_stats(self):
+        """
+        Get update contention counters for each path that was updated
+
+        The counters are updates (calls), writes, skipped (no-op updates),
+        conflicts (version mismatches), retries and failures (updates that
+        ran out of retries). Only the MAX_UPDATE_STATS most recently updated
+        paths are kept, and removing a property drops its counters.
+
+        Returns:
+            Map of path to a dictionary of counters
+        """
+        with self._update_stats_lock:
+            return dict(
+                (path, dict(counters))
+                for path, counters in self._update_stats.iteritems())
+
+    def get_metrics(self):
+        """
+        Get the registry that accessor metrics are recorded in.
+
+        Returns:
+            MetricsRegistry instance, or None if instrumentation is disabled
+        """
+        return self._metrics
+
+    def get_cache_stats(self):
+        """
+        Get property cache effectiveness counters
+
+        Returns:
+            Dictionary of hits, misses, evictions and size, or None if
+            caching is disabled
+        """
+        if not self._cache:
+            return None
+        return self._cache.get_stats()
+
+    def get_async_accessor(self):
+        """
+        Get a future-returning accessor that shares this connection.
+
+        Returns:
+            AsyncDataAccessor instance
+        """
+        if not self._async_accessor:
+            self._async_accessor = AsyncDataAccessor(
+                self._cluster_id, self._client, codec=self._codec,
+                max_update_retries=self._max_update_retries,
+                metrics=self._metrics)
+        return self._async_accessor
+
     def get_key_builder(self):
         """
         Get a key builder that can be used with this accessor.
@@ -265,4 +623,783 @@ class DataAccessor(object):
         Returns:
             KeyBuilder instance
         """
-        return keybuilder.KeyBuilder(self._cluster_id)
+        return self._builder
+
+    def get_codec(self):
+        """
+        Get the codec this accessor uses for ZNode data.
+
+        Returns:
+            JsonCodec instance
+        """
+        return self._codec
+
+    def _get_data(self, key):
+        """
+        Read the data of a property, through the cache if enabled (private)
+
+        Args:
+            key: KeyBuilder property
+
+        Returns:
+            (raw ZNode data, ZNode version) pair
+        """
+        path = key.path
+        if self._cache and key.cacheable:
+            entry = self._cache.get(path)
+            if entry is None:
+                epoch = self._cache.get_epoch()
+                value, stat = self._client.get(
+                    path, watch=self._cache_watcher)
+                entry = (value, stat.version)
+                self._cache.put(path, value, stat.version, epoch)
+            return entry
+        value, stat = self._client.get(path)
+        return value, stat.version
+
+    def _get_bucket_size(self, key, data, sub=False):
+        """
+        Get the bucket size to store a record with (private)
+
+        Args:
+            key: KeyBuilder property
+            data: The data to write (python object)
+            sub: True if the data will be subtracted
+
+        Returns:
+            Number of partitions per bucket, or 0 if not bucketized
+        """
+        if not key.bucketized:
+            return 0
+        bucket_size = bucketizer.get_bucket_size(data)
+        if not bucket_size and sub:
+            # subtractions don't carry the bucket size, so check the record
+            try:
+                value, stat = self._client.get(key.path)
+                bucket_size = bucketizer.get_bucket_size(_deserialize(
+                    self._codec, self._metrics, key, value))
+            except kazoo.exceptions.KazooException:
+                pass  # the update itself will report the failure
+        return bucket_size
+
+    def _set_buckets(self, key, record, bucket_size):
+        """
+        Set a bucketized record, replacing all existing buckets (private)
+
+        Args:
+            key: KeyBuilder property
+            record: The ZNRecord (python object)
+            bucket_size: Number of partitions per bucket
+
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            buckets = bucketizer.ZNRecordBucketizer(bucket_size).bucketize(
+                record)
+        except ValueError as e:
+            logging.error('Cannot bucketize {0}: {1}'.format(key.path, e))
+            return False
+        meta = znode.get_empty_znode(record['id'])
+        meta['simpleFields'] = record['simpleFields']
+        if not self._set_record(key, meta):
+            return False
+        stale = set(self.get_children(key)) - set(buckets)
+        for bucket_name, bucket in buckets.iteritems():
+            if not self._set_record(
+                    self._builder.bucket(key, bucket_name), bucket):
+                return False
+        for bucket_name in stale:
+            self.remove(self._builder.bucket(key, bucket_name))
+        return True
+
+    def _update_buckets(self, key, updated_value, sub, bucket_size):
+        """
+        Update the buckets of a bucketized record (private)
+
+        Args:
+            key: KeyBuilder property
+            updated_value: The data to write (python object)
+            sub: True to subtract the updated value, False to add it
+            bucket_size: Number of partitions per bucket
+
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            buckets = bucketizer.ZNRecordBucketizer(bucket_size).bucketize(
+                updated_value)
+        except ValueError as e:
+            logging.error('Cannot bucketize {0}: {1}'.format(key.path, e))
+            return False
+        if not sub or updated_value['simpleFields']:
+            meta = znode.get_empty_znode(updated_value['id'])
+            meta['simpleFields'] = updated_value['simpleFields']
+            # always write the meta record: readers of bucketized records
+            # watch it to learn that buckets changed
+            if not self._update_record(key, meta, sub, force=True):
+                return False
+        for bucket_name, bucket in buckets.iteritems():
+            if not self._update_record(
+                    self._builder.bucket(key, bucket_name), bucket, sub):
+                return False
+        return True
+
+    def _record_update(self, path, counter):
+        """
+        Increment an update counter for a path (private)
+
+        Args:
+            path: The property path
+            counter: Name of the counter
+        """
+        with self._update_stats_lock:
+            counters = self._update_stats.pop(path, None)
+            if counters is None:
+                counters = dict.fromkeys(
+                    ('updates', 'writes', 'skipped', 'conflicts', 'retries',
+                     'failures'), 0)
+                while len(self._update_stats) >= self.MAX_UPDATE_STATS:
+                    self._update_stats.popitem(last=False)
+            self._update_stats[path] = counters
+            counters[counter] += 1
+
+    def _invalidate(self, key):
+        """
+        Drop a property that was written from the cache (private)
+
+        Args:
+            key: KeyBuilder property
+        """
+        if self._cache and key.cacheable:
+            self._cache.invalidate(key.path)
+
+    def _cache_watcher(self, event):
+        """
+        Callback for changes to cached properties (private)
+
+        Args:
+            event: The kazoo WatchedEvent
+        """
+        self._cache.invalidate(event.path)
+
+    def _cache_connection_listener(self, state):
+        """
+        Callback for connection state changes (private)
+
+        Watches do not survive a lost session, so nothing cached can be
+        trusted afterwards.
+
+        Args:
+            state: the current connection state (LOST, CONNECTED, SUSPENDED)
+        """
+        if state == kazoo.client.KazooState.LOST:
+            self._cache.clear()
+
+
+class AsyncDataAccessor(object):
+    """
+    Helix property accessor that pipelines requests
+
+    Every method returns a concurrent.futures.Future immediately, so many
+    requests can be outstanding on the same ZooKeeper session at once. The
+    results match those of the corresponding DataAccessor methods, except
+    that writes never split records into buckets.
+    """
+    def __init__(self, cluster_id, zk_client, codec=None,
+                 max_update_retries=None, metrics=None):
+        """
+        Initialze for a cluster and ZooKeeper connection
+
+        Args:
+            cluster_id: Unique clsuter identifier
+            zk_client: A live connection to ZooKeeper
+            codec: (Optional) ZNRecord codec, compact JSON by default
+            max_update_retries: (Optional) Number of times a conflicting
+                update is retried before giving up
+            metrics: (Optional) MetricsRegistry to record latencies and sizes
+                in, None (default) to disable instrumentation
+        """
+        if max_update_retries is None:
+            max_update_retries = DataAccessor.DEFAULT_MAX_UPDATE_RETRIES
+        self._cluster_id = cluster_id
+        self._client = zk_client
+        self._codec = codec or codec_module.COMPACT_CODEC
+        self._max_update_retries = max_update_retries
+        self._metrics = metrics
+        self._builder = keybuilder.KeyBuilder(cluster_id)
+
+    @_instrumented('create')
+    def create(self, key, data):
+        """
+        Create a property, creating parent nodes as necessary
+
+        Args:
+            key: KeyBuilder property
+            data: The data to write (python object)
+
+        Returns:
+            Future for True if successful, False otherwise
+        """
+        path = key.path
+        future = futures.Future()
+        logging.info('creating {0} with {1}'.format(path, data))
+
+        def on_exists(e):
+            logging.warn('{0} exists already'.format(path))
+            self._chain(self.set(key, data), future)
+
+        self._link(
+            self._client.create_async(
+                path, _serialize(self._codec, self._metrics, key, data),
+                ephemeral=key.ephemeral, sequence=key.sequential,
+                makepath=True),
+            future, path, lambda result: True, False,
+            {kazoo.exceptions.NodeExistsError: on_exists})
+        return future
+
+    @_instrumented('set')
+    def set(self, key, data):
+        """
+        Set a property
+
+        Unlike DataAccessor.set, missing parent nodes are not created.
+
+        Args:
+            key: KeyBuilder property
+            data: The data to write (python object)
+
+        Returns:
+            Future for True if successful, False otherwise
+        """
+        path = key.path
+        future = futures.Future()
+        logging.info('setting {0} with {1}'.format(path, data))
+        self._link(
+            self._client.set_async(
+                path, _serialize(self._codec, self._metrics, key, data)),
+            future, path, lambda stat: True, False)
+        return future
+
+    @_instrumented('get')
+    def get(self, key):
+        """
+        Get a property
+
+        The buckets of a bucketized record are read and reassembled.
+        Records carry the version of the ZNode they were read from.
+
+        Args:
+            key: KeyBuilder property
+
+        Returns:
+            Future for the data that is persisted, or None
+        """
+        path = key.path
+        future = futures.Future()
+
+        def on_get(result):
+            value = _deserialize(
+                self._codec, self._metrics, key, result[0])
+            if isinstance(value, znode.ZNRecord):
+                value.version = result[1].version
+            if key.bucketized and bucketizer.get_bucket_size(value):
+                self._get_buckets(key, value, future)
+            else:
+                future.set_result(value)
+
+        self._link(
+            self._client.get_async(path), future, path, on_get, None,
+            resolve=False)
+        return future
+
+    @_instrumented('children')
+    def get_children(self, key):
+        """
+        Get the children of a property
+
+        Args:
+            key: KeyBuilder property
+
+        Returns:
+            Future for the list of child names
+        """
+        path = key.path
+        future = futures.Future()
+        self._link(
+            self._client.get_children_async(path), future, path,
+            lambda children: children, [])
+        return future
+
+    @_instrumented('update')
+    def update(self, key, updated_value, sub=False):
+        """
+        Update a property
+
+        Args:
+            key: KeyBuilder property
+            updated_value: The data to write (python object)
+            sub: True to subtract the updated value, False (default) to add it
+
+        Returns:
+            Future for True if successful, False otherwise
+        """
+        path = key.path
+        future = futures.Future()
+
+        def on_no_node(e):
+            if key.update_only_on_exists or sub:
+                logging.info('{0} does not exist, cannot update'.format(path))
+                future.set_result(False)
+                return
+            self._link(
+                self._client.create_async(
+                    path, _serialize(
+                        self._codec, self._metrics, key, updated_value),
+                    ephemeral=key.ephemeral, sequence=key.sequential,
+                    makepath=True),
+                future, path, lambda result: True, False,
+                {kazoo.exceptions.NodeExistsError: attempt})
+
+        def on_get(result):
+            value, get_stat = result
+            value = _deserialize(self._codec, self._metrics, key, value)
+            value, changed = _merge(key, value, updated_value, sub)
+            if value is None or not changed:
+                future.set_result(value is not None)
+                return
+            self._link(
+                self._client.set_async(
+                    path, _serialize(self._codec, self._metrics, key, value),
+                    version=get_stat.version),
+                future, path, lambda stat: True, False,
+                {kazoo.exceptions.BadVersionError: on_conflict})
+
+        def on_conflict(e):
+            if retries[0] >= self._max_update_retries:
+                logging.error('Giving up on updating {0} after {1}'
+                              ' retries'.format(path, retries[0]))
+                future.set_result(False)
+                return
+            retries[0] += 1
+            if self._metrics:
+                self._metrics.record_retry(key.type)
+            logging.info('trying again to update {0}'.format(path))
+            timer = threading.Timer(_backoff_delay(retries[0]), attempt)
+            timer.daemon = True
+            timer.start()
+
+        def attempt(e=None):
+            self._link(
+                self._client.get_async(path), future, path, on_get, False,
+                {kazoo.exceptions.NoNodeError: on_no_node}, resolve=False)
+
+        retries = [0]
+        attempt()
+        return future
+
+    @_instrumented('remove')
+    def remove(self, key):
+        """
+        Remove a property
+
+        Unlike DataAccessor.remove, the removal is not recursive.
+
+        Args:
+            key: KeyBuilder property
+
+        Returns:
+            Future for True if successful, False otherwise
+        """
+        path = key.path
+        future = futures.Future()
+        self._link(
+            self._client.delete_async(path), future, path,
+            lambda result: True, False)
+        return future
+
+    @_instrumented('exists')
+    def exists(self, key):
+        """
+        Check if a property exists
+
+        Args:
+            key: KeyBuilder property
+
+        Returns:
+            Future for True if exists, False otherwise
+        """
+        path = key.path
+        future = futures.Future()
+        self._link(
+            self._client.exists_async(path), future, path,
+            lambda stat: stat is not None, False)
+        return future
+
+    def get_many(self, keys):
+        """
+        Get several properties with all requests in flight at once
+
+        Args:
+            keys: List of KeyBuilder properties
+
+        Returns:
+            List of persisted data (or None), in the same order as keys
+        """
+        return [f.result() for f in [self.get(key) for key in keys]]
+
+    def set_many(self, keys_and_data):
+        """
+        Set several properties with all requests in flight at once
+
+        Args:
+            keys_and_data: List of (KeyBuilder property, data) pairs
+
+        Returns:
+            List of True/False results, in the same order as keys_and_data
+        """
+        return [f.result() for f in [
+            self.set(key, data) for key, data in keys_and_data]]
+
+    def get_key_builder(self):
+        """
+        Get a key builder that can be used with this accessor.
+
+        Returns:
+            KeyBuilder instance
+        """
+        return self._builder
+
+    def _link(self, async_result, future, path, on_value, default,
+              handlers=None, resolve=True):
+        """
+        Complete a future from a kazoo asynchronous result (private)
+
+        Args:
+            async_result: The kazoo IAsyncResult
+            future: The future to complete
+            path: The path being accessed, for logging
+            on_value: Function of the kazoo result giving the future result
+            default: Result of the future if the request fails
+            handlers: Map of exception type to single-argument function that
+                takes over completing the future when that exception occurs
+            resolve: False if on_value takes over completing the future
+        """
+        handlers = handlers or {}
+
+        def callback(result):
+            try:
+                value = result.get()
+            except kazoo.exceptions.KazooException as e:
+                for exc_type, handler in handlers.iteritems():
+                    if isinstance(e, exc_type):
+                        handler(e)
+                        return
+                if isinstance(e, kazoo.exceptions.NoNodeError):
+                    logging.info('{0} does not exist'.format(path))
+                else:
+                    logging.error(path)
+                    logging.error(traceback.format_exc())
+                future.set_result(default)
+                return
+            try:
+                value = on_value(value)
+            except Exception as e:
+                future.set_exception(e)
+                return
+            if resolve:
+                future.set_result(value)
+
+        async_result.rawlink(callback)
+
+    def _get_buckets(self, key, record, future):
+        """
+        Complete a future with a record and all of its buckets (private)
+
+        Args:
+            key: The bucketized KeyBuilder property
+            record: The ZNRecord (python object) read from the property
+            future: The future to complete
+        """
+        lock = threading.Lock()
+        pending = []
+
+        def on_bucket(unused):
+            with lock:
+                pending.pop()
+                done = not pending
+            if done:
+                for bucket_future in bucket_futures:
+                    _merge_bucket(record, bucket_future.result())
+                future.set_result(record)
+
+        bucket_futures = []
+
+        def on_children(children_future):
+            bucket_futures.extend([
+                self.get(self._builder.bucket(key, bucket_name))
+                for bucket_name in children_future.result()])
+            if not bucket_futures:
+                future.set_result(record)
+                return
+            pending.extend(bucket_futures)
+            for bucket_future in list(bucket_futures):
+                bucket_future.add_done_callback(on_bucket)
+
+        self.get_children(key).add_done_callback(on_children)
+
+    def _chain(self, source, future):
+        """
+        Complete a future with the outcome of another (private)
+
+        Args:
+            source: The future whose result is forwarded
+            future: The future to complete
+        """
+        def callback(f):
+            if f.exception():
+                future.set_exception(f.exception())
+            else:
+                future.set_result(f.result())
+        source.add_done_callback(callback)
+
+
+class Transaction(object):
+    """
+    A batch of property operations applied in a single ZooKeeper multi
+
+    Either every operation succeeds or none of them are applied. Unlike
+    DataAccessor.create, parent nodes are not created automatically, so a
+    create must be preceded by creates of any missing parents.
+    """
+    def __init__(self, zk_client, codec, metrics=None,
+                 max_update_retries=None):
+        """
+        Initialize an empty transaction
+
+        Args:
+            zk_client: A live connection to ZooKeeper
+            codec: ZNRecord codec
+            metrics: (Optional) MetricsRegistry to record sizes in
+            max_update_retries: (Optional) Number of times a commit whose
+                updates conflict is retried before giving up
+        """
+        if max_update_retries is None:
+            max_update_retries = DataAccessor.DEFAULT_MAX_UPDATE_RETRIES
+        self._client = zk_client
+        self._codec = codec
+        self._metrics = metrics
+        self._max_update_retries = max_update_retries
+        self._ops = []
+
+    def create(self, key, data):
+        """
+        Add a property creation to the transaction
+
+        Args:
+            key: KeyBuilder property
+            data: The data to write (python object)
+        """
+        self._ops.append(('create', key, data, -1))
+
+    def set(self, key, data, version=-1):
+        """
+        Add a property write to the transaction
+
+        Args:
+            key: KeyBuilder property
+            data: The data to write (python object)
+            version: Expected version of the property, -1 (default) for any
+        """
+        self._ops.append(('set', key, data, version))
+
+    def remove(self, key, version=-1):
+        """
+        Add a (non-recursive) property removal to the transaction
+
+        Args:
+            key: KeyBuilder property
+            version: Expected version of the property, -1 (default) for any
+        """
+        self._ops.append(('remove', key, None, version))
+
+    def update(self, key, updated_value, sub=False):
+        """
+        Add a property update to the transaction
+
+        The property is read when the transaction is committed, and written
+        back only if it is still at the version read; commits that conflict
+        are retried. Updates of the same property are combined into one
+        write. A missing property is created (its parent must exist), unless
+        the update is a subtraction, which then does nothing. Records are
+        not split into buckets.
+
+        Args:
+            key: KeyBuilder property
+            updated_value: The data to write (python object)
+            sub: True to subtract the updated value, False (default) to add it
+        """
+        self._ops.append(('update', key, (updated_value, sub), -1))
+
+    def check(self, key, version):
+        """
+        Require a property to be at a version for the transaction to succeed
+
+        Args:
+            key: KeyBuilder property
+            version: Expected version of the property
+        """
+        self._ops.append(('check', key, None, version))
+
+    def commit(self):
+        """
+        Apply all operations atomically
+
+        The commit is timed as a "multi" operation of each property type in
+        the transaction, and a commit retried because an updated property
+        changed counts as a retry of each type that is updated.
+
+        Returns:
+            True if successful, False otherwise
+        """
+        if not self._ops:
+            return True
+        start = time.time()
+        try:
+            retries = 0
+            while True:
+                result = self._commit_once()
+                if result is not None:
+                    return result
+                if retries >= self._max_update_retries:
+                    logging.error('Giving up on transaction after {0}'
+                                  ' retries'.format(retries))
+                    return False
+                retries += 1
+                if self._metrics:
+                    for property_type in set(
+                            key.type for op, key, data, version in self._ops
+                            if op == 'update'):
+                        self._metrics.record_retry(property_type)
+                logging.info('trying again to commit transaction')
+                time.sleep(_backoff_delay(retries))
+        finally:
+            if self._metrics:
+                # once for each kind of property the multi touched
+                seconds = time.time() - start
+                for property_type in set(
+                        key.type for op, key, data, version in self._ops):
+                    self._metrics.record_latency(
+                        property_type, 'multi', seconds)
+
+    def _commit_once(self):
+        """
+        Read the updated properties and try to commit once (private)
+
+        Returns:
+            True if successful, False if failed, or None if an updated
+            property changed since it was read
+        """
+        paths = []
+        try:
+            staged = self._stage_updates()
+            if staged is None:
+                return False
+            txn = self._client.transaction()
+            for op, key, data, version in self._ops:
+                path = key.path
+                if op == 'update':
+                    if path not in staged:
+                        continue  # written already, or nothing to write
+                    value, version = staged.pop(path)
+                    data = _serialize(self._codec, self._metrics, key, value)
+                    if version is None:
+                        txn.create(path, data, ephemeral=key.ephemeral,
+                                   sequence=key.sequential)
+                    else:
+                        txn.set_data(path, data, version=version)
+                elif op == 'create':
+                    txn.create(
+                        path, _serialize(
+                            self._codec, self._metrics, key, data),
+                        ephemeral=key.ephemeral, sequence=key.sequential)
+                elif op == 'set':
+                    txn.set_data(
+                        path, _serialize(
+                            self._codec, self._metrics, key, data),
+                        version=version)
+                elif op == 'remove':
+                    txn.delete(path, version=version)
+                else:
+                    txn.check(path, version)
+                paths.append((op, path))
+            if not paths:
+                return True
+            logging.info('committing {0} operations on {1}'.format(
+                len(paths), [path for op, path in paths]))
+            results = txn.commit()
+        except kazoo.exceptions.KazooException:
+            logging.error(paths)
+            logging.error(traceback.format_exc())
+            return False
+        failed = False
+        conflict = False
+        for (op, path), result in zip(paths, results):
+            if (isinstance(result, Exception) and
+               not isinstance(result, kazoo.exceptions.RolledBackError)):
+                logging.info('transaction failed on {0}: {1}'.format(
+                    path, type(result).__name__))
+                failed = True
+                if op == 'update' and isinstance(result, (
+                        kazoo.exceptions.BadVersionError,
+                        kazoo.exceptions.NodeExistsError)):
+                    conflict = True
+        if conflict:
+            return None
+        return not failed
+
+    def _stage_updates(self):
+        """
+        Read and merge the properties to update (private)
+
+        Returns:
+            Map of path to (merged value, version read or None if missing)
+            for the properties to write, or None if an update is not allowed
+        """
+        staged = {}
+        unchanged = set()
+        for op, key, data, version in self._ops:
+            if op != 'update':
+                continue
+            path = key.path
+            updated_value, sub = data
+            if path not in staged:
+                try:
+                    value, stat = self._client.get(path)
+                    unchanged.add(path)
+                    staged[path] = (
+                        _deserialize(self._codec, self._metrics, key, value),
+                        stat.version)
+                except kazoo.exceptions.NoNodeError:
+                    staged[path] = (None, None)
+            value, version = staged[path]
+            if value is None:
+                if key.update_only_on_exists and not sub:
+                    logging.info(
+                        '{0} does not exist, cannot update'.format(path))
+                    return None
+                if not sub:
+                    staged[path] = (copy.deepcopy(updated_value), None)
+                    unchanged.discard(path)
+                continue
+            value, changed = _merge(key, value, updated_value, sub)
+            if value is None:
+                return None
+            staged[path] = (value, version)
+            if changed:
+                unchanged.discard(path)
+        for path in unchanged:
+            del staged[path]
+        return dict(
+            (path, entry) for path, entry in staged.iteritems()
+            if entry[0] is not None)
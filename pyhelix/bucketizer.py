@@ -0,0 +1,86 @@
+import znode
+
+# Simple field holding the number of partitions per bucket
+BUCKET_SIZE_FIELD = 'BUCKET_SIZE'
+
+
+def get_bucket_size(record):
+    """
+    Get the bucket size a ZNRecord is stored with
+
+    Args:
+        record: The ZNRecord (python object)
+
+    Returns:
+        Number of partitions per bucket, or 0 if not bucketized
+    """
+    try:
+        return int(record['simpleFields'].get(BUCKET_SIZE_FIELD, 0))
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return 0
+
+
+class ZNRecordBucketizer(object):
+    """
+    Splits a ZNRecord into buckets of partitions, as Java Helix does
+
+    Partition names are expected to look like "resourceName_partitionNumber".
+    Partitions 0 to bucket_size - 1 are stored in the bucket named
+    "resourceName_p0-p{bucket_size - 1}", and so on.
+    """
+    def __init__(self, bucket_size):
+        """
+        Initialize the bucketizer
+
+        Args:
+            bucket_size: Number of partitions per bucket
+        """
+        self._bucket_size = bucket_size
+
+    def get_bucket_name(self, partition_name):
+        """
+        Get the name of the bucket that holds a partition
+
+        Args:
+            partition_name: The partition
+
+        Returns:
+            The bucket name
+
+        Raises:
+            ValueError: If the partition name has no partition number
+        """
+        idx = partition_name.rfind('_')
+        if idx < 0:
+            raise ValueError(
+                'No partition number in {0}'.format(partition_name))
+        partition_number = int(partition_name[idx + 1:])
+        start = (partition_number // self._bucket_size) * self._bucket_size
+        end = start + self._bucket_size - 1
+        return '{0}_p{1}-p{2}'.format(partition_name[:idx], start, end)
+
+    def bucketize(self, record):
+        """
+        Split the list and map fields of a record into buckets
+
+        Every bucket gets a copy of the record's simple fields.
+
+        Args:
+            record: The ZNRecord (python object)
+
+        Returns:
+            Map of bucket name to bucket ZNRecord
+
+        Raises:
+            ValueError: If a partition name has no partition number
+        """
+        buckets = {}
+        for fields in ('listFields', 'mapFields'):
+            for partition_name, value in record[fields].iteritems():
+                bucket_name = self.get_bucket_name(partition_name)
+                if bucket_name not in buckets:
+                    buckets[bucket_name] = znode.get_empty_znode(bucket_name)
+                buckets[bucket_name][fields][partition_name] = value
+        for bucket in buckets.itervalues():
+            bucket['simpleFields'] = dict(record['simpleFields'])
+        return buckets
@@ -0,0 +1,203 @@
+import json
+import zlib
+
+import znode
+
+# Payloads starting with these bytes are gzip streams
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Simple field that asks Helix serializers to compress a record
+COMPRESSION_FIELD = 'enableCompression'
+
+
+def is_compressed(data):
+    """
+    Check if ZNode data is gzip-compressed
+
+    Args:
+        data: The raw ZNode data
+
+    Returns:
+        True if compressed, False otherwise
+    """
+    return data is not None and data[:2] == GZIP_MAGIC
+
+
+def compress(data):
+    """
+    Compress data in the gzip format
+
+    Args:
+        data: The bytes to compress
+
+    Returns:
+        The gzip stream
+    """
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data):
+    """
+    Decompress a gzip stream
+
+    Args:
+        data: The gzip stream
+
+    Returns:
+        The uncompressed bytes
+    """
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def _to_dict(value):
+    """
+    Convert a ZNRecord for JSON serialization (private)
+
+    Args:
+        value: An object the json module cannot serialize
+
+    Returns:
+        The dictionary form of the record
+
+    Raises:
+        TypeError: If value is not a ZNRecord
+    """
+    if isinstance(value, znode.ZNRecord):
+        return value.to_dict()
+    raise TypeError('{0!r} is not JSON serializable'.format(value))
+
+
+class JsonCodec(object):
+    """
+    Converts ZNRecords to and from the JSON format used by Helix
+
+    As in Java Helix, records that set the enableCompression simple field to
+    "true" are gzip-compressed, and compressed payloads are detected by their
+    gzip header when reading, whichever codec wrote them.
+    """
+    def __init__(self, indent=None, sort_keys=False):
+        """
+        Initialize the JSON layout
+
+        Args:
+            indent: Spaces to indent nested objects with, None (default) for
+                the most compact output
+            sort_keys: True to write keys in sorted order
+        """
+        self._indent = indent
+        self._sort_keys = sort_keys
+        self._separators = (',', ': ') if indent else (',', ':')
+
+    def serialize(self, data):
+        """
+        Serialize a python object for storage in a ZNode
+
+        Args:
+            data: The data to write (python object)
+
+        Returns:
+            The serialized data, or the data itself if empty
+        """
+        if not data:
+            return data
+        value = json.dumps(
+            data, indent=self._indent, sort_keys=self._sort_keys,
+            separators=self._separators, default=_to_dict)
+        if self._should_compress(data, value):
+            value = compress(value)
+        return value
+
+    def deserialize(self, value, lazy=False):
+        """
+        Deserialize the contents of a ZNode
+
+        Args:
+            value: The raw ZNode data
+            lazy: True to decode map and list fields of a record on demand
+
+        Returns:
+            ZNRecord, other python object, or the data itself if empty
+        """
+        if not value:
+            return value
+        if is_compressed(value):
+            value = decompress(value)
+        if (lazy and value.lstrip()[:1] == '{' and
+                '"simpleFields"' in value):
+            return znode.LazyZNRecord(value)
+        value = json.loads(value)
+        if isinstance(value, dict) and 'simpleFields' in value:
+            return znode.ZNRecord.from_dict(value)
+        return value
+
+    def _should_compress(self, data, value):
+        """
+        Check if a serialized record should be compressed (private)
+
+        Args:
+            data: The python object
+            value: The serialized data
+
+        Returns:
+            True to compress, False otherwise
+        """
+        try:
+            return data['simpleFields'].get(COMPRESSION_FIELD) == 'true'
+        except (KeyError, TypeError, AttributeError):
+            return False
+
+
+class GzipJsonCodec(JsonCodec):
+    """
+    JSON codec that compresses large records
+
+    Compressed records are marked with the enableCompression simple field,
+    so Java Helix keeps compressing them when it rewrites them.
+    """
+    def __init__(self, threshold=0, indent=None, sort_keys=False):
+        """
+        Initialize the codec
+
+        Args:
+            threshold: Serialized size in bytes above which records are
+                compressed, 0 (default) to compress all records
+            indent: Spaces to indent nested objects with
+            sort_keys: True to write keys in sorted order
+        """
+        super(GzipJsonCodec, self).__init__(
+            indent=indent, sort_keys=sort_keys)
+        self._threshold = threshold
+
+    def serialize(self, data):
+        """
+        Serialize a python object for storage in a ZNode
+
+        Args:
+            data: The data to write (python object)
+
+        Returns:
+            The serialized data, or the data itself if empty
+        """
+        value = super(GzipJsonCodec, self).serialize(data)
+        if (not value or is_compressed(value) or
+           len(value) <= self._threshold):
+            return value
+        if isinstance(data, dict) and 'simpleFields' in data:
+            data = znode.ZNRecord.from_dict(data)
+        if isinstance(data, znode.ZNRecord):
+            # mark the record so other writers also compress it
+            simple_fields = dict(data.simple_fields)
+            simple_fields[COMPRESSION_FIELD] = 'true'
+            data = znode.ZNRecord(
+                data.id, simple_fields, data.list_fields, data.map_fields)
+            return super(GzipJsonCodec, self).serialize(data)
+        return compress(value)
+
+
+# Indented, sorted JSON, as written by earlier versions of pyhelix
+PRETTY_CODEC = JsonCodec(indent=2, sort_keys=True)
+
+# Compact JSON, the default
+COMPACT_CODEC = JsonCodec()
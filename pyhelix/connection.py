@@ -0,0 +1,463 @@
+import kazoo.client
+import threading
+
+# Port used for ZooKeeper servers that are listed without one
+DEFAULT_ZK_PORT = 2181
+
+
+def normalize_zk_addrs(zk_addrs):
+    """
+    Get a canonical form of a ZooKeeper connection string
+
+    Strings that name the same servers (in any order) and chroot normalize
+    to the same value.
+
+    Args:
+        zk_addrs: Comma-separated host:port of ZooKeeper servers, optionally
+            followed by a chroot path
+
+    Returns:
+        The normalized connection string
+    """
+    chroot = ''
+    if '/' in zk_addrs:
+        zk_addrs, chroot = zk_addrs.split('/', 1)
+        chroot = '/' + chroot.rstrip('/')
+        if chroot == '/':
+            chroot = ''
+    servers = set()
+    for server in zk_addrs.split(','):
+        server = server.strip().lower()
+        if not server:
+            continue
+        if ':' not in server:
+            server = '{0}:{1}'.format(server, DEFAULT_ZK_PORT)
+        servers.add(server)
+    return ','.join(sorted(servers)) + chroot
+
+
+class SessionManager(object):
+    """
+    Hands out one shared ZooKeeper session per ensemble
+
+    Each call to acquire() returns a SharedClient for a single owner, such as
+    a participant or spectator connection. Owners of the same ensemble share
+    one KazooClient, which is started when the first owner starts and
+    stopped when the last owner stops.
+    """
+    def __init__(self, client_factory=kazoo.client.KazooClient):
+        """
+        Initialize an empty manager
+
+        Args:
+            client_factory: (Optional) Callable that creates a KazooClient
+                from a connection string
+        """
+        self._client_factory = client_factory
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, zk_addrs):
+        """
+        Get a client for one owner of a shared session
+
+        Args:
+            zk_addrs: Comma-separated host:port of ZooKeeper servers
+
+        Returns:
+            SharedClient, to be closed by the owner when done
+        """
+        return self._join(zk_addrs)
+
+    def get_sessions(self):
+        """
+        Get the number of owners of each shared session
+
+        Returns:
+            Map of normalized connection string to owner count
+        """
+        with self._lock:
+            return dict(
+                (ensemble, session.get_owner_count())
+                for ensemble, session in self._sessions.iteritems())
+
+    def _join(self, zk_addrs, owner=None):
+        """
+        Add an owner to the shared session of an ensemble (private)
+
+        Args:
+            zk_addrs: Comma-separated host:port of ZooKeeper servers
+            owner: (Optional) Closed SharedClient to register again
+
+        Returns:
+            The SharedClient
+        """
+        ensemble = normalize_zk_addrs(zk_addrs)
+        with self._lock:
+            session = self._sessions.get(ensemble)
+            if session is not None:
+                added = session.add_owner(owner)
+                if added is not None:
+                    return added
+            # no session yet, or its last owner is closing it
+            session = _SharedSession(
+                self, ensemble, zk_addrs, self._client_factory(zk_addrs))
+            self._sessions[ensemble] = session
+            return session.add_owner(owner)
+
+    def _discard(self, session):
+        """
+        Forget a session that no longer has owners (private)
+
+        Args:
+            session: The _SharedSession
+        """
+        with self._lock:
+            if self._sessions.get(session.ensemble) is session:
+                del self._sessions[session.ensemble]
+
+
+class _SharedSession(object):
+    """
+    A KazooClient and the owners that share it (private)
+    """
+    def __init__(self, manager, ensemble, zk_addrs, client):
+        self.ensemble = ensemble
+        self.zk_addrs = zk_addrs
+        self.client = client
+        self._manager = manager
+        self._owners = []
+        self._started = 0
+        self._closed = False
+        self._lock = threading.RLock()
+        client.add_listener(self._dispatch)
+
+    def add_owner(self, owner=None):
+        """
+        Register an owner of this session
+
+        Args:
+            owner: (Optional) Closed SharedClient to register again, a new
+                one is created if None
+
+        Returns:
+            The SharedClient, or None if the session is being closed
+        """
+        with self._lock:
+            if self._closed:
+                return None
+            if owner is None:
+                owner = SharedClient(self)
+            else:
+                owner._session = self
+            self._owners.append(owner)
+            return owner
+
+    def get_owner_count(self):
+        """
+        Get the number of registered owners
+
+        Returns:
+            Owner count
+        """
+        with self._lock:
+            return len(self._owners)
+
+    def start(self, owner, timeout):
+        """
+        Start the client for an owner, connecting if it is the first one
+
+        Args:
+            owner: The SharedClient that starts
+            timeout: Seconds to wait for a connection
+        """
+        with self._lock:
+            if self._started == 0:
+                self.client.start(timeout)
+            self._started += 1
+
+    def stop(self, owner):
+        """
+        Stop the client for an owner, disconnecting if it was the last one
+
+        Args:
+            owner: The SharedClient that stops
+        """
+        with self._lock:
+            self._started -= 1
+            if self._started == 0:
+                self.client.stop()
+
+    def close(self, owner):
+        """
+        Unregister an owner, closing the client if it was the last one
+
+        Args:
+            owner: The SharedClient that closes
+        """
+        with self._lock:
+            if owner in self._owners:
+                self._owners.remove(owner)
+            if self._owners:
+                return
+            self._closed = True
+            self.client.close()
+        self._manager._discard(self)
+
+    def _dispatch(self, state):
+        """
+        Pass a connection state change to every started owner
+
+        Args:
+            state: The KazooState
+        """
+        with self._lock:
+            owners = list(self._owners)
+        for owner in owners:
+            owner._dispatch(state)
+
+
+class SharedClient(object):
+    """
+    One owner's view of a shared ZooKeeper session
+
+    This can be used in place of a KazooClient. Starting and stopping only
+    affect this owner; connection state changes and watches are delivered
+    to the owner only while it is started. Stopping reports the session as
+    lost to the owner's listeners, like stopping a KazooClient does. A
+    closed owner can be started again; it then rejoins the shared session
+    of its ensemble, creating a new one if needed.
+    """
+    def __init__(self, session):
+        """
+        Initialize an owner (use SessionManager.acquire instead)
+
+        Args:
+            session: The shared session
+        """
+        self._session = session
+        self._listeners = []
+        self._started = False
+        self._closed = False
+        self._generation = 0
+        # guarded watch callbacks of the current start, by callback
+        self._guarded = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self._session.client, name)
+
+    @property
+    def connected(self):
+        """
+        True if this owner is started and the session is connected
+        """
+        return self._started and self._session.client.connected
+
+    def start(self, timeout=15):
+        """
+        Start this owner, connecting the shared session if needed
+
+        Args:
+            timeout: Seconds to wait for a connection
+        """
+        with self._lock:
+            if self._started:
+                return
+            if self._closed:
+                session = self._session
+                session._manager._join(session.zk_addrs, self)
+                self._closed = False
+            self._session.start(self, timeout)
+            self._started = True
+            self._generation += 1
+            self._guarded = {}
+
+    def stop(self):
+        """
+        Stop this owner, disconnecting the session if it was the last one
+        """
+        with self._lock:
+            if not self._started:
+                return
+            self._started = False
+        self._session.stop(self)
+        self._notify(kazoo.client.KazooState.LOST)
+
+    def close(self):
+        """
+        Release this owner's reference to the session
+        """
+        self.stop()
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._session.close(self)
+
+    def add_listener(self, listener):
+        """
+        Add a connection state listener for this owner
+
+        Args:
+            listener: Single argument callback that takes a KazooState
+        """
+        with self._lock:
+            if listener not in self._listeners:
+                self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """
+        Remove a connection state listener of this owner
+
+        Args:
+            listener: A callback passed to add_listener
+        """
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def get(self, path, watch=None):
+        """
+        Get the data of a node
+
+        Args:
+            path: The node path
+            watch: (Optional) Data watch callback
+
+        Returns:
+            (data, ZnodeStat) tuple
+        """
+        return self._session.client.get(path, watch=self._guard(watch))
+
+    def get_async(self, path, watch=None):
+        """
+        Asynchronously get the data of a node
+
+        Args:
+            path: The node path
+            watch: (Optional) Data watch callback
+
+        Returns:
+            IAsyncResult for a (data, ZnodeStat) tuple
+        """
+        return self._session.client.get_async(path, watch=self._guard(watch))
+
+    def get_children(self, path, watch=None, include_data=False):
+        """
+        Get the children of a node
+
+        Args:
+            path: The node path
+            watch: (Optional) Child watch callback
+            include_data: (Optional) True to also get the stat of the node
+
+        Returns:
+            List of child names, and the ZnodeStat if include_data
+        """
+        return self._session.client.get_children(
+            path, watch=self._guard(watch), include_data=include_data)
+
+    def get_children_async(self, path, watch=None, include_data=False):
+        """
+        Asynchronously get the children of a node
+
+        Args:
+            path: The node path
+            watch: (Optional) Child watch callback
+            include_data: (Optional) True to also get the stat of the node
+
+        Returns:
+            IAsyncResult for the list of child names
+        """
+        return self._session.client.get_children_async(
+            path, watch=self._guard(watch), include_data=include_data)
+
+    def exists(self, path, watch=None):
+        """
+        Check if a node exists
+
+        Args:
+            path: The node path
+            watch: (Optional) Data watch callback
+
+        Returns:
+            ZnodeStat, or None if the node does not exist
+        """
+        return self._session.client.exists(path, watch=self._guard(watch))
+
+    def exists_async(self, path, watch=None):
+        """
+        Asynchronously check if a node exists
+
+        Args:
+            path: The node path
+            watch: (Optional) Data watch callback
+
+        Returns:
+            IAsyncResult for a ZnodeStat, or None
+        """
+        return self._session.client.exists_async(
+            path, watch=self._guard(watch))
+
+    def _guard(self, watch):
+        """
+        Drop watch events once this owner stops (private)
+
+        A callback gets the same wrapper until the owner starts again, so
+        watching a node repeatedly with it does not add kazoo watchers.
+
+        Args:
+            watch: Watch callback, or None
+
+        Returns:
+            Watch callback that only fires for the current start
+        """
+        if watch is None:
+            return None
+
+        def guarded_watch(event):
+            if self._started and self._generation == generation:
+                return watch(event)
+        with self._lock:
+            generation = self._generation
+            try:
+                return self._guarded.setdefault(watch, guarded_watch)
+            except TypeError:
+                return guarded_watch  # unhashable, such as list.append
+
+    def _dispatch(self, state):
+        """
+        Handle a state change of the shared session (private)
+
+        Args:
+            state: The KazooState
+        """
+        if self._started:
+            self._notify(state)
+
+    def _notify(self, state):
+        """
+        Call the listeners of this owner (private)
+
+        Args:
+            state: The KazooState
+        """
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            if listener(state) is True:
+                self.remove_listener(listener)
+
+
+_default_manager = SessionManager()
+
+
+def get_session_manager():
+    """
+    Get the process-wide session manager
+
+    Returns:
+        SessionManager
+    """
+    return _default_manager
@@ -44,6 +44,8 @@ class CodeRunnerModelFactory(statemodel.StateModelFactory):
     """
     State model factory for an online-offline code runner set
     """
+    state_model_class = CodeRunnerModel
+
     def create_state_model(self, partition_name):
         """
         Create a CodeRunnerModel
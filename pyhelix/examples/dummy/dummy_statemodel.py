@@ -32,6 +32,8 @@ class DummyStateModelFactory(statemodel.StateModelFactory):
     Dummy state model factory
     """
 
+    state_model_class = DummyStateModel
+
     def create_state_model(self, partition_name):
         """
         Create a DummyStateModel
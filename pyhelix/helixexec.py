@@ -3,6 +3,7 @@ import logging
 import time
 
 import helixtask
+import scheduler
 import znode
 
 
@@ -13,22 +14,57 @@ class HelixExecutor(object):
 
     DEFAULT_PARALLELISM = 20
 
-    def __init__(self, state_model_ftys, participant, num_concurrent=None):
+    def __init__(self, state_model_ftys, participant, num_concurrent=None,
+                 current_state_window=0, max_combined_partitions=None,
+                 policy=None, min_concurrent=None, max_concurrent=None,
+                 process_pool_size=None):
         """
         Initialize the executor
 
         Args:
             state_model_ftys: An iterable collection of state model factories
             participant: A Helix participant object
+            num_concurrent: (Optional) Transitions to run at the same time,
+                initially if adaptive; DEFAULT_PARALLELISM by default
+            current_state_window: (Optional) Seconds to combine current state
+                writes of a resource for; 0 (default) writes each one
+            max_combined_partitions: (Optional) Partitions to combine in one
+                current state write at most
+            policy: (Optional) SchedulingPolicy with transition priorities
+                and per-resource caps
+            min_concurrent: (Optional) Fewest transitions to run at the same
+                time if adaptive; 1 by default
+            max_concurrent: (Optional) Most transitions to run at the same
+                time; setting this adapts concurrency to queue wait times
+                and transition latency
+            process_pool_size: (Optional) Worker processes for transitions
+                of process-safe state models; none by default
         """
         if not num_concurrent:
             num_concurrent = self.DEFAULT_PARALLELISM
-        self._threadpool = futures.ThreadPoolExecutor(num_concurrent)
+        if policy is None:
+            policy = scheduler.SchedulingPolicy()
+        self._policy = policy
+        adaptive = None
+        if max_concurrent:
+            adaptive = scheduler.AdaptiveConcurrency(
+                min_concurrent or 1, max_concurrent)
+            num_concurrent = max(adaptive.min_concurrent,
+                                 min(num_concurrent, max_concurrent))
+        self._scheduler = scheduler.PartitionScheduler(
+            num_concurrent, policy=policy, adaptive=adaptive)
         self._state_model_ftys = state_model_ftys
         self._accessor = participant.get_accessor()
         self._builder = self._accessor.get_key_builder()
         self._participant_id = participant.get_participant_id()
         self._participant = participant
+        self._process_pool = None
+        if process_pool_size:
+            self._process_pool = futures.ProcessPoolExecutor(
+                process_pool_size)
+        self._combiner = helixtask.CurrentStateCombiner(
+            participant, current_state_window,
+            max_partitions=max_combined_partitions)
 
     def on_message(self, messages):
         """
@@ -39,51 +75,201 @@ class HelixExecutor(object):
         """
         for message in messages:
             # Skip bad messages
-            if (not message or
-               not message['simpleFields'] or
-               not message['simpleFields']['MSG_TYPE']):
+            if not isinstance(message, znode.ZNRecord):
+                continue
+            # the typed properties are Python calls; index the fields here
+            fields = message.simple_fields
+            message_type = fields.get('MSG_TYPE')
+            if not message_type:
                 continue
 
             # Skip messages that aren't transition messages
-            message_type = message['simpleFields']['MSG_TYPE'].upper()
+            message_type = message_type.upper()
             if message_type != 'STATE_TRANSITION':
                 continue
 
             # Remove messages that aren't for this session
-            tgt_session_id = message['simpleFields']['TGT_SESSION_ID']
+            tgt_session_id = fields['TGT_SESSION_ID']
             session_id = self._participant.get_session_id()
             if tgt_session_id != session_id:
                 logging.warn(
                     'Message {0} has target session id {1},'
                     ' expected {2}'.format(
-                        message['id'], tgt_session_id, session_id))
+                        message.id, tgt_session_id, session_id))
                 self._accessor.remove(
-                    self._builder.message(self._participant_id, message['id']))
+                    self._builder.message(self._participant_id, message.id))
                 continue
 
             # Skip messages that are already read
-            message_state = message['simpleFields']['MSG_STATE'].upper()
+            message_state = fields['MSG_STATE'].upper()
             if message_state != 'NEW':
                 continue
 
             # Get the state model, instantiating if it doesn't exist
-            state_model_name = message['simpleFields']['STATE_MODEL_DEF']
+            state_model_name = fields['STATE_MODEL_DEF']
             state_model_fty = self._state_model_ftys[state_model_name]
-            partition_name = message['simpleFields']['PARTITION_NAME']
-            state_model = state_model_fty.get_state_model(partition_name)
-            if state_model is None:
-                state_model = state_model_fty.create_state_model(
-                    partition_name)
-                state_model_fty.put_state_model(partition_name, state_model)
+            is_batch = message.is_batch_message()
+            if is_batch:
+                partition_names = message.get_partition_names()
+                state_models = [
+                    self._get_state_model(state_model_fty, partition_name)
+                    for partition_name in partition_names]
+            else:
+                partition_name = fields['PARTITION_NAME']
+                state_model = self._get_state_model(
+                    state_model_fty, partition_name)
 
             # Update message to READ
-            message['simpleFields']['MSG_STATE'] = 'READ'
-            message['simpleFields']['READ_TIMESTAMP'] = '{0}'.format(
-                int(time.time() * 1000))
-            message['simpleFields']['EXE_SESSION_ID'] = session_id
-            self._accessor.update(self._builder.message(
-                self._participant_id, message['id']), message)
+            if not self._mark_read(message, session_id):
+                continue
 
             # Schedule the transition for processing
-            task = helixtask.HelixTask(message, state_model, self._participant)
-            self._threadpool.submit(task.call)
+            process_pool = None
+            if getattr(state_model_fty, 'process_safe', False):
+                process_pool = self._process_pool
+            priority = self._policy.get_priority(
+                state_model_name, fields['FROM_STATE'],
+                fields['TO_STATE'])
+            timeout = _get_timeout(message, state_model_fty)
+            resource_name = fields['RESOURCE_NAME']
+            if not is_batch:
+                task = helixtask.HelixTask(
+                    message, state_model, self._participant,
+                    combiner=self._combiner, process_pool=process_pool,
+                    call_soon=self._scheduler.call_soon)
+                self._scheduler.submit(
+                    resource_name, partition_name, task.call,
+                    priority=priority, timeout=timeout,
+                    on_timeout=task.on_timeout)
+            elif not partition_names:
+                self._accessor.remove(
+                    self._builder.message(self._participant_id, message.id))
+            else:
+                # one task per partition; the last one to finish records
+                # all of them and removes the message
+                batch = helixtask.BatchCompletion(
+                    message, partition_names, self._participant,
+                    combiner=self._combiner)
+                for partition_name, state_model in zip(
+                        partition_names, state_models):
+                    task = helixtask.HelixTask(
+                        message.get_sub_message(partition_name), state_model,
+                        self._participant, batch=batch,
+                        process_pool=process_pool,
+                        call_soon=self._scheduler.call_soon)
+                    self._scheduler.submit(
+                        resource_name, partition_name, task.call,
+                        priority=priority, timeout=timeout,
+                        on_timeout=task.on_timeout)
+
+    def _mark_read(self, message, session_id):
+        """
+        Mark a message READ before its transition is scheduled (private)
+
+        A message that carries the version it was read at is written back in
+        a single request, conditional on that version. If the message changed
+        in the meantime, it is read again and handled from scratch.
+
+        Args:
+            message: The message ZNode
+            session_id: Session the message is executed in
+
+        Returns:
+            True if the message was marked, False if it should be skipped
+        """
+        message_key = self._builder.message(self._participant_id, message.id)
+        version = message.version
+        fields = message.simple_fields
+        fields['MSG_STATE'] = 'READ'
+        fields['READ_TIMESTAMP'] = '{0}'.format(int(time.time() * 1000))
+        fields['EXE_SESSION_ID'] = session_id
+        if version is None:
+            self._accessor.update(message_key, message)
+            return True
+        if self._accessor.set(message_key, message, version=version):
+            return True
+        latest = self._accessor.get(message_key)
+        if latest is None:
+            return False
+        if latest.version == version:
+            # the write failed for another reason than a conflict
+            logging.error('Could not mark message {0} read'.format(
+                message.id))
+            return False
+        self.on_message([latest])
+        return False
+
+    def get_concurrency(self):
+        """
+        Get the number of transitions allowed to run at the same time
+
+        Returns:
+            The concurrency
+        """
+        return self._scheduler.get_concurrency()
+
+    def get_stats(self):
+        """
+        Get scheduling statistics
+
+        Returns:
+            Dictionary of concurrency, running and queued transitions and
+            wait times, as returned by PartitionScheduler.get_stats
+        """
+        return self._scheduler.get_stats()
+
+    def shutdown(self, wait=True):
+        """
+        Stop scheduling transitions
+
+        Args:
+            wait: True to wait until scheduled transitions have run
+        """
+        self._scheduler.shutdown(wait)
+        if self._process_pool:
+            self._process_pool.shutdown(wait)
+        self._combiner.flush()
+
+    def flush(self):
+        """
+        Write current states that are waiting to be combined
+        """
+        self._combiner.flush()
+
+    def _get_state_model(self, state_model_fty, partition_name):
+        """
+        Get the state model of a partition, creating it if needed (private)
+
+        Args:
+            state_model_fty: The state model factory
+            partition_name: The partition
+
+        Returns:
+            StateModel
+        """
+        state_model = state_model_fty.get_state_model(partition_name)
+        if state_model is None:
+            state_model = state_model_fty.create_state_model(partition_name)
+            state_model_fty.put_state_model(partition_name, state_model)
+        return state_model
+
+
+def _get_timeout(message, state_model_fty):
+    """
+    Get the seconds a transition may take (private)
+
+    Args:
+        message: The transition message
+        state_model_fty: Factory of the message's state model
+
+    Returns:
+        The message's TIMEOUT if it has a positive one, the factory's
+        transition_timeout otherwise (None for no limit)
+    """
+    try:
+        timeout = int(message.simple_fields.get('TIMEOUT'))
+    except (TypeError, ValueError):
+        timeout = -1
+    if timeout > 0:
+        return timeout / 1000.0
+    return getattr(state_model_fty, 'transition_timeout', None)
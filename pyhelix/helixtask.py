@@ -1,16 +1,175 @@
+import concurrent.futures as futures
+import cPickle as pickle
+import functools
 import logging
 import threading
+import traceback
 
+import scheduler
 import statemodel
 import znode
 
 
+def _complete(participant, session_id, completions):
+    """
+    Record the outcome of transitions and remove their messages (private)
+
+    All partitions of a resource are written to the current state, their
+    errors recorded, and the messages removed, in one transaction; dropped
+    partitions are removed from the current state in the same write. If
+    the transaction fails, for instance because the parent of the current
+    state or of an error does not exist yet, the writes are made one at a
+    time instead.
+
+    Args:
+        participant: Participant connection
+        session_id: Session the transitions ran in
+        completions: List of (message, map of partition to the state it
+            ended up in, map of partition to the error of its failed
+            transition) triples, all for the same resource
+    """
+    accessor = participant.get_accessor()
+    builder = accessor.get_key_builder()
+    participant_id = participant.get_participant_id()
+    fields = completions[0][0].simple_fields
+    resource_name = fields['RESOURCE_NAME']
+    bucket_size = fields.get('BUCKET_SIZE')
+    current_state = znode.get_empty_znode(resource_name)
+    dropped = znode.get_empty_znode(resource_name)
+    error_nodes = {}
+    for message, results, errors in completions:
+        for partition_name, error in errors.iteritems():
+            error_node = znode.get_empty_znode(partition_name)
+            error_node.simple_fields['ERROR'] = error
+            error_nodes[builder.error(
+                participant_id, session_id, resource_name,
+                partition_name)] = error_node
+        for partition_name, to_state in results.iteritems():
+            if to_state != 'DROPPED':
+                current_state.map_fields[partition_name] = {
+                    'CURRENT_STATE': to_state}
+                dropped.map_fields.pop(partition_name, None)
+            else:
+                dropped.map_fields[partition_name] = {}
+                current_state.map_fields.pop(partition_name, None)
+    current_state_key = builder.current_state(
+        participant_id, session_id, resource_name)
+    if current_state.map_fields:
+        current_state_fields = current_state.simple_fields
+        current_state_fields['STATE_MODEL_DEF'] = fields['STATE_MODEL_DEF']
+        current_state_fields['SESSION_ID'] = session_id
+        if bucket_size:
+            current_state_fields['BUCKET_SIZE'] = bucket_size
+    message_keys = [
+        builder.message(participant_id, message.id)
+        for message, results, errors in completions]
+    if not bucket_size:
+        # bucketized current states span several nodes
+        txn = accessor.transaction()
+        for error_key, error_node in error_nodes.iteritems():
+            txn.update(error_key, error_node)
+        if current_state.map_fields:
+            txn.update(current_state_key, current_state)
+        if dropped.map_fields:
+            txn.update(current_state_key, dropped, sub=True)
+        for message_key in message_keys:
+            txn.remove(message_key)
+        if txn.commit():
+            return
+        logging.info('Recording transitions of {0} one write at a'
+                     ' time'.format(resource_name))
+    for error_key, error_node in error_nodes.iteritems():
+        accessor.update(error_key, error_node)
+    if current_state.map_fields:
+        # update the current state
+        accessor.update(current_state_key, current_state)
+    if dropped.map_fields:
+        # drop the partitions from the current state
+        accessor.update(current_state_key, dropped, sub=True)
+    if len(message_keys) == 1:
+        accessor.remove(message_keys[0])
+        return
+    async_accessor = accessor.get_async_accessor()
+    removals = [
+        async_accessor.remove(message_key) for message_key in message_keys]
+    for removal in removals:
+        removal.result()
+
+
+class RemoteTransitionError(Exception):
+    """
+    A transition callback failed in a worker process
+    """
+    pass
+
+
+class TransitionTimeoutError(Exception):
+    """
+    A transition callback overran its timeout
+    """
+    pass
+
+
+def _get_attributes(state_model):
+    """
+    Get the instance attributes of a state model (private)
+
+    Both the instance dictionary and the slots declared by its classes are
+    read, so that compact state models can run in worker processes too.
+
+    Args:
+        state_model: The state model
+
+    Returns:
+        Map of attribute name to value
+    """
+    attributes = dict(getattr(state_model, '__dict__', {}))
+    for cls in type(state_model).__mro__:
+        slots = cls.__dict__.get('__slots__', ())
+        if isinstance(slots, basestring):
+            slots = (slots,)
+        for name in slots:
+            if name in ('__dict__', '__weakref__'):
+                continue
+            if hasattr(state_model, name):
+                attributes[name] = getattr(state_model, name)
+    return attributes
+
+
+def _transition_in_process(payload):
+    """
+    Run a transition callback in a worker process (private)
+
+    Arguments and results are pickled here and by the participant, because
+    the executor pickles in a background thread, where failures would leave
+    the transition waiting forever. Errors are returned rather than raised,
+    because exceptions may not survive the trip back to the participant.
+
+    Args:
+        payload: Pickled (copy of the partition's state model, previous
+            state, new state, transition message)
+
+    Returns:
+        Pickled (state model attributes, None, None) if successful, or
+        (None, error message, traceback) otherwise
+    """
+    try:
+        state_model, from_state, to_state, message = pickle.loads(payload)
+        method_to_invoke = statemodel.get_transition_handler(
+            state_model, from_state, to_state)
+        method_to_invoke(message)
+        return pickle.dumps((_get_attributes(state_model), None, None), 2)
+    except Exception as e:
+        return pickle.dumps((None, str(e), traceback.format_exc()), 2)
+
+
 class HelixTask(object):
     """
     Helix task for state transitions
     """
 
-    def __init__(self, message, state_model, participant):
+    def __init__(self, message, state_model, participant, batch=None,
+                 combiner=None, process_pool=None, call_soon=None):
         """
         Instantiate this task
 
@@ -18,63 +177,323 @@ class HelixTask(object):
             message: The message to be processed
             state_model: The state model that the participant follows
             participant: Participant connection
+            batch: (Optional) BatchCompletion if the message is one
+                partition of a batch message
+            combiner: (Optional) CurrentStateCombiner to write through
+            process_pool: (Optional) ProcessPoolExecutor to run the
+                transition callback in; the state model must be process-safe
+            call_soon: (Optional) Function that runs a callable on a worker
+                thread, used to finish transitions whose callbacks return a
+                future; without it, call() waits for the future
         """
         self._message = message
         self._state_model = state_model
-        self._state_model_parser = statemodel.StateModelParser()
-        self._accessor = participant.get_accessor()
-        self._builder = self._accessor.get_key_builder()
-        self._participant_id = participant.get_participant_id()
         self._participant = participant
+        self._batch = batch
+        self._combiner = combiner
+        self._process_pool = process_pool
+        self._call_soon = call_soon
+        self._session_id = None
+        self._settled = False
+        self._lock = threading.Lock()
 
     def call(self):
         """
         Process the message.
 
-        Calls application callbacks and then updates the global state.
+        Calls application callbacks and then updates the global state. A
+        callback may return a future (anything with add_done_callback and
+        result) instead of blocking; the global state is then updated once
+        the future is done.
+
+        Returns:
+            None, or a Future that is done once the global state is updated
+            if the callback returned a future
         """
         thread = threading.current_thread()
         logging.info('{0} invokes message: {1}'.format(
             str(thread), self._message))
-        from_state = self._message['simpleFields']['FROM_STATE']
-        to_state = self._message['simpleFields']['TO_STATE']
+        fields = self._message.simple_fields
+        from_state = fields['FROM_STATE']
+        to_state = fields['TO_STATE']
         session_id = self._participant.get_session_id()
-        resource_name = self._message['simpleFields']['RESOURCE_NAME']
-        partition_name = self._message['simpleFields']['PARTITION_NAME']
+        self._session_id = session_id
+        error = None
         try:
-            parser = self._state_model_parser
-            method_to_invoke = parser.get_method_for_transition(
-                self._state_model, from_state, to_state)
-            logging.info('method_to_invoke: {0}'.format(str(method_to_invoke)))
-            method_to_invoke(self._message)
+            if self._process_pool:
+                self._call_in_process(from_state, to_state)
+            else:
+                method_to_invoke = statemodel.get_transition_handler(
+                    self._state_model, from_state, to_state)
+                logging.info(
+                    'method_to_invoke: {0}'.format(str(method_to_invoke)))
+                result = method_to_invoke(self._message)
+                if scheduler.is_future(result):
+                    if self._call_soon:
+                        done = futures.Future()
+                        result.add_done_callback(functools.partial(
+                            self._on_callback_done, session_id, done))
+                        return done
+                    result.result()
         except Exception as e:
+            error = e
+        self._settle(session_id, error)
+
+    def on_timeout(self):
+        """
+        Fail the transition because it overran its timeout
+
+        The partition goes to ERROR and the message is removed, unless the
+        callback finished first; whatever the callback does afterwards is
+        not recorded.
+        """
+        self._settle(self._session_id, TransitionTimeoutError(
+            '{0}-{1} transition timed out'.format(
+                self._message.from_state, self._message.to_state)))
+
+    def _on_callback_done(self, session_id, done, result):
+        """
+        Finish the transition once its callback's future is done (private)
+
+        The future may complete on any thread, such as an application's
+        I/O loop, so the ZooKeeper writes are handed to a worker thread.
+
+        Args:
+            session_id: Session the transition ran in
+            done: Future returned by call()
+            result: Future returned by the callback
+        """
+        def finish():
+            error = None
+            try:
+                result.result()
+            except Exception as e:
+                error = e
+            try:
+                self._settle(session_id, error)
+            except Exception as e:
+                logging.error(traceback.format_exc())
+                done.set_exception(e)
+            else:
+                done.set_result(None)
+        self._call_soon(finish)
+
+    def _settle(self, session_id, error):
+        """
+        Record the outcome of the transition, only once (private)
+
+        Args:
+            session_id: Session the transition ran in
+            error: The exception the callback raised, or None
+        """
+        with self._lock:
+            if self._settled:
+                return
+            self._settled = True
+        fields = self._message.simple_fields
+        to_state = fields['TO_STATE']
+        if error is not None:
             logging.error('{0}-{1} transition failed, {2}'.format(
-                from_state, to_state, e))
+                fields['FROM_STATE'], to_state, error))
             to_state = 'ERROR'
-            error_key = self._builder.error(
-                self._participant_id, session_id, resource_name,
-                partition_name)
-            error_node = znode.get_empty_znode(partition_name)
-            error_node['simpleFields']['ERROR'] = str(e)
-            self._accessor.update(error_key, error_node)
+            error = str(error)
+        self._finish(to_state, session_id, error)
+
+    def _finish(self, to_state, session_id, error=None):
+        """
+        Update the current state and record any error, then remove the
+        message (private)
+
+        Args:
+            to_state: The state the partition ended up in
+            session_id: Session the transition ran in
+            error: (Optional) Error message of a failed transition
+        """
+        partition_name = self._message.simple_fields['PARTITION_NAME']
         self._state_model._current_state = to_state
+        errors = {}
+        if error is not None:
+            errors[partition_name] = error
+        if self._batch:
+            self._batch.complete(partition_name, to_state, session_id, error)
+        elif self._combiner:
+            self._combiner.add(
+                self._message, session_id, {partition_name: to_state},
+                errors)
+        else:
+            _complete(self._participant, session_id,
+                      [(self._message, {partition_name: to_state}, errors)])
 
-        # update current-state, then remove message
-        sub = False
-        current_state = znode.get_empty_znode(resource_name)
-        current_state['mapFields'][partition_name] = {}
-        if to_state != 'DROPPED':
-            # update the current state
-            current_state['mapFields'][partition_name]['CURRENT_STATE'] = (
-                to_state)
-            current_state['simpleFields']['STATE_MODEL_DEF'] = (
-                self._message['simpleFields']['STATE_MODEL_DEF'])
-            current_state['simpleFields']['SESSION_ID'] = session_id
+    def _call_in_process(self, from_state, to_state):
+        """
+        Run the transition callback in the process pool (private)
+
+        Args:
+            from_state: The previous state
+            to_state: The new state
+
+        Raises:
+            RemoteTransitionError: If the callback failed
+        """
+        try:
+            payload = pickle.dumps(
+                (self._state_model, from_state, to_state, self._message), 2)
+        except Exception as e:
+            logging.error(traceback.format_exc())
+            raise RemoteTransitionError(
+                'Cannot send the transition to a worker process: {0}'.format(
+                    e))
+        future = self._process_pool.submit(_transition_in_process, payload)
+        attributes, error, details = pickle.loads(future.result())
+        if error is not None:
+            logging.error(details)
+            raise RemoteTransitionError(error)
+        # the state is recorded here, not by the worker's copy
+        attributes.pop('_current_state', None)
+        with self._lock:
+            if self._settled:
+                # timed out; the model has moved on without this result
+                return
+            state = self._state_model.get_current_state()
+            for name, value in attributes.iteritems():
+                setattr(self._state_model, name, value)
+            # compact state models keep their state in a slot
+            self._state_model._current_state = state
+
+
+class BatchCompletion(object):
+    """
+    Collects the transitions of a batch message
+
+    When the last partition's transition finishes, the current states of
+    all partitions are written together and the batch message is removed.
+    """
+
+    def __init__(self, message, partition_names, participant, combiner=None):
+        """
+        Initialize for the partitions of a batch message
+
+        Args:
+            message: The batch message
+            partition_names: Partitions that will be transitioned
+            participant: Participant connection
+            combiner: (Optional) CurrentStateCombiner to write through
+        """
+        self._message = message
+        self._combiner = combiner
+        self._pending = set(partition_names)
+        self._results = {}
+        self._errors = {}
+        self._participant = participant
+        self._lock = threading.Lock()
+
+    def complete(self, partition_name, to_state, session_id, error=None):
+        """
+        Record the outcome of one partition's transition
+
+        Args:
+            partition_name: The partition
+            to_state: The state the partition ended up in
+            session_id: Session the transition ran in
+            error: (Optional) Error message of a failed transition
+        """
+        with self._lock:
+            self._results[partition_name] = to_state
+            if error is not None:
+                self._errors[partition_name] = error
+            self._pending.discard(partition_name)
+            if self._pending:
+                return
+        if self._combiner:
+            self._combiner.add(
+                self._message, session_id, self._results, self._errors)
         else:
-            # drop the partition from the current state
-            sub = True
-        self._accessor.update(self._builder.current_state(
-            self._participant_id, session_id,
-            resource_name), current_state, sub=sub)
-        self._accessor.remove(self._builder.message(
-            self._participant_id, self._message['id']))
+            _complete(self._participant, session_id,
+                      [(self._message, self._results, self._errors)])
+
+
+class CurrentStateCombiner(object):
+    """
+    Combines the current state writes of transitions that finish together
+
+    Transitions of a resource in one session that finish within a window
+    of each other are written in a single current state update, after
+    which their messages are removed. The writes are made when the window
+    ends or once max_partitions partitions are waiting, whichever is first.
+    """
+
+    DEFAULT_MAX_PARTITIONS = 100
+
+    def __init__(self, participant, window, max_partitions=None):
+        """
+        Initialize the combiner
+
+        Args:
+            participant: Participant connection
+            window: Seconds to wait for more transitions; 0 writes each one
+                as soon as it finishes
+            max_partitions: (Optional) Partitions to combine at most
+        """
+        if max_partitions is None:
+            max_partitions = self.DEFAULT_MAX_PARTITIONS
+        self._participant = participant
+        self._window = window
+        self._max_partitions = max_partitions
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, message, session_id, results, errors=None):
+        """
+        Queue the outcome of a message's transitions for writing
+
+        Args:
+            message: The message that was processed
+            session_id: Session the transitions ran in
+            results: Map of partition to the state it ended up in
+            errors: (Optional) Map of partition to the error message of its
+                failed transition
+        """
+        if errors is None:
+            errors = {}
+        if self._window <= 0:
+            _complete(
+                self._participant, session_id, [(message, results, errors)])
+            return
+        group_key = (session_id, message.simple_fields['RESOURCE_NAME'])
+        with self._lock:
+            group = self._pending.get(group_key)
+            if group is None:
+                timer = threading.Timer(
+                    self._window, self._flush, (group_key,))
+                timer.daemon = True
+                group = self._pending[group_key] = [[], 0, timer]
+                timer.start()
+            group[0].append((message, results, errors))
+            group[1] += len(results)
+            full = group[1] >= self._max_partitions
+        if full:
+            self._flush(group_key)
+
+    def flush(self):
+        """
+        Write everything that is waiting, without waiting for the window
+        """
+        with self._lock:
+            group_keys = self._pending.keys()
+        for group_key in group_keys:
+            self._flush(group_key)
+
+    def _flush(self, group_key):
+        """
+        Write the transitions waiting for a resource and session (private)
+
+        Args:
+            group_key: (session id, resource) pair
+        """
+        with self._lock:
+            group = self._pending.pop(group_key, None)
+        if group is None:
+            return
+        completions, num_partitions, timer = group
+        timer.cancel()
+        _complete(self._participant, group_key[0], completions)
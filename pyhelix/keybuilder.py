@@ -1,25 +1,318 @@
+import collections
+import inspect
+import threading
+
+# Placeholders used to turn KeyBuilder functions into path templates
+_CLUSTER_SENTINEL = '\x00cluster\x00'
+_PARAM_SENTINEL = '\x00{0}\x00'
+
+
+class PropertyKey(object):
+    """
+    Immutable location and access flags of a Helix property
+
+    Fields can also be read like dictionary items, e.g. key.path.
+    """
+
+    __slots__ = ('path', 'type', 'ephemeral', 'sequential', 'merge_on_update',
+                 'update_only_on_exists', 'cacheable', 'bucketized')
+
+    def __init__(self, path, type, ephemeral=False, sequential=False,
+                 merge_on_update=False, update_only_on_exists=False,
+                 cacheable=False, bucketized=False):
+        """
+        Initialize a property key
+
+        Args:
+            path: ZooKeeper path of the property
+            type: Property type, the name of the KeyBuilder function
+            ephemeral: True if the ZNode goes away with the session
+            sequential: True if ZooKeeper appends a sequence number
+            merge_on_update: True if updates merge into the stored record
+            update_only_on_exists: True if updates must not create the ZNode
+            cacheable: True if the property rarely changes
+            bucketized: True if the record can be split into buckets
+        """
+        set_field = super(PropertyKey, self).__setattr__
+        set_field('path', path)
+        set_field('type', type)
+        set_field('ephemeral', ephemeral)
+        set_field('sequential', sequential)
+        set_field('merge_on_update', merge_on_update)
+        set_field('update_only_on_exists', update_only_on_exists)
+        set_field('cacheable', cacheable)
+        set_field('bucketized', bucketized)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('PropertyKey is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('PropertyKey is immutable')
+
+    def __getitem__(self, name):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __contains__(self, name):
+        return name in self.__slots__
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def _fields(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        if not isinstance(other, PropertyKey):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self._fields())
+
+    def __reduce__(self):
+        return (PropertyKey, self._fields())
+
+    def __repr__(self):
+        return 'PropertyKey({0!r}, {1!r})'.format(self.type, self.path)
+
+
 def propertykey(ephemeral=False, sequential=False, merge_on_update=False,
-                update_only_on_exists=False):
+                update_only_on_exists=False, cacheable=False,
+                bucketized=False):
     def decorator(func):
-        def hidden_func(*args, **kwargs):
-            prop = {'ephemeral': ephemeral,
-                    'sequential': sequential,
-                    'merge_on_update': merge_on_update,
-                    'update_only_on_exists': update_only_on_exists}
-            prop['path'] = func(*args, **kwargs)
-            return prop
+        name = func.__name__
+
+        def hidden_func(self, *args, **kwargs):
+            cache_key = args
+            if kwargs:
+                cache_key += tuple(sorted(kwargs.iteritems()))
+            keys = self._keys[name]
+            key = keys.get(cache_key)
+            if key is None:
+                key = PropertyKey(
+                    func(self, *args, **kwargs), name, ephemeral=ephemeral,
+                    sequential=sequential, merge_on_update=merge_on_update,
+                    update_only_on_exists=update_only_on_exists,
+                    cacheable=cacheable, bucketized=bucketized)
+                with self._keys_lock:
+                    if len(keys) >= self._max_keys:
+                        keys.popitem(last=False)
+                    keys[cache_key] = key
+            return key
+        hidden_func.__name__ = name
+        hidden_func.__doc__ = func.__doc__
+        hidden_func.path_template = func
+        hidden_func.property_flags = {
+            'ephemeral': ephemeral,
+            'sequential': sequential,
+            'merge_on_update': merge_on_update,
+            'update_only_on_exists': update_only_on_exists,
+            'cacheable': cacheable,
+            'bucketized': bucketized}
         return hidden_func
     return decorator
 
 
+class _PathNode(object):
+    """
+    Node of the reverse path index (private)
+    """
+
+    __slots__ = ('literals', 'param', 'leaf')
+
+    def __init__(self):
+        self.literals = {}
+        self.param = None
+        self.leaf = None
+
+    def add(self, segments, leaf):
+        """
+        Add a path template below this node
+
+        Args:
+            segments: Path segments; parameters are sentinel strings
+            leaf: (type, parameter names, flags) for the template
+
+        Returns:
+            The node for the full template
+        """
+        node = self
+        for segment in segments:
+            if (segment.startswith('\x00') and
+                    segment != _CLUSTER_SENTINEL):
+                if node.param is None:
+                    node.param = _PathNode()
+                node = node.param
+            else:
+                if '\x00' in segment and segment != _CLUSTER_SENTINEL:
+                    raise ValueError(
+                        'Unsupported path segment {0!r}'.format(segment))
+                node = node.literals.setdefault(segment, _PathNode())
+        if node.leaf is None:
+            node.leaf = leaf
+        return node
+
+    def match(self, segments, index, cluster_id, values):
+        """
+        Find the template matching a path, collecting parameter values
+
+        Literal segments are preferred over parameters.
+
+        Args:
+            segments: Path segments after the cluster
+            index: Segment to match at this node
+            cluster_id: The cluster, which may appear inside paths
+            values: Parameter values so far, extended in place
+
+        Returns:
+            (type, parameter names, flags), or None if nothing matches
+        """
+        if index == len(segments):
+            return self.leaf
+        segment = segments[index]
+        children = [self.literals.get(segment)]
+        if segment == cluster_id:
+            children.append(self.literals.get(_CLUSTER_SENTINEL))
+        for child in children:
+            if child is not None:
+                leaf = child.match(segments, index + 1, cluster_id, values)
+                if leaf is not None:
+                    return leaf
+        if self.param is not None and segment:
+            values.append(segment)
+            leaf = self.param.match(segments, index + 1, cluster_id, values)
+            if leaf is not None:
+                return leaf
+            values.pop()
+        return None
+
+
+_path_index = None
+_path_index_lock = threading.Lock()
+
+
+def _get_path_index():
+    """
+    Get the reverse path index, building it on first use (private)
+
+    Every KeyBuilder function is called with placeholder arguments, once for
+    each number of optional arguments, and the resulting paths are added to
+    a trie. Bucketized properties also get a template for their buckets.
+
+    Returns:
+        The root _PathNode, which matches the segment after the cluster
+    """
+    global _path_index
+    with _path_index_lock:
+        if _path_index is not None:
+            return _path_index
+        root = _PathNode()
+        builder = KeyBuilder(_CLUSTER_SENTINEL)
+        for name, func in sorted(vars(KeyBuilder).iteritems()):
+            template = getattr(func, 'path_template', None)
+            if template is None:
+                continue
+            argspec = inspect.getargspec(template)
+            arg_names = argspec.args[1:]
+            num_optional = len(argspec.defaults or ())
+            for count in range(len(arg_names) - num_optional,
+                               len(arg_names) + 1):
+                path = template(builder, *[
+                    _PARAM_SENTINEL.format(arg) for arg in arg_names[:count]])
+
+                # parameters in the order they appear; some are not used
+                param_names = tuple(sorted(
+                    (arg for arg in arg_names[:count]
+                     if _PARAM_SENTINEL.format(arg) in path),
+                    key=lambda arg: path.index(_PARAM_SENTINEL.format(arg))))
+                flags = func.property_flags
+                node = root.add(
+                    path.split('/')[2:], (name, param_names, flags))
+                if flags['bucketized']:
+                    bucket_flags = dict(
+                        flags, cacheable=False, bucketized=False)
+                    node.add([_PARAM_SENTINEL.format('bucket_name')], (
+                        name, param_names + ('bucket_name',), bucket_flags))
+        _path_index = root
+        return root
+
+
 class KeyBuilder(object):
     """
     A collection of functions to get ZooKeeper metadata
+
+    Keys are immutable and reused: each function remembers the keys it
+    built most recently, up to max_keys per function.
     """
-    def __init__(self, cluster_id):
+
+    DEFAULT_MAX_KEYS = 1024
+
+    def __init__(self, cluster_id, max_keys=None):
+        """
+        Initialize a key builder for a cluster
+
+        Args:
+            cluster_id: The cluster
+            max_keys: (Optional) Keys to remember per function, at least 1
+        """
         self._cluster_id = cluster_id
+        if max_keys is None:
+            max_keys = self.DEFAULT_MAX_KEYS
+        self._max_keys = max_keys
+        self._keys = collections.defaultdict(collections.OrderedDict)
+        self._keys_lock = threading.Lock()
 
-    @propertykey()
+    def bucket(self, key, bucket_name):
+        """
+        Get the property holding one bucket of a bucketized property
+
+        Args:
+            key: The bucketized KeyBuilder property
+            bucket_name: The bucket
+
+        Returns:
+            KeyBuilder property for the bucket
+        """
+        return PropertyKey(
+            '{0}/{1}'.format(key.path, bucket_name), key.type,
+            ephemeral=key.ephemeral, sequential=key.sequential,
+            merge_on_update=key.merge_on_update,
+            update_only_on_exists=key.update_only_on_exists)
+
+    def resolve(self, path):
+        """
+        Find the property that a path belongs to
+
+        Paths of buckets resolve to the bucketized property, with the bucket
+        in the bucket_name parameter.
+
+        Args:
+            path: ZooKeeper path in this cluster
+
+        Returns:
+            (type, map of parameter to value, PropertyKey) tuple, or None if
+            the path is not a known property
+        """
+        segments = path.strip('/').split('/')
+        if segments[0] != self._cluster_id:
+            return None
+        values = []
+        leaf = _get_path_index().match(segments, 1, self._cluster_id, values)
+        if leaf is None:
+            return None
+        property_type, param_names, flags = leaf
+        return (property_type, dict(zip(param_names, values)),
+                PropertyKey('/' + '/'.join(segments), property_type, **flags))
+
+    @propertykey(cacheable=True)
     def cluster_config(self):
         return '/{0}/CONFIGS/CLUSTER/{0}'.format(self._cluster_id)
 
@@ -27,7 +320,7 @@ class KeyBuilder(object):
     def external_views(self):
         return '/{0}/EXTERNALVIEW'.format(self._cluster_id)
 
-    @propertykey()
+    @propertykey(bucketized=True)
     def external_view(self, resource_id):
         return '/{0}/EXTERNALVIEW/{1}'.format(self._cluster_id, resource_id)
 
@@ -35,7 +328,7 @@ class KeyBuilder(object):
     def ideal_states(self, resource_id):
         return '/{0}/IDEALSTATES'.format(self._cluster_id)
 
-    @propertykey()
+    @propertykey(cacheable=True, bucketized=True)
     def ideal_state(self, resource_id):
         return '/{0}/IDEALSTATES/{1}'.format(self._cluster_id, resource_id)
 
@@ -43,7 +336,7 @@ class KeyBuilder(object):
     def participant_configs(self):
         return '/{0}/CONFIGS/PARTICIPANT'.format(self._cluster_id)
 
-    @propertykey()
+    @propertykey(cacheable=True)
     def participant_config(self, participant_id):
         return '/{0}/CONFIGS/PARTICIPANT/{1}'.format(
             self._cluster_id, participant_id)
@@ -69,7 +362,7 @@ class KeyBuilder(object):
             path += '/{0}'.format(session_id)
         return path
 
-    @propertykey(merge_on_update=True)
+    @propertykey(merge_on_update=True, bucketized=True)
     def current_state(self, participant_id, session_id, resource_id):
         return '/{0}/INSTANCES/{1}/CURRENTSTATES/{2}/{3}'.format(
             self._cluster_id, participant_id, session_id, resource_id)
@@ -99,7 +392,7 @@ class KeyBuilder(object):
     def state_models(self):
         return '/{0}/STATEMODELDEFS'.format(self._cluster_id)
 
-    @propertykey()
+    @propertykey(cacheable=True)
     def state_model(self, resource_id):
         return '/{0}/STATEMODELDEFS/{1}'.format(self._cluster_id, resource_id)
 
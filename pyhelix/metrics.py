@@ -0,0 +1,156 @@
+import bisect
+import json
+import threading
+
+
+class Histogram(object):
+    """
+    Latency histogram with fixed bucket boundaries
+    """
+
+    # Upper bounds of the buckets, in milliseconds
+    BOUNDS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self):
+        """
+        Initialize an empty histogram
+        """
+        self._counts = [0] * (len(self.BOUNDS) + 1)
+        self._count = 0
+        self._total = 0.0
+        self._min = None
+        self._max = None
+
+    def add(self, value):
+        """
+        Record a value
+
+        Args:
+            value: The value, in milliseconds
+        """
+        self._counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self._count += 1
+        self._total += value
+        if self._min is None or value < self._min:
+            self._min = value
+        if self._max is None or value > self._max:
+            self._max = value
+
+    def get_snapshot(self):
+        """
+        Get the recorded distribution
+
+        Returns:
+            Dictionary of count, total, min, max and buckets, a map of bucket
+            upper bound (or "inf") to count
+        """
+        buckets = {}
+        for bound, count in zip(self.BOUNDS + ('inf',), self._counts):
+            if count:
+                buckets[str(bound)] = count
+        return {'count': self._count, 'total': self._total,
+                'min': self._min, 'max': self._max, 'buckets': buckets}
+
+
+class MetricsRegistry(object):
+    """
+    Collects accessor metrics, grouped by property type
+
+    Property types are the names of the KeyBuilder functions that build the
+    properties, like "current_state" or "message".
+    """
+    def __init__(self):
+        """
+        Initialize an empty registry
+        """
+        self._lock = threading.Lock()
+        self._types = {}
+
+    def record_latency(self, property_type, operation, seconds):
+        """
+        Record how long an operation took
+
+        Args:
+            property_type: The property type
+            operation: The accessor operation, like "get" or "update"
+            seconds: The duration
+        """
+        with self._lock:
+            histograms = self._get_type(property_type)['latency']
+            if operation not in histograms:
+                histograms[operation] = Histogram()
+            histograms[operation].add(seconds * 1000)
+
+    def record_bytes(self, property_type, direction, num_bytes):
+        """
+        Record data passing through the codec
+
+        Args:
+            property_type: The property type
+            direction: "serialized" or "deserialized"
+            num_bytes: Size of the serialized data
+        """
+        with self._lock:
+            self._get_type(property_type)['bytes_' + direction] += num_bytes
+
+    def record_retry(self, property_type):
+        """
+        Record a retried compare-and-set write
+
+        Args:
+            property_type: The property type
+        """
+        with self._lock:
+            self._get_type(property_type)['cas_retries'] += 1
+
+    def get_snapshot(self):
+        """
+        Get all metrics recorded so far
+
+        Returns:
+            Map of property type to a dictionary with bytes_serialized,
+            bytes_deserialized, cas_retries and latency, a map of operation
+            to histogram (in milliseconds)
+        """
+        with self._lock:
+            snapshot = {}
+            for property_type, metrics in self._types.iteritems():
+                snapshot[property_type] = dict(metrics)
+                snapshot[property_type]['latency'] = dict(
+                    (operation, histogram.get_snapshot())
+                    for operation, histogram
+                    in metrics['latency'].iteritems())
+            return snapshot
+
+    def dump(self):
+        """
+        Get all metrics recorded so far as JSON
+
+        Returns:
+            JSON string of get_snapshot()
+        """
+        return json.dumps(self.get_snapshot(), indent=2, sort_keys=True)
+
+    def reset(self):
+        """
+        Discard all metrics recorded so far
+        """
+        with self._lock:
+            self._types = {}
+
+    def _get_type(self, property_type):
+        """
+        Get the metrics of a property type, creating them if needed (private)
+
+        Args:
+            property_type: The property type
+
+        Returns:
+            Dictionary of metrics
+        """
+        metrics = self._types.get(property_type)
+        if metrics is None:
+            metrics = {'bytes_serialized': 0, 'bytes_deserialized': 0,
+                       'cas_retries': 0, 'latency': {}}
+            self._types[property_type] = metrics
+        return metrics
@@ -3,8 +3,10 @@ import logging
 import os
 
 import accessor
+import connection
 import constants
 import helixexec
+import statemodel
 import znode
 
 
@@ -15,7 +17,11 @@ class Participant(object):
     This class encompasses all of a Helix participant's interactions with
     ZooKeeper.
     """
-    def __init__(self, cluster_id, host, port, zk_addrs, participant_id=None):
+    def __init__(self, cluster_id, host, port, zk_addrs, participant_id=None,
+                 cache_size=0, metrics=None, shared_session=False,
+                 current_state_window=0, scheduling_policy=None,
+                 num_concurrent=None, max_concurrent=None,
+                 process_pool_size=None):
         """
         Initialize the connection parameters.
 
@@ -25,6 +31,25 @@ class Participant(object):
             port: Logical port of this participant
             zk_addrs: Comma separated host:port of ZooKeeper servers
             participant_id: (Optional) Custom ID, "host_port" by default
+            cache_size: (Optional) Number of rarely-changing properties, like
+                the cluster config, to cache; 0 (default) disables caching
+            metrics: (Optional) MetricsRegistry for ZooKeeper access metrics
+            shared_session: (Optional) True to share one ZooKeeper session
+                with other participants and spectators of the same ensemble
+                in this process
+            current_state_window: (Optional) Seconds to combine current
+                state writes of transitions that finish together; 0
+                (default) writes each one as soon as it finishes
+            scheduling_policy: (Optional) SchedulingPolicy with transition
+                priorities and per-resource concurrency caps
+            num_concurrent: (Optional) Transitions to run at the same time
+                (initially, if max_concurrent is set); 20 by default
+            max_concurrent: (Optional) Upper bound for adapting concurrency
+                to queue wait times and transition latency; not adaptive by
+                default
+            process_pool_size: (Optional) Worker processes to run the
+                transitions of process-safe state models in (see
+                StateModelFactory); none by default
         """
         self._host = host
         self._port = port
@@ -32,13 +57,24 @@ class Participant(object):
             self._participant_id = participant_id
         else:
             self._participant_id = '{0}_{1}'.format(host, port)
-        self._client = kazoo.client.KazooClient(zk_addrs)
+        if shared_session:
+            self._client = connection.get_session_manager().acquire(zk_addrs)
+        else:
+            self._client = kazoo.client.KazooClient(zk_addrs)
         self._client.add_listener(self._connection_listener)
-        self._accessor = accessor.DataAccessor(cluster_id, self._client)
+        self._accessor = accessor.DataAccessor(
+            cluster_id, self._client, cache_size=cache_size, metrics=metrics)
         self._builder = self._accessor.get_key_builder()
         self._callbacks = set()
+        self._seen_messages = set()
+        self._seen_messages_lock = self._client.handler.lock_object()
         self._state_model_ftys = {}
-        self._executor = helixexec.HelixExecutor(self._state_model_ftys, self)
+        self._executor = helixexec.HelixExecutor(
+            self._state_model_ftys, self,
+            current_state_window=current_state_window,
+            policy=scheduling_policy, num_concurrent=num_concurrent,
+            max_concurrent=max_concurrent,
+            process_pool_size=process_pool_size)
         self._pre_connect_callbacks = set()
         self._is_lost = False
 
@@ -56,6 +92,7 @@ class Participant(object):
         End an active connection.
         """
         self._is_lost = True
+        self._executor.flush()
         self._accessor.remove(
             self._builder.live_instance(self._participant_id))
         self._client.stop()
@@ -119,6 +156,8 @@ class Participant(object):
             state_model_fty: A factory of callbacks for state transitions
         """
         self._state_model_ftys[state_model_name] = state_model_fty
+        if self.is_connected():
+            self._validate_state_model_fty(state_model_name, state_model_fty)
 
     def unregister_state_model_fty(self, state_model_name):
         """
@@ -133,6 +172,45 @@ class Participant(object):
         removed = self._state_model_ftys.pop(state_model_name)
         removed.reset()
 
+    def _validate_state_model_fty(self, state_model_name, state_model_fty):
+        """
+        Report callbacks that do not match the state model definition
+        (private)
+
+        Transitions of the definition without a callback go to the default
+        transition handler; callbacks for transitions the definition does
+        not have are never called. Nothing is checked for factories without
+        a state_model_class.
+
+        Args:
+            state_model_name: The name of the state model definition
+            state_model_fty: The registered factory
+
+        Returns:
+            True if the callbacks match the definition, False otherwise
+        """
+        state_model_class = getattr(state_model_fty, 'state_model_class', None)
+        if state_model_class is None:
+            return True
+        state_model_def = self._accessor.get(
+            self._builder.state_model(state_model_name))
+        if state_model_def is None:
+            logging.warn('State model {0} is not defined in the'
+                         ' cluster'.format(state_model_name))
+            return False
+        missing, illegal = statemodel.validate_transitions(
+            state_model_class, state_model_def)
+        for transition in missing:
+            logging.warn('{0} has no callback for {1}, using the default'
+                         ' transition handler'.format(
+                             state_model_class.__name__, transition))
+        for transition in illegal:
+            logging.error('{0} has a callback for {1}, which is not a'
+                          ' transition of {2}'.format(
+                              state_model_class.__name__, transition,
+                              state_model_name))
+        return not missing and not illegal
+
     def _register_message_callback(self, callback):
         """
         Register a callback for messages to this participant (private)
@@ -144,7 +222,11 @@ class Participant(object):
 
     def _ensure_participant_config(self):
         """
-        Ensure that ZNodes for a participant all exist, non-atomic (private)
+        Ensure that ZNodes for a participant all exist (private)
+
+        All nodes are created in a single transaction. If that fails (for
+        instance, because a previous bootstrap left some of them behind), the
+        missing nodes are created one at a time instead.
 
         Returns:
             True if everything was persisted, False otherwise
@@ -153,23 +235,27 @@ class Participant(object):
             self._builder.participant_config(self._participant_id))
         if not exists and self._auto_join_allowed():
             node = znode.get_empty_znode(self._participant_id)
-            node['simpleFields'] = {
+            node.simple_fields = {
                 'HELIX_HOST': self._host, 'HELIX_PORT': str(self._port),
                 'HELIX_ENABLED': 'true'}
-            self._accessor.create(
-                self._builder.participant_config(self._participant_id), node)
-            self._accessor.create(
-                self._builder.instance(self._participant_id), b'')
-            self._accessor.create(
-                self._builder.current_states(self._participant_id), b'')
-            self._accessor.create(
-                self._builder.errors(self._participant_id), b'')
-            self._accessor.create(
-                self._builder.health_report(self._participant_id), b'')
-            self._accessor.create(
-                self._builder.messages(self._participant_id), b'')
-            self._accessor.create(
-                self._builder.status_updates(self._participant_id), b'')
+            nodes = [
+                (self._builder.participant_config(self._participant_id),
+                 node),
+                (self._builder.instance(self._participant_id), b''),
+                (self._builder.current_states(self._participant_id), b''),
+                (self._builder.errors(self._participant_id), b''),
+                (self._builder.health_report(self._participant_id), b''),
+                (self._builder.messages(self._participant_id), b''),
+                (self._builder.status_updates(self._participant_id), b'')]
+            txn = self._accessor.transaction()
+            for key, data in nodes:
+                txn.create(key, data)
+            if not txn.commit():
+                logging.warn(
+                    'Could not bootstrap {0} atomically, retrying'
+                    ' non-atomically'.format(self._participant_id))
+                for key, data in nodes:
+                    self._accessor.create(key, data)
         elif not exists:
             return False
         return True
@@ -182,12 +268,11 @@ class Participant(object):
             True if auto join allowed, False otherwise
         """
         clst_config = self._accessor.get(self._builder.cluster_config())
-        if clst_config:
-            if 'allowParticipantAutoJoin' in clst_config['simpleFields']:
-                auto_join = (
-                    clst_config['simpleFields']['allowParticipantAutoJoin'])
-                if auto_join == 'true':
-                    return True
+        if isinstance(clst_config, znode.ZNRecord):
+            auto_join = clst_config.simple_fields.get(
+                'allowParticipantAutoJoin')
+            if auto_join == 'true':
+                return True
         return False
 
     def _create_live_instance_node(self):
@@ -198,7 +283,7 @@ class Participant(object):
             True if created, False otherwise
         """
         node = znode.get_empty_znode(self._participant_id)
-        node['simpleFields'] = {
+        node.simple_fields = {
             'HELIX_VERSION': 'pyhelix-{0}'.format(constants.CURRENT_VERSION),
             'SESSION_ID': str(self._client.client_id[0]),
             'LIVE_INSTANCE': '{0}@{1}'.format(os.getpid(), self._host)}
@@ -209,19 +294,46 @@ class Participant(object):
         """
         Dispatcher for message callbacks (private)
 
+        Only messages that were not seen before are read, once for all
+        callbacks. Messages that could not be read or dispatched are tried
+        again on the next change.
+
         Args:
             List of message ids as strings
 
         Returns:
             Always True
         """
-        logging.info('handler called: {0}'.format(messages))
-        for cb in self._callbacks:
-            message_nodes = []
-            for message_id in messages:
-                message_nodes.append(self._accessor.get(
-                    self._builder.message(self._participant_id, message_id)))
-            cb(message_nodes)
+        with self._seen_messages_lock:
+            # forget messages that were removed
+            self._seen_messages.intersection_update(messages)
+            new_messages = [
+                message_id for message_id in messages
+                if message_id not in self._seen_messages]
+            self._seen_messages.update(new_messages)
+        logging.info('handler called: {0} new of {1}'.format(
+            new_messages, len(messages)))
+        if not new_messages:
+            return True
+        message_nodes = self._accessor.get_async_accessor().get_many([
+            self._builder.message(self._participant_id, message_id)
+            for message_id in new_messages])
+        unread = [
+            message_id for message_id, message_node
+            in zip(new_messages, message_nodes) if message_node is None]
+        if unread:
+            with self._seen_messages_lock:
+                self._seen_messages.difference_update(unread)
+        message_nodes = [
+            message_node for message_node in message_nodes if message_node]
+        try:
+            for cb in self._callbacks:
+                cb(message_nodes)
+        except Exception:
+            # deliver the whole batch again on the next change
+            with self._seen_messages_lock:
+                self._seen_messages.difference_update(new_messages)
+            raise
         return True
 
     def _connection_listener(self, state):
@@ -242,6 +354,8 @@ class Participant(object):
         """
         Internal cleanup (private)
         """
+        with self._seen_messages_lock:
+            self._seen_messages.clear()
         for smf in self._state_model_ftys.itervalues():
             smf.reset()
 
@@ -256,6 +370,11 @@ class Participant(object):
             self.disconnect()
             return
 
+        # Check the callbacks against the cluster's state models
+        for state_model_name, state_model_fty in (
+                self._state_model_ftys.items()):
+            self._validate_state_model_fty(state_model_name, state_model_fty)
+
         # Get ready to receive cluster messages
         self._register_message_callback(self._executor.on_message)
         self._accessor.watch_children(self._builder.messages(
@@ -0,0 +1,103 @@
+import collections
+import threading
+
+
+class PropertyCache(object):
+    """
+    Bounded LRU cache of raw property data, keyed by path
+    """
+    def __init__(self, max_size):
+        """
+        Initialize an empty cache
+
+        Args:
+            max_size: Maximum number of properties to hold
+        """
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._epoch = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, path):
+        """
+        Look up a property, marking it as recently used
+
+        Args:
+            path: The property path
+
+        Returns:
+            (raw data, version) tuple, or None if not cached
+        """
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries[path] = entry
+            self._hits += 1
+            return entry
+
+    def get_epoch(self):
+        """
+        Get a token to pass to put() before reading a property from ZooKeeper
+
+        Returns:
+            Opaque token that changes whenever a property is invalidated
+        """
+        with self._lock:
+            return self._epoch
+
+    def put(self, path, value, version, epoch):
+        """
+        Store a property, evicting the least recently used if full
+
+        The property is not stored if anything was invalidated since epoch
+        was taken, because the read may have raced with a change.
+
+        Args:
+            path: The property path
+            value: The raw data
+            version: The ZNode version of the data
+            epoch: Token from get_epoch() taken before the read
+        """
+        with self._lock:
+            if epoch != self._epoch:
+                return
+            self._entries.pop(path, None)
+            self._entries[path] = (value, version)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, path):
+        """
+        Drop a property from the cache
+
+        Args:
+            path: The property path
+        """
+        with self._lock:
+            self._epoch += 1
+            self._entries.pop(path, None)
+
+    def clear(self):
+        """
+        Drop all properties from the cache
+        """
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+    def get_stats(self):
+        """
+        Get cache effectiveness counters
+
+        Returns:
+            Dictionary of hits, misses, evictions and current size
+        """
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses,
+                    'evictions': self._evictions, 'size': len(self._entries)}
@@ -0,0 +1,731 @@
+import collections
+import concurrent.futures as futures
+import functools
+import heapq
+import itertools
+import logging
+import threading
+import time
+import traceback
+
+import metrics
+
+
+class SchedulingPolicy(object):
+    """
+    Priorities and concurrency caps for scheduling transitions
+
+    Priorities are looked up by state model and transition, written as
+    "FROM-TO" (e.g. "ERROR-OFFLINE"); None in either position matches any.
+    The most specific match wins, and unmatched transitions get priority 0.
+    Higher priorities run first.
+    """
+
+    def __init__(self, priorities=None, resource_caps=None,
+                 default_resource_cap=None):
+        """
+        Initialize the policy
+
+        Args:
+            priorities: (Optional) Map of (state model, transition) to
+                priority
+            resource_caps: (Optional) Map of resource to the number of its
+                transitions that may run at the same time
+            default_resource_cap: (Optional) Cap for resources that are not
+                in resource_caps; None (default) for no cap
+        """
+        self._priorities = dict(priorities or {})
+        self._resource_caps = dict(resource_caps or {})
+        self._default_resource_cap = default_resource_cap
+
+    def get_priority(self, state_model_def, from_state, to_state):
+        """
+        Get the priority of a transition
+
+        Args:
+            state_model_def: The state model
+            from_state: Source state
+            to_state: Target state
+
+        Returns:
+            The priority
+        """
+        transition = '{0}-{1}'.format(from_state, to_state).upper()
+        for lookup in ((state_model_def, transition), (None, transition),
+                       (state_model_def, None)):
+            if lookup in self._priorities:
+                return self._priorities[lookup]
+        return 0
+
+    def get_resource_cap(self, resource_name):
+        """
+        Get the number of transitions of a resource that may run at once
+
+        Args:
+            resource_name: The resource
+
+        Returns:
+            The cap, or None for no cap
+        """
+        return self._resource_caps.get(
+            resource_name, self._default_resource_cap)
+
+
+class AdaptiveConcurrency(object):
+    """
+    Grows or shrinks the number of concurrent tasks within bounds
+
+    Adjustments are made at most once per interval, from the tasks that
+    started and finished since the last one. When tasks waited longer to
+    start than they took to run, and some are still waiting, concurrency
+    grows by a quarter (at least one). When fewer tasks ran at once than
+    allowed, it shrinks by one.
+    """
+
+    DEFAULT_INTERVAL = 5.0
+
+    def __init__(self, min_concurrent, max_concurrent, interval=None):
+        """
+        Initialize the bounds
+
+        Args:
+            min_concurrent: Fewest tasks to allow at the same time
+            max_concurrent: Most tasks to allow at the same time
+            interval: (Optional) Seconds between adjustments
+        """
+        if interval is None:
+            interval = self.DEFAULT_INTERVAL
+        self.min_concurrent = min_concurrent
+        self.max_concurrent = max_concurrent
+        self._interval = interval
+        self._reset(time.time())
+
+    def record_wait(self, seconds):
+        """
+        Record how long a task waited to start
+
+        Args:
+            seconds: The wait
+        """
+        self._waits += 1
+        self._wait_time += seconds
+
+    def record_run(self, seconds, running):
+        """
+        Record how long a task ran
+
+        Args:
+            seconds: The duration
+            running: Tasks running when it finished, including itself
+        """
+        self._runs += 1
+        self._run_time += seconds
+        self._peak_running = max(self._peak_running, running)
+
+    def adjust(self, concurrency, queued):
+        """
+        Get the concurrency to use from now on
+
+        Args:
+            concurrency: The current concurrency
+            queued: Tasks waiting to start
+
+        Returns:
+            The new concurrency
+        """
+        now = time.time()
+        if now - self._start < self._interval or not self._runs:
+            return concurrency
+        mean_wait = self._wait_time / max(self._waits, 1)
+        mean_run = self._run_time / self._runs
+        if queued and mean_wait > mean_run:
+            concurrency += max(1, concurrency // 4)
+        elif self._peak_running < concurrency:
+            concurrency -= 1
+        self._reset(now)
+        return max(self.min_concurrent, min(self.max_concurrent, concurrency))
+
+    def _reset(self, now):
+        """
+        Start a new measurement interval (private)
+
+        Args:
+            now: The current time
+        """
+        self._start = now
+        self._waits = 0
+        self._wait_time = 0.0
+        self._runs = 0
+        self._run_time = 0.0
+        self._peak_running = 0
+
+
+class CancellationToken(object):
+    """
+    Tells a task that it should stop
+
+    Tasks that run long can check is_cancelled() now and then, or register
+    a callback, and give up once their deadline has passed.
+    """
+
+    def __init__(self):
+        """
+        Initialize a token that is not cancelled
+        """
+        self._cancelled = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def is_cancelled(self):
+        """
+        Check if the task should stop
+
+        Returns:
+            True if cancelled, False otherwise
+        """
+        return self._cancelled
+
+    def add_callback(self, callback):
+        """
+        Call a function when the token is cancelled
+
+        Args:
+            callback: Callable without arguments; called right away if the
+                token is already cancelled
+        """
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        """
+        Cancel the token, calling its callbacks
+        """
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logging.error(traceback.format_exc())
+
+
+_local = threading.local()
+
+
+def current_cancellation_token():
+    """
+    Get the cancellation token of the task running on this thread
+
+    Returns:
+        CancellationToken, or None outside of a scheduled task
+    """
+    return getattr(_local, 'token', None)
+
+
+class DeadlineTimer(object):
+    """
+    Calls functions when their deadlines pass, all from one thread
+
+    The thread is started with the first deadline and stops on shutdown().
+    """
+
+    def __init__(self):
+        """
+        Initialize a timer without deadlines
+        """
+        self._deadlines = []
+        self._sequence = itertools.count()
+        self._thread = None
+        self._is_shutdown = False
+        self._condition = threading.Condition(threading.Lock())
+
+    def add(self, timeout, callback):
+        """
+        Call a function after a timeout, unless cancelled first
+
+        Args:
+            timeout: Seconds to wait
+            callback: Callable without arguments
+
+        Returns:
+            Handle to pass to cancel()
+        """
+        entry = [time.time() + timeout, next(self._sequence), callback]
+        with self._condition:
+            if self._is_shutdown:
+                raise RuntimeError('Cannot add deadlines after shutdown')
+            heapq.heappush(self._deadlines, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._wait)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return entry
+
+    def cancel(self, entry):
+        """
+        Stop a deadline from firing
+
+        Args:
+            entry: Handle returned by add()
+        """
+        with self._condition:
+            # dropped lazily when it reaches the top of the heap
+            entry[2] = None
+
+    def shutdown(self):
+        """
+        Drop the remaining deadlines and stop the thread
+        """
+        with self._condition:
+            self._is_shutdown = True
+            self._deadlines = []
+            self._condition.notify()
+
+    def _wait(self):
+        """
+        Fire deadlines as they pass (private)
+        """
+        while True:
+            with self._condition:
+                while not self._is_shutdown:
+                    while self._deadlines and self._deadlines[0][2] is None:
+                        heapq.heappop(self._deadlines)
+                    if not self._deadlines:
+                        self._condition.wait()
+                        continue
+                    delay = self._deadlines[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                if self._is_shutdown:
+                    return
+                callback = heapq.heappop(self._deadlines)[2]
+            try:
+                callback()
+            except Exception:
+                logging.error(traceback.format_exc())
+
+
+class _Run(object):
+    """
+    A task that has started, and whether it still holds its slot (private)
+    """
+
+    __slots__ = ('partition_key', 'future', 'on_timeout', 'token',
+                 'deadline', 'on_thread', 'released', 'completed')
+
+    def __init__(self, partition_key, future, on_timeout):
+        self.partition_key = partition_key
+        self.future = future
+        self.on_timeout = on_timeout
+        self.token = CancellationToken()
+        self.deadline = None
+        self.on_thread = True
+        self.released = False
+        self.completed = False
+
+
+class PartitionScheduler(object):
+    """
+    Runs tasks in submission order per partition, by priority across them
+
+    At most one task of a (resource, partition) runs at a time; a task that
+    returns a future gives up its thread but keeps its partition (and its
+    place under the resource's cap) until the future is done. Partitions
+    with waiting tasks are picked by the priority of their next task, and
+    take turns when priorities are equal: after a partition's task
+    finishes, the partition goes to the back of the line. Per-resource caps
+    from the scheduling policy hold back partitions of busy resources.
+
+    Tasks can be given a timeout. A task still running (or waiting on its
+    future) when its timeout passes fails with a TimeoutError, its
+    cancellation token is cancelled and it gives up its slot, so that a
+    stuck task cannot hold back its partition or starve the others. Python
+    threads cannot be stopped, so the thread pool has room for as many
+    overrunning tasks as there are slots.
+    """
+
+    def __init__(self, num_concurrent, policy=None, adaptive=None):
+        """
+        Initialize the scheduler
+
+        Args:
+            num_concurrent: Tasks to run at the same time (initially, if
+                adaptive)
+            policy: (Optional) SchedulingPolicy for resource caps
+            adaptive: (Optional) AdaptiveConcurrency to resize with
+        """
+        if policy is None:
+            policy = SchedulingPolicy()
+        self._num_concurrent = num_concurrent
+        self._policy = policy
+        self._adaptive = adaptive
+        max_workers = num_concurrent
+        if adaptive:
+            max_workers = max(num_concurrent, adaptive.max_concurrent)
+        self._threadpool = futures.ThreadPoolExecutor(2 * max_workers)
+        self._deadlines = DeadlineTimer()
+        self._queues = {}
+        self._ready = []
+        self._blocked = {}
+        self._sequence = itertools.count()
+        self._running = 0
+        self._queued = 0
+        self._deferred = 0
+        self._running_by_resource = collections.defaultdict(int)
+        self._wait_times = {}
+        self._is_shutdown = False
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def submit(self, resource_name, partition_name, fn, priority=0,
+               timeout=None, on_timeout=None):
+        """
+        Queue a task for a partition
+
+        Args:
+            resource_name: The resource
+            partition_name: The partition
+            fn: The callable to run, without arguments; it can get its
+                cancellation token from current_cancellation_token()
+            priority: (Optional) Higher priorities run first
+            timeout: (Optional) Seconds the task may run for once started
+            on_timeout: (Optional) Callable without arguments, run on a
+                worker thread if the task times out
+
+        Returns:
+            Future for the result of fn
+
+        Raises:
+            RuntimeError: If the scheduler was shut down
+        """
+        future = futures.Future()
+        partition_key = (resource_name, partition_name)
+        with self._lock:
+            if self._is_shutdown:
+                raise RuntimeError('Cannot schedule after shutdown')
+            queue = self._queues.get(partition_key)
+            if queue is None:
+                # neither running nor waiting
+                queue = self._queues[partition_key] = collections.deque()
+                queue.append(
+                    (future, fn, priority, time.time(), timeout, on_timeout))
+                self._push(partition_key)
+            else:
+                queue.append(
+                    (future, fn, priority, time.time(), timeout, on_timeout))
+            self._queued += 1
+            tasks = self._take()
+        self._start(tasks)
+        return future
+
+    def call_soon(self, fn):
+        """
+        Run a short callable on a worker thread, outside partition order
+
+        Args:
+            fn: The callable, without arguments
+
+        Returns:
+            Future for the result of fn
+        """
+        return self._threadpool.submit(fn)
+
+    def get_concurrency(self):
+        """
+        Get the number of tasks allowed to run at the same time
+
+        Returns:
+            The concurrency
+        """
+        with self._lock:
+            return self._num_concurrent
+
+    def get_stats(self):
+        """
+        Get queue depths and how long tasks waited to start
+
+        Returns:
+            Dictionary of concurrency, running (task count), deferred (tasks
+            waiting on a future they returned), queued (task count),
+            queued_by_resource (map of resource to task count) and
+            wait_time (map of priority to a histogram snapshot, in ms)
+        """
+        with self._lock:
+            queued_by_resource = collections.defaultdict(int)
+            for (resource_name, partition_name), queue in (
+                    self._queues.iteritems()):
+                if queue:
+                    queued_by_resource[resource_name] += len(queue)
+            return {
+                'concurrency': self._num_concurrent,
+                'running': self._running,
+                'deferred': self._deferred,
+                'queued': self._queued,
+                'queued_by_resource': dict(queued_by_resource),
+                'wait_time': dict(
+                    (priority, histogram.get_snapshot())
+                    for priority, histogram in self._wait_times.iteritems())}
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting tasks
+
+        Args:
+            wait: True to wait until queued tasks have run, False to cancel
+                the tasks that have not started
+        """
+        with self._lock:
+            self._is_shutdown = True
+            if not wait:
+                for queue in self._queues.itervalues():
+                    for task in queue:
+                        task[0].cancel()
+                    queue.clear()
+                self._ready = []
+                self._blocked.clear()
+                self._queued = 0
+            while wait and self._queues:
+                self._idle.wait()
+        self._deadlines.shutdown()
+        self._threadpool.shutdown(wait)
+
+    def _push(self, partition_key):
+        """
+        Mark a partition as ready to run its next task (private)
+
+        Must be called with the lock held.
+
+        Args:
+            partition_key: (resource, partition) pair
+        """
+        priority = self._queues[partition_key][0][2]
+        heapq.heappush(
+            self._ready, (-priority, next(self._sequence), partition_key))
+
+    def _take(self):
+        """
+        Pick tasks to start while there is capacity (private)
+
+        Must be called with the lock held.
+
+        Returns:
+            List of (partition key, task) pairs
+        """
+        tasks = []
+        while self._running < self._num_concurrent and self._ready:
+            entry = heapq.heappop(self._ready)
+            partition_key = entry[2]
+            resource_name = partition_key[0]
+            cap = self._policy.get_resource_cap(resource_name)
+            if (cap is not None and
+                    self._running_by_resource[resource_name] >= cap):
+                # keeps its place until the resource has room again
+                self._blocked.setdefault(resource_name, []).append(entry)
+                continue
+            task = self._queues[partition_key].popleft()
+            self._queued -= 1
+            priority = task[2]
+            if priority not in self._wait_times:
+                self._wait_times[priority] = metrics.Histogram()
+            wait = time.time() - task[3]
+            self._wait_times[priority].add(wait * 1000)
+            if self._adaptive:
+                self._adaptive.record_wait(wait)
+            tasks.append((partition_key, task))
+            self._running += 1
+            self._running_by_resource[resource_name] += 1
+        return tasks
+
+    def _start(self, tasks):
+        """
+        Hand tasks to the thread pool (private)
+
+        Args:
+            tasks: List of (partition key, task) pairs
+        """
+        for partition_key, task in tasks:
+            self._threadpool.submit(self._run, partition_key, task)
+
+    def _run(self, partition_key, task):
+        """
+        Run a task, then let the next partition have a turn (private)
+
+        If the task returns a future, the thread is released right away,
+        but the partition's next task waits until that future is done.
+
+        Args:
+            partition_key: (resource, partition) pair
+            task: (future, fn, priority, submit time, timeout, on_timeout)
+                tuple
+        """
+        future, fn = task[:2]
+        timeout, on_timeout = task[4:]
+        run = _Run(partition_key, future, on_timeout)
+        start = time.time()
+        deferred = None
+        error = None
+        if future.set_running_or_notify_cancel():
+            if timeout is not None:
+                run.deadline = self._deadlines.add(
+                    timeout, functools.partial(self._on_deadline, run))
+            _local.token = run.token
+            result = None
+            try:
+                result = fn()
+            except Exception as e:
+                logging.error('Task for {0} failed'.format(partition_key))
+                logging.error(traceback.format_exc())
+                error = e
+            finally:
+                _local.token = None
+            if is_future(result):
+                deferred = result
+            else:
+                self._set_result(run, result, error)
+        with self._lock:
+            if self._adaptive:
+                self._adaptive.record_run(time.time() - start, self._running)
+                self._num_concurrent = self._adaptive.adjust(
+                    self._num_concurrent, self._queued)
+            if not run.released:
+                self._running -= 1
+                if deferred is None:
+                    run.released = True
+                    self._release(partition_key)
+                else:
+                    run.on_thread = False
+                    self._deferred += 1
+            tasks = self._take()
+        self._start(tasks)
+        if deferred is None:
+            self._cancel_deadline(run)
+        else:
+            deferred.add_done_callback(
+                functools.partial(self._on_deferred_done, run))
+
+    def _on_deferred_done(self, run, deferred):
+        """
+        Finish a task whose future is done (private)
+
+        Args:
+            run: The _Run of the task
+            deferred: Future returned by the task
+        """
+        result = error = None
+        try:
+            result = deferred.result()
+        except Exception as e:
+            logging.error('Task for {0} failed'.format(run.partition_key))
+            logging.error(traceback.format_exc())
+            error = e
+        self._set_result(run, result, error)
+        with self._lock:
+            if run.released:
+                return
+            run.released = True
+            self._deferred -= 1
+            self._release(run.partition_key)
+            tasks = self._take()
+        self._start(tasks)
+        self._cancel_deadline(run)
+
+    def _on_deadline(self, run):
+        """
+        Fail a task that overran its timeout and free its slot (private)
+
+        Args:
+            run: The _Run of the task
+        """
+        with self._lock:
+            if run.released:
+                return
+            run.released = True
+            if run.on_thread:
+                self._running -= 1
+            else:
+                self._deferred -= 1
+            if run.on_timeout:
+                # before the release, which may let shutdown() go ahead
+                self._threadpool.submit(run.on_timeout)
+            self._release(run.partition_key)
+            tasks = self._take()
+        logging.error('Task for {0} timed out'.format(run.partition_key))
+        run.token.cancel()
+        self._set_result(run, None, futures.TimeoutError(
+            'Task for {0} timed out'.format(run.partition_key)))
+        self._start(tasks)
+
+    def _set_result(self, run, result, error):
+        """
+        Complete the future of a task, unless it already is (private)
+
+        The task finishing and its deadline passing can race; whichever
+        comes first decides the outcome.
+
+        Args:
+            run: The _Run of the task
+            result: What the task returned
+            error: The exception it raised, or None
+        """
+        with self._lock:
+            if run.completed:
+                return
+            run.completed = True
+        if error is not None:
+            run.future.set_exception(error)
+        else:
+            run.future.set_result(result)
+
+    def _cancel_deadline(self, run):
+        """
+        Stop the deadline of a finished task (private)
+
+        Args:
+            run: The _Run of the task
+        """
+        if run.deadline is not None:
+            self._deadlines.cancel(run.deadline)
+
+    def _release(self, partition_key):
+        """
+        Let a partition run its next task (private)
+
+        Must be called with the lock held.
+
+        Args:
+            partition_key: (resource, partition) pair
+        """
+        resource_name = partition_key[0]
+        self._running_by_resource[resource_name] -= 1
+        if not self._running_by_resource[resource_name]:
+            del self._running_by_resource[resource_name]
+        for entry in self._blocked.pop(resource_name, []):
+            heapq.heappush(self._ready, entry)
+        if self._queues[partition_key]:
+            self._push(partition_key)
+        else:
+            del self._queues[partition_key]
+        if not self._queues:
+            self._idle.notify_all()
+
+
+def is_future(result):
+    """
+    Check if a task returned a future instead of a result
+
+    Args:
+        result: What the task returned
+
+    Returns:
+        True if the result has add_done_callback and result methods
+    """
+    return (hasattr(result, 'add_done_callback') and
+            hasattr(result, 'result'))
@@ -1,8 +1,10 @@
-import json
 import kazoo.client
 import logging
 
 import accessor
+import bucketizer
+import connection
+import znode
 
 
 class SpectatorConnection(object):
@@ -11,16 +13,22 @@ class SpectatorConnection(object):
 
     This class encompasses all of a spectator's interactions with ZooKeeper.
     """
-    def __init__(self, cluster_id, zk_addrs):
+    def __init__(self, cluster_id, zk_addrs, shared_session=False):
         """
         Initialize the connection parameters
 
         Args:
             cluster_id: The cluster to watch
             zk_addrs: Comma-separated host:port of ZooKeeper servers
+            shared_session: (Optional) True to share one ZooKeeper session
+                with other participants and spectators of the same ensemble
+                in this process
         """
         self._cluster_id = cluster_id
-        self._client = kazoo.client.KazooClient(zk_addrs)
+        if shared_session:
+            self._client = connection.get_session_manager().acquire(zk_addrs)
+        else:
+            self._client = kazoo.client.KazooClient(zk_addrs)
         self._client.add_listener(self._connection_listener)
         self._accessor = accessor.DataAccessor(cluster_id, self._client)
         self._keybuilder = self._accessor.get_key_builder()
@@ -117,10 +125,11 @@ class SpectatorConnection(object):
         """
         if not data:
             return True
-        participant_config = json.loads(data)
-        if participant_config and 'id' in participant_config:
+        participant_config = self._accessor.get_codec().deserialize(data)
+        if isinstance(participant_config, znode.ZNRecord):
             with self._participants_lock:
-                self._participants[participant_config['id']] = participant_config
+                self._participants[participant_config.id] = (
+                    participant_config)
         return True
 
     def _connection_listener(self, state):
@@ -161,7 +170,7 @@ class Spectator(object):
             resource_id: The resource to spectate
             participants: Map of participant id to participant config
         """
-        self._mapping = {}
+        self._external_view = None
         self._participants_lock = participants_lock
         self._participants = participants
         self._accessor = accessor
@@ -180,15 +189,17 @@ class Spectator(object):
             List of participants
         """
         result = set()
-        partitions = None
 
         with self._participants_lock:
-            if partition_id:
-                partitions = [partition_id]
+            external_view = self._external_view
+            if not external_view:
+                mappings = []
+            elif partition_id:
+                mappings = [external_view.get_map_field(partition_id) or {}]
             else:
-                partitions = self._mapping.keys()
-            for partition_id in partitions:
-                for participant_id, s in self._mapping[partition_id].iteritems():
+                mappings = external_view.map_fields.values()
+            for mapping in mappings:
+                for participant_id, s in mapping.iteritems():
                     if s == state:
                         result.add(participant_id)
         return [self._participants[p] for p in result]
@@ -204,8 +215,8 @@ class Spectator(object):
             Map of participant id to state
         """
         with self._participants_lock:
-            if partition_id in self._mapping:
-                return self._mapping[partition_id]
+            if self._external_view:
+                return self._external_view.get_map_field(partition_id) or {}
             else:
                 return {}
 
@@ -220,17 +231,21 @@ class Spectator(object):
         Returns:
             Always True
         """
+        external_view = None
+        if data:
+            # partitions are decoded when they are looked up
+            external_view = self._accessor.get_codec().deserialize(
+                data, lazy=True)
+            if bucketizer.get_bucket_size(external_view):
+                # partitions live in buckets; the controller rewrites this
+                # node whenever it writes them, so re-read everything
+                external_view = self._accessor.get(self._ev_key, lazy=True)
+        if not isinstance(external_view, znode.ZNRecord):
+            external_view = None
         with self._participants_lock:
-            if not data:
-                self._mapping = {}
-                return True
-            external_view = json.loads(data)
-            if (external_view and
-               'mapFields' in external_view and external_view['mapFields']):
-                self._mapping = external_view['mapFields']
-            else:
-                self._mapping = {}
-            logging.debug('Updated external view: {0}'.format(self._mapping))
+            self._external_view = external_view
+            logging.debug('Updated external view: {0}'.format(
+                external_view and external_view.id))
         return True
 
     def _init(self, resource_id):
@@ -240,5 +255,5 @@ class Spectator(object):
         Args:
             resource_id: The resource to spectate on
         """
-        self._accessor.watch_property(
-            self._keybuilder.external_view(resource_id), self._ev_watcher)
+        self._ev_key = self._keybuilder.external_view(resource_id)
+        self._accessor.watch_property(self._ev_key, self._ev_watcher)
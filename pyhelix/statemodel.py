@@ -1,4 +1,92 @@
 import logging
+import re
+
+# Transition callbacks are named on_become_<to>_from_<from>
+_HANDLER_NAME = re.compile(r'^on_become_(\w+?)_from_(\w+)$')
+
+# Name of the callback for transitions without their own
+_DEFAULT_HANDLER = 'default_transition_handler'
+
+# State model class -> dispatch table
+_dispatch_tables = {}
+
+# (state model class, from state, to state) as spelled in messages -> name
+_handler_names = {}
+
+
+def get_dispatch_table(state_model_class):
+    """
+    Get the transition callbacks of a state model class
+
+    The table is compiled from the class's methods the first time it is
+    needed and shared by all of the class's state models.
+
+    Args:
+        state_model_class: A StateModel subclass
+
+    Returns:
+        Map of (from state, to state), in lowercase, to the callback name
+    """
+    table = _dispatch_tables.get(state_model_class)
+    if table is None:
+        table = {}
+        for name in dir(state_model_class):
+            match = _HANDLER_NAME.match(name)
+            if match and callable(getattr(state_model_class, name)):
+                table[(match.group(2), match.group(1))] = name
+        _dispatch_tables[state_model_class] = table
+    return table
+
+
+def get_transition_handler(model, from_state, to_state):
+    """
+    Get the bound callback of a state model for a transition
+
+    Args:
+        model: The instance of StateModel subclass with the callbacks
+        from_state: The previous state
+        to_state: The new state
+
+    Returns:
+        The method to call; the default transition handler if the model has
+        no callback for the transition
+    """
+    key = (type(model), from_state, to_state)
+    name = _handler_names.get(key)
+    if name is None:
+        table = get_dispatch_table(type(model))
+        name = table.get(
+            (from_state.lower(), to_state.lower()), _DEFAULT_HANDLER)
+        _handler_names[key] = name
+    return getattr(model, name, model.default_transition_handler)
+
+
+def validate_transitions(state_model_class, state_model_def):
+    """
+    Compare the callbacks of a state model class with its definition
+
+    Args:
+        state_model_class: A StateModel subclass
+        state_model_def: The STATEMODELDEFS record of the state model
+
+    Returns:
+        (missing, illegal) tuple: sorted "FROM-TO" transitions of the
+        definition without a callback, and of callbacks for transitions
+        the definition does not have
+    """
+    transitions = set()
+    for transition in (state_model_def.get_list_field(
+            'STATE_TRANSITION_PRIORITYLIST') or []):
+        from_state, _, to_state = transition.partition('-')
+        transitions.add((from_state.lower(), to_state.lower()))
+    handled = set(get_dispatch_table(state_model_class))
+
+    def format_transitions(keys):
+        return sorted(
+            '{0}-{1}'.format(from_state, to_state).upper()
+            for from_state, to_state in keys)
+    return (format_transitions(transitions - handled),
+            format_transitions(handled - transitions))
 
 
 class StateModelParser(object):
@@ -18,15 +106,22 @@ class StateModelParser(object):
         Returns:
             The method to call
         """
-        method_name = (
-            'on_become_' + to_state.lower() + '_from_' + from_state.lower())
-        logging.debug('method_name: {0}'.format(method_name))
-        return getattr(model, method_name, model.default_transition_handler)
+        return get_transition_handler(model, from_state, to_state)
 
 
 class StateModel(object):
     """
     Base state model
+
+    Transition callbacks are named on_become_<to>_from_<from> and take the
+    message. A callback that waits on I/O can return a future (anything
+    with add_done_callback and result, such as a concurrent.futures.Future)
+    instead of blocking; its worker thread is then free for other
+    partitions, while later transitions of the same partition wait for the
+    future. If the future fails, the partition goes to ERROR. Callbacks that
+    can be interrupted should check the token from
+    scheduler.current_cancellation_token(), which is cancelled when the
+    transition times out.
     """
 
     DEFAULT_INIT_STATE = 'OFFLINE'
@@ -65,11 +160,113 @@ class StateModel(object):
         logging.warn('Default reset method invoked on state model')
 
 
+def _intern(value):
+    """
+    Get the shared copy of a state or partition name (private)
+
+    ASCII unicode strings, as decoded from ZNodes, become byte strings,
+    which take a quarter of the memory.
+
+    Args:
+        value: The string
+
+    Returns:
+        An equal string, shared by all callers where possible
+    """
+    try:
+        return intern(str(value))
+    except UnicodeEncodeError:
+        return value
+
+
+class CompactStateModel(object):
+    """
+    State model without a per-instance dictionary
+
+    This can be used in place of StateModel by participants that host very
+    many partitions. Instances only have the slots their classes declare,
+    so subclasses must declare __slots__ too (an empty tuple if they keep
+    no state of their own), and the current state is a shared, interned
+    string. Callbacks are named and called as for StateModel. When run in
+    a worker process, the values of all declared slots are copied back.
+    """
+
+    __slots__ = ('_state',)
+
+    DEFAULT_INIT_STATE = StateModel.DEFAULT_INIT_STATE
+
+    def __init__(self):
+        """
+        Initialize the state model in the initial state
+        """
+        self._state = _intern(self.DEFAULT_INIT_STATE)
+
+    @property
+    def _current_state(self):
+        return self._state
+
+    @_current_state.setter
+    def _current_state(self, state):
+        self._state = _intern(state)
+
+    def get_current_state(self):
+        """
+        Get the current state for this partition
+
+        Returns:
+            Current state string for this partition
+        """
+        return self._state
+
+    def default_transition_handler(self, message):
+        """
+        Default method for when no method is available to handle the transition
+
+        Args:
+            message: the transition message
+        """
+        logging.error('No method found for {0}-{1}'.format(
+            message.from_state, message.to_state))
+
+    def reset(self):
+        """
+        Method that is invoked when revert to initial state is requested
+        """
+        self._state = _intern(self.DEFAULT_INIT_STATE)
+
+
 class StateModelFactory(object):
     """
     Base state model factory
+
+    Factories whose state models are process-safe can set process_safe to
+    True, so that participants with a process pool run their transition
+    callbacks in worker processes. Such state models are pickled together
+    with the message and sent to a worker, so they (and the classes they
+    use) must be picklable and importable by module path. The callback runs
+    on the copy; on success the copy's attributes replace those of the
+    original. On failure the partition goes to ERROR with the exception's
+    message, like an in-process failure. Callbacks must not depend on
+    threads, locks, or connections of the participant process.
+
+    Transitions that take longer than transition_timeout seconds (or the
+    TIMEOUT of their message, if it has one) are failed: the partition goes
+    to ERROR and the next transition can start. The callback keeps running
+    and can stop early by checking the token from
+    scheduler.current_cancellation_token(); anything it does afterwards is
+    not recorded.
     """
 
+    # True if transition callbacks may run in a worker process
+    process_safe = False
+
+    # Seconds a transition may take; None for no limit
+    transition_timeout = None
+
+    # StateModel subclass of the state models, to check against the
+    # cluster's state model definition when the participant connects
+    state_model_class = None
+
     def __init__(self):
         """
         Initialize the factory
@@ -112,3 +309,40 @@ class StateModelFactory(object):
         """
         for sm in self._state_models.itervalues():
             sm.reset()
+
+
+class CompactStateModelFactory(StateModelFactory):
+    """
+    State model factory for participants with very many partitions
+
+    Meant for CompactStateModel subclasses. Partition names are interned,
+    and reset() drops all state models at once: partitions start over in
+    the initial state when their next transition creates a new model. The
+    state models' reset() is only called if their class overrides it.
+    """
+
+    def put_state_model(self, partition_name, state_model):
+        """
+        Associate a partition with a state model
+
+        Args:
+            partition_name: The partition
+            state_model: The state model
+        """
+        self._state_models[_intern(partition_name)] = state_model
+
+    def reset(self):
+        """
+        Invoked when cleanup is requested for all state provided state models
+        """
+        state_models, self._state_models = self._state_models, {}
+        default_reset = CompactStateModel.reset.__func__
+        overrides = {}
+        for sm in state_models.itervalues():
+            state_model_class = type(sm)
+            override = overrides.get(state_model_class)
+            if override is None:
+                override = overrides[state_model_class] = (
+                    state_model_class.reset.__func__ is not default_reset)
+            if override:
+                sm.reset()
@@ -1,3 +1,7 @@
+import json
+import re
+
+
 def get_empty_znode(node_id):
     """
     Get an empty ZNode with headers filled.
@@ -6,7 +10,431 @@ def get_empty_znode(node_id):
         node_id: String that identifies the ZNode
 
     Returns:
-        A dictionary representing a ZNRecord
+        An empty ZNRecord
+    """
+    return ZNRecord(node_id)
+
+
+def _simple_field(name, doc):
+    """
+    Build a property for a well-known simple field (private)
+
+    Args:
+        name: The simple field name
+        doc: Description of the field
+
+    Returns:
+        property that reads the field (None if missing) and writes it
+    """
+    def getter(self):
+        return self.simple_fields.get(name)
+
+    def setter(self, value):
+        self.simple_fields[name] = value
+
+    return property(getter, setter, doc=doc)
+
+
+class ZNRecord(object):
     """
-    return {
-        'id': node_id, 'simpleFields': {}, 'listFields': {}, 'mapFields': {}}
+    Helix ZNRecord: an id plus simple, list and map fields
+
+    The fields are plain dictionaries, available as attributes. For existing
+    code, records also behave like the dictionary they are stored as, so
+    record['simpleFields']['MSG_TYPE'] and record.msg_type are equivalent.
+    Both are Python-level calls, several times slower than indexing
+    record.simple_fields, which is what code on the message path uses.
+    """
+
+    __slots__ = ('id', 'simple_fields', 'list_fields', 'map_fields',
+                 'version')
+
+    # dictionary keys of the JSON representation, and the matching attributes
+    _FIELDS = {'id': 'id', 'simpleFields': 'simple_fields',
+               'listFields': 'list_fields', 'mapFields': 'map_fields'}
+
+    def __init__(self, node_id, simple_fields=None, list_fields=None,
+                 map_fields=None):
+        """
+        Initialize a record
+
+        Args:
+            node_id: String that identifies the ZNode
+            simple_fields: (Optional) Map of field to string
+            list_fields: (Optional) Map of field to list of strings
+            map_fields: (Optional) Map of field to map of string to string
+        """
+        self.id = node_id
+        self.simple_fields = {} if simple_fields is None else simple_fields
+        self.list_fields = {} if list_fields is None else list_fields
+        self.map_fields = {} if map_fields is None else map_fields
+        # ZNode version the record was read at, if read from ZooKeeper
+        self.version = None
+
+    @classmethod
+    def from_dict(cls, value):
+        """
+        Wrap the dictionary form of a record, without copying the fields
+
+        Args:
+            value: Dictionary with id, simpleFields, listFields and mapFields
+
+        Returns:
+            ZNRecord
+        """
+        return cls(value.get('id'), value.get('simpleFields'),
+                   value.get('listFields'), value.get('mapFields'))
+
+    @classmethod
+    def from_json(cls, value):
+        """
+        Parse the JSON form of a record
+
+        Args:
+            value: JSON string
+
+        Returns:
+            ZNRecord
+        """
+        return cls.from_dict(json.loads(value))
+
+    def to_dict(self):
+        """
+        Get the dictionary form of this record, sharing the fields
+
+        Returns:
+            Dictionary with id, simpleFields, listFields and mapFields
+        """
+        return {'id': self.id, 'simpleFields': self.simple_fields,
+                'listFields': self.list_fields, 'mapFields': self.map_fields}
+
+    def to_json(self):
+        """
+        Get the compact JSON form of this record
+
+        Returns:
+            JSON string
+        """
+        return json.dumps(self.to_dict(), separators=(',', ':'))
+
+    def get_current_state(self, partition_name):
+        """
+        Get the state of a partition in a current state record
+
+        Args:
+            partition_name: The partition
+
+        Returns:
+            The state, or None
+        """
+        fields = self.get_map_field(partition_name)
+        if fields is None:
+            return None
+        return fields.get('CURRENT_STATE')
+
+    def get_map_field(self, name):
+        """
+        Get one map field
+
+        Args:
+            name: The field, usually a partition
+
+        Returns:
+            Map of string to string, or None
+        """
+        return self.map_fields.get(name)
+
+    def get_list_field(self, name):
+        """
+        Get one list field
+
+        Args:
+            name: The field, usually a partition
+
+        Returns:
+            List of strings, or None
+        """
+        return self.list_fields.get(name)
+
+    def is_batch_message(self):
+        """
+        Check if this message carries transitions for several partitions
+
+        Returns:
+            True if the message is a batch message, False otherwise
+        """
+        mode = self.simple_fields.get('BATCH_MESSAGE_MODE') or ''
+        return mode.lower() == 'true'
+
+    def get_partition_names(self):
+        """
+        Get the partitions of a batch message
+
+        Like Helix, these are read from the PARTITION_NAME list field.
+
+        Returns:
+            List of partitions, without duplicates
+        """
+        partition_names = []
+        seen = set()
+        for partition_name in self.get_list_field('PARTITION_NAME') or []:
+            if partition_name not in seen:
+                seen.add(partition_name)
+                partition_names.append(partition_name)
+        return partition_names
+
+    def get_sub_message(self, partition_name):
+        """
+        Get the message for one partition of a batch message
+
+        Args:
+            partition_name: The partition
+
+        Returns:
+            ZNRecord with the same id and fields, for the partition only
+        """
+        sub_message = ZNRecord(
+            self.id, dict(self.simple_fields), self.list_fields,
+            self.map_fields)
+        sub_message.partition_name = partition_name
+        return sub_message
+
+    msg_type = _simple_field('MSG_TYPE', 'Message type')
+    msg_state = _simple_field('MSG_STATE', 'Message state (NEW, READ)')
+    tgt_session_id = _simple_field(
+        'TGT_SESSION_ID', 'Session the message is addressed to')
+    from_state = _simple_field('FROM_STATE', 'Transition source state')
+    to_state = _simple_field('TO_STATE', 'Transition target state')
+    resource_name = _simple_field('RESOURCE_NAME', 'Resource')
+    partition_name = _simple_field('PARTITION_NAME', 'Partition')
+    state_model_def = _simple_field(
+        'STATE_MODEL_DEF', 'Name of the state model definition')
+    session_id = _simple_field('SESSION_ID', 'Session of a current state')
+    bucket_size = _simple_field('BUCKET_SIZE', 'Partitions per bucket')
+    batch_message_mode = _simple_field(
+        'BATCH_MESSAGE_MODE', '"true" for batch messages')
+    timeout = _simple_field(
+        'TIMEOUT', 'Milliseconds a transition may take; -1 for no limit')
+
+    def __getitem__(self, name):
+        if name == 'simpleFields':
+            return self.simple_fields
+        elif name == 'mapFields':
+            return self.map_fields
+        elif name == 'listFields':
+            return self.list_fields
+        elif name == 'id':
+            return self.id
+        raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        try:
+            setattr(self, self._FIELDS[name], value)
+        except KeyError:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        return name in self._FIELDS
+
+    def __iter__(self):
+        return iter(self._FIELDS)
+
+    def get(self, name, default=None):
+        if name in self._FIELDS:
+            return self[name]
+        return default
+
+    def keys(self):
+        return self._FIELDS.keys()
+
+    def iteritems(self):
+        for name in self._FIELDS:
+            yield name, self[name]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, ZNRecord):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__init__(
+            state['id'], state['simpleFields'], state['listFields'],
+            state['mapFields'])
+
+    def __repr__(self):
+        return 'ZNRecord({0!r})'.format(self.to_dict())
+
+
+# Candidate top-level keys; the value must start right after the match
+_TOP_LEVEL = re.compile(
+    r'[{,][ \t\n\r]*"(id|simpleFields|mapFields|listFields)"'
+    r'[ \t\n\r]*:[ \t\n\r]*')
+
+# Field names that can be searched for as they are written
+_PLAIN_NAME = re.compile(r'^[\x20-\x7e]*$')
+
+_DECODER = json.JSONDecoder()
+
+
+class LazyZNRecord(ZNRecord):
+    """
+    ZNRecord that decodes its map and list fields on demand
+
+    The id and simple fields are decoded when the record is created. Single
+    map and list fields are located in the raw JSON and decoded when they
+    are first requested with get_map_field and get_list_field; reading
+    map_fields or list_fields (or the dictionary view) decodes all of them.
+    """
+
+    __slots__ = ('_raw', '_spans', '_map_fields', '_list_fields', '_decoded',
+                 '_lookups')
+
+    # Single-field lookups before all fields of that kind are decoded
+    DECODE_THRESHOLD = 8
+
+    def __init__(self, raw):
+        """
+        Initialize from the raw JSON of a record
+
+        Args:
+            raw: The JSON string
+
+        Raises:
+            ValueError: If raw is not valid JSON
+        """
+        self._raw = raw
+        self._spans = {}
+        self._map_fields = None
+        self._list_fields = None
+        self._decoded = {}
+        self._lookups = 0
+        self.version = None
+        matches = {}
+        for match in _TOP_LEVEL.finditer(raw):
+            matches.setdefault(match.group(1), []).append(match.end())
+        if len(matches) != 4 or [m for m in matches.values() if len(m) > 1]:
+            # a field shares a name with a top-level key, so parse it all
+            record = ZNRecord.from_dict(json.loads(raw))
+            self.id = record.id
+            self.simple_fields = record.simple_fields
+            self._map_fields = record.map_fields
+            self._list_fields = record.list_fields
+            return
+        starts = sorted(offsets[0] for offsets in matches.values())
+        for name, offsets in matches.items():
+            start = offsets[0]
+            following = [s for s in starts if s > start]
+            self._spans[name] = (start, following[0] if following else
+                                 len(raw))
+        self.id = _DECODER.raw_decode(raw, self._spans['id'][0])[0]
+        self.simple_fields = _DECODER.raw_decode(
+            raw, self._spans['simpleFields'][0])[0]
+
+    @property
+    def map_fields(self):
+        if self._map_fields is None:
+            self._map_fields = self._decode_all('mapFields')
+        return self._map_fields
+
+    @map_fields.setter
+    def map_fields(self, value):
+        self._map_fields = value
+
+    @property
+    def list_fields(self):
+        if self._list_fields is None:
+            self._list_fields = self._decode_all('listFields')
+        return self._list_fields
+
+    @list_fields.setter
+    def list_fields(self, value):
+        self._list_fields = value
+
+    def get_map_field(self, name):
+        """
+        Get one map field, decoding only that field
+
+        Args:
+            name: The field, usually a partition
+
+        Returns:
+            Map of string to string, or None
+        """
+        if self._map_fields is not None:
+            return self._map_fields.get(name)
+        return self._get_field('mapFields', '{', name)
+
+    def get_list_field(self, name):
+        """
+        Get one list field, decoding only that field
+
+        Args:
+            name: The field, usually a partition
+
+        Returns:
+            List of strings, or None
+        """
+        if self._list_fields is not None:
+            return self._list_fields.get(name)
+        return self._get_field('listFields', '\\[', name)
+
+    def __reduce__(self):
+        return (ZNRecord, (self.id, self.simple_fields, self.list_fields,
+                           self.map_fields))
+
+    def _decode_all(self, fields):
+        """
+        Decode every map or list field (private)
+
+        Args:
+            fields: "mapFields" or "listFields"
+
+        Returns:
+            Map of field name to value
+        """
+        return _DECODER.raw_decode(self._raw, self._spans[fields][0])[0]
+
+    def _get_field(self, fields, opener, name):
+        """
+        Find and decode a single map or list field (private)
+
+        Args:
+            fields: "mapFields" or "listFields"
+            opener: Pattern for the first character of a value
+            name: The field
+
+        Returns:
+            The decoded value, or None
+        """
+        cache_key = (fields, name)
+        if cache_key in self._decoded:
+            return self._decoded[cache_key]
+        self._lookups += 1
+        if (self._lookups > self.DECODE_THRESHOLD or
+                not _PLAIN_NAME.match(name)):
+            # searching is no longer cheaper than decoding everything
+            if fields == 'mapFields':
+                return self.map_fields.get(name)
+            return self.list_fields.get(name)
+
+        # inside these fields, only field names are followed by an opener
+        start, end = self._spans[fields]
+        match = re.compile(
+            r'[{,][ \t\n\r]*' + re.escape(json.dumps(name)) +
+            r'[ \t\n\r]*:[ \t\n\r]*' + opener).search(self._raw, start, end)
+        value = None
+        if match:
+            value = _DECODER.raw_decode(self._raw, match.end() - 1)[0]
+        self._decoded[cache_key] = value
+        return value
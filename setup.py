@@ -28,6 +28,6 @@ setuptools.setup(
         'Intended Audience :: Developers',
         'Intended Audience :: System Administrators',
         'License :: OSI Approved :: Apache Software License',
-        'Programming Language :: Python :: 2.6',
+        'Programming Language :: Python :: 2.7',
         ],
     zip_safe=False)
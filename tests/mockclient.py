@@ -17,9 +17,11 @@ class MockKazooClient(object):
         self.store = {'/': None}
         self.ephemerals = set()
         self.versions = {}
+        self.watches = {}
+        self.listeners = []
         self._connected = False
 
-    def start(self):
+    def start(self, timeout=15):
         self._connected = True
 
     def stop(self):
@@ -74,51 +76,54 @@ class MockKazooClient(object):
                 self.store[subpath] = None
         self.store[path] = None
 
-    def exists(self, path):
+    def exists(self, path, watch=None):
         return path if path in self.store else None
 
-    def get(self, path):
-        # TODO: manage versions internally better
+    def get(self, path, watch=None):
         if path not in self.store:
             raise kazoo.exceptions.NoNodeError
+        if watch:
+            watches = self.watches.setdefault(path, [])
+            if watch not in watches:
+                watches.append(watch)
         get_stat = MockStruct()
-        get_stat.version = -1
-        return self.store[path], True
+        get_stat.version = self.versions.get(path, 0)
+        return self.store[path], get_stat
 
-    def get_children(self, path, include_data=False):
+    def get_children(self, path, watch=None, include_data=False):
         # TODO: include_data doesn't do the right thing
         if path not in self.store:
             raise kazoo.exceptions.NoNodeError
-        parts = path.split('/')
+        prefix = path.rstrip('/') + '/'
         result = []
         for existpath, data in self.store.iteritems():
-            if existpath.startswith(path):
-                existparts = existpath.split('/')
-                if len(existparts) == len(parts) + 1:
+            if existpath.startswith(prefix) and existpath != prefix:
+                name = existpath[len(prefix):]
+                if '/' not in name:
                     if include_data:
-                        result.append((existpath, data))
+                        result.append((name, data))
                     else:
-                        result.append(existpath)
+                        result.append(name)
         return result
 
     def set(self, path, data, version=-1):
         if path not in self.store:
             raise kazoo.exceptions.NoNodeError
-        if path in self.versions:
-            existversion = self.versions[path]
-            if version != -1 and existversion > version:
-                raise kazoo.exceptions.BadVersionError
+        existversion = self.versions.get(path, 0)
+        if version not in (-1, existversion):
+            raise kazoo.exceptions.BadVersionError
         self.store[path] = data
-        self.versions[path] = version
+        self.versions[path] = existversion + 1
+        self._fire_watches(path)
+        set_stat = MockStruct()
+        set_stat.version = existversion + 1
+        return set_stat
 
     def delete(self, path, version=-1, recursive=False):
         if path not in self.store:
             raise kazoo.exceptions.NoNodeError
-        existversion = -1
-        if path in self.versions:
-            existversion = self.versions[path]
-            if version != -1 and existversion > version:
-                raise kazoo.exceptions.BadVersionError
+        if version not in (-1, self.versions.get(path, 0)):
+            raise kazoo.exceptions.BadVersionError
         to_pop = []
         for existpath in self.store.iterkeys():
             if existpath.startswith(path):
@@ -126,6 +131,7 @@ class MockKazooClient(object):
                     raise kazoo.exceptions.NotEmptyError
                 to_pop.append(existpath)
         for subpath in to_pop:
+            self._fire_watches(subpath)
             self.store.pop(subpath)
             if subpath in self.versions:
                 self.versions.pop(subpath)
@@ -134,8 +140,113 @@ class MockKazooClient(object):
         if path == '/':
             self.store = {'/': None}
 
-    def add_listener(self, unused):
-        pass
+    def create_async(self, *args, **kwargs):
+        return MockAsyncResult(self.create, *args, **kwargs)
 
-    def remove_listener(self, unused):
-        pass
+    def exists_async(self, *args, **kwargs):
+        return MockAsyncResult(self.exists, *args, **kwargs)
+
+    def get_async(self, *args, **kwargs):
+        return MockAsyncResult(self.get, *args, **kwargs)
+
+    def get_children_async(self, *args, **kwargs):
+        return MockAsyncResult(self.get_children, *args, **kwargs)
+
+    def set_async(self, *args, **kwargs):
+        return MockAsyncResult(self.set, *args, **kwargs)
+
+    def delete_async(self, *args, **kwargs):
+        return MockAsyncResult(self.delete, *args, **kwargs)
+
+    def transaction(self):
+        return MockTransactionRequest(self)
+
+    def _fire_watches(self, path):
+        event = MockStruct()
+        event.path = path
+        for watch in self.watches.pop(path, []):
+            watch(event)
+
+    def _fire_state(self, state):
+        for listener in list(self.listeners):
+            listener(state)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+
+class MockAsyncResult(object):
+    """
+    Already-completed version of a kazoo asynchronous result
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self.value = None
+        self.exception = None
+        try:
+            self.value = func(*args, **kwargs)
+        except kazoo.exceptions.KazooException as e:
+            self.exception = e
+
+    def get(self):
+        if self.exception:
+            raise self.exception
+        return self.value
+
+    def rawlink(self, callback):
+        callback(self)
+
+
+class MockTransactionRequest(object):
+    """
+    In-memory version of a kazoo transaction, applied all-or-nothing
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.operations = []
+
+    def create(self, path, value=b'', acl=None, ephemeral=False,
+               sequence=False):
+        self.operations.append(
+            lambda: self.client.create(
+                path, value, ephemeral=ephemeral, sequence=sequence))
+
+    def delete(self, path, version=-1):
+        self.operations.append(
+            lambda: self.client.delete(path, version=version))
+
+    def set_data(self, path, value, version=-1):
+        self.operations.append(
+            lambda: self.client.set(path, value, version=version))
+
+    def check(self, path, version):
+        def check_op():
+            if path not in self.client.store:
+                raise kazoo.exceptions.NoNodeError
+            if self.client.versions.get(path, 0) != version:
+                raise kazoo.exceptions.BadVersionError
+            return True
+        self.operations.append(check_op)
+
+    def commit(self):
+        saved = (dict(self.client.store), set(self.client.ephemerals),
+                 dict(self.client.versions))
+        results = []
+        for op in self.operations:
+            try:
+                results.append(op())
+            except kazoo.exceptions.KazooException as e:
+                self.client.store, self.client.ephemerals, \
+                    self.client.versions = saved
+                results = [kazoo.exceptions.RolledBackError()] * len(results)
+                results.append(e)
+                results.extend(
+                    [kazoo.exceptions.RuntimeInconsistency()] *
+                    (len(self.operations) - len(results)))
+                break
+        return results
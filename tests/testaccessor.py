@@ -0,0 +1,317 @@
+import kazoo.exceptions
+import unittest
+
+import pyhelix.accessor as accessor
+import pyhelix.znode as znode
+
+import mockclient
+
+
+class ConflictingKazooClient(mockclient.MockKazooClient):
+    """
+    Mock client whose versioned writes conflict a set number of times
+    """
+    def __init__(self, conflicts):
+        mockclient.MockKazooClient.__init__(self)
+        self.conflicts = conflicts
+
+    def set(self, path, data, version=-1):
+        if version != -1 and self.conflicts:
+            self.conflicts -= 1
+            raise kazoo.exceptions.BadVersionError
+        return mockclient.MockKazooClient.set(
+            self, path, data, version=version)
+
+
+class TestDataAccessor(unittest.TestCase):
+    """
+    These test methods check DataAccessor behavior against a mock client
+    """
+
+    def setUp(self):
+        self._client = mockclient.MockKazooClient()
+        self._client.start()
+        self._accessor = accessor.DataAccessor('mockcluster', self._client)
+        self._builder = self._accessor.get_key_builder()
+
+    def test_transaction_commit(self):
+        """
+        Test that all operations in a transaction are applied
+        """
+        self._accessor.create(self._builder.instance('p0'), b'')
+        node = znode.get_empty_znode('p0')
+        txn = self._accessor.transaction()
+        txn.create(self._builder.messages('p0'), b'')
+        txn.create(self._builder.errors('p0'), node)
+        self.assertTrue(txn.commit())
+        self.assertTrue(self._accessor.exists(self._builder.messages('p0')))
+        self.assertEqual(
+            self._accessor.get(self._builder.errors('p0'))['id'], 'p0')
+
+    def test_transaction_rollback(self):
+        """
+        Test that a failed operation prevents the whole transaction
+        """
+        self._accessor.create(self._builder.instance('p0'), b'')
+        self._accessor.create(self._builder.errors('p0'), b'')
+        txn = self._accessor.transaction()
+        txn.create(self._builder.messages('p0'), b'')
+        txn.create(self._builder.errors('p0'), b'')
+        self.assertFalse(txn.commit())
+        self.assertFalse(self._accessor.exists(self._builder.messages('p0')))
+
+    def test_transaction_update(self):
+        """
+        Test that transactional updates merge, combine and retry conflicts
+        """
+        key = self._builder.current_state('p0', 's0', 'r0')
+        self._accessor.create(
+            self._builder.current_states('p0', 's0'), b'')
+        message_key = self._builder.message('p0', 'm0')
+        self._accessor.create(message_key, znode.get_empty_znode('m0'))
+        first = znode.get_empty_znode('r0')
+        first.map_fields['r0_0'] = {'CURRENT_STATE': 'ONLINE'}
+        first.map_fields['r0_1'] = {'CURRENT_STATE': 'ONLINE'}
+        txn = self._accessor.transaction()
+        txn.update(key, first)
+        self.assertTrue(txn.commit())
+
+        # another writer gets in between the read and the commit once
+        get = self._client.get
+        interfered = []
+
+        def interfering_get(path, watch=None):
+            value, stat = get(path, watch)
+            if path == key.path and not interfered:
+                interfered.append(path)
+                self._client.set(path, value)
+            return value, stat
+        self._client.get = interfering_get
+        second = znode.get_empty_znode('r0')
+        second.map_fields['r0_2'] = {'CURRENT_STATE': 'ONLINE'}
+        dropped = znode.get_empty_znode('r0')
+        dropped.map_fields['r0_0'] = {}
+        txn = self._accessor.transaction()
+        txn.update(key, second)
+        txn.update(key, dropped, sub=True)
+        txn.remove(message_key)
+        self.assertTrue(txn.commit())
+        self.assertEqual(interfered, [key.path])
+        self.assertEqual(
+            sorted(self._accessor.get(key).map_fields), ['r0_1', 'r0_2'])
+        self.assertFalse(self._accessor.exists(message_key))
+
+    def test_async_get_many(self):
+        """
+        Test that pipelined gets return results in request order
+        """
+        keys = []
+        for i in xrange(5):
+            key = self._builder.message('p0', 'm{0}'.format(i))
+            self._accessor.create(key, znode.get_empty_znode('m{0}'.format(i)))
+            keys.append(key)
+        keys.append(self._builder.message('p0', 'missing'))
+        async_accessor = self._accessor.get_async_accessor()
+        nodes = async_accessor.get_many(keys)
+        self.assertEqual(
+            [n['id'] for n in nodes[:-1]],
+            ['m{0}'.format(i) for i in xrange(5)])
+        self.assertTrue(nodes[-1] is None)
+
+    def test_async_update(self):
+        """
+        Test that an asynchronous update creates and then merges
+        """
+        key = self._builder.current_state('p0', 's0', 'r0')
+        async_accessor = self._accessor.get_async_accessor()
+        first = znode.get_empty_znode('r0')
+        first['mapFields']['r0_0'] = {'CURRENT_STATE': 'ONLINE'}
+        self.assertTrue(async_accessor.update(key, first).result())
+        second = znode.get_empty_znode('r0')
+        second['mapFields']['r0_1'] = {'CURRENT_STATE': 'OFFLINE'}
+        self.assertTrue(async_accessor.update(key, second).result())
+        self.assertEqual(
+            sorted(self._accessor.get(key)['mapFields'].keys()),
+            ['r0_0', 'r0_1'])
+        self.assertTrue(async_accessor.set_many([(key, first)]) == [True])
+        self.assertEqual(
+            self._accessor.get(key)['mapFields'].keys(), ['r0_0'])
+
+    def test_versioned_set(self):
+        """
+        Test that records carry their version and conditional sets use it
+        """
+        key = self._builder.message('p0', 'm0')
+        self._accessor.create(key, znode.get_empty_znode('m0'))
+        record = self._accessor.get(key)
+        self.assertEqual(record.version, 0)
+        async_record = self._accessor.get_async_accessor().get(key).result()
+        self.assertEqual(async_record.version, 0)
+
+        record.msg_state = 'READ'
+        self.assertTrue(self._accessor.set(key, record, version=0))
+        self.assertEqual(self._accessor.get(key).version, 1)
+        # another writer moves the node on
+        self._client.set(key.path, self._client.get(key.path)[0])
+        async_record.msg_state = 'NEW'
+        self.assertFalse(self._accessor.set(key, async_record, version=0))
+        self.assertEqual(self._accessor.get(key).msg_state, 'READ')
+        self.assertFalse(self._accessor.set(
+            self._builder.message('p0', 'm1'), record, version=0))
+
+    def test_cache_hits_and_invalidation(self):
+        """
+        Test that cacheable reads are served from memory until changed
+        """
+        cached = accessor.DataAccessor(
+            'mockcluster', self._client, cache_size=2)
+        key = self._builder.cluster_config()
+        config = znode.get_empty_znode('mockcluster')
+        cached.create(key, config)
+        self.assertEqual(cached.get(key)['id'], 'mockcluster')
+        self.assertEqual(cached.get(key)['id'], 'mockcluster')
+        stats = cached.get_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+        # a write from another accessor fires the watch
+        config['simpleFields']['allowParticipantAutoJoin'] = 'true'
+        self._accessor.set(key, config)
+        self.assertTrue(
+            'allowParticipantAutoJoin' in cached.get(key)['simpleFields'])
+        self.assertEqual(cached.get_cache_stats()['misses'], 2)
+
+        # messages are never cached
+        message_key = self._builder.message('p0', 'm0')
+        cached.create(message_key, znode.get_empty_znode('m0'))
+        cached.get(message_key)
+        self.assertEqual(cached.get_cache_stats()['size'], 1)
+
+    def test_cached_update_not_skipped(self):
+        """
+        Test that an update is not skipped against a stale cached property
+        """
+        cached = accessor.DataAccessor(
+            'mockcluster', self._client, cache_size=2)
+        key = self._builder.cluster_config()
+        config = znode.get_empty_znode('mockcluster')
+        config['simpleFields']['X'] = 'a'
+        cached.create(key, config)
+        cached.get(key)
+
+        # another writer changes the node before the watch fires
+        config['simpleFields']['X'] = 'b'
+        self._client.store[key.path] = cached.get_codec().serialize(config)
+        self._client.versions[key.path] = 1
+
+        config['simpleFields']['X'] = 'a'
+        self.assertTrue(cached.update(key, config))
+        self.assertEqual(self._accessor.get(key)['simpleFields']['X'], 'a')
+        stats = cached.get_update_stats()[key['path']]
+        self.assertEqual((stats['skipped'], stats['writes']), (0, 1))
+
+    def test_cache_eviction(self):
+        """
+        Test that the least recently used property is evicted
+        """
+        cached = accessor.DataAccessor(
+            'mockcluster', self._client, cache_size=2)
+        for resource in ['r0', 'r1', 'r2']:
+            key = self._builder.ideal_state(resource)
+            cached.create(key, znode.get_empty_znode(resource))
+            cached.get(key)
+        cached.get(self._builder.ideal_state('r2'))
+        stats = cached.get_cache_stats()
+        self.assertEqual((stats['evictions'], stats['size']), (1, 2))
+        self.assertEqual(stats['hits'], 1)
+
+    def test_bucketized_update(self):
+        """
+        Test that bucketized records are split, merged and reassembled
+        """
+        key = self._builder.current_state('p0', 's0', 'r0')
+        record = znode.get_empty_znode('r0')
+        record['simpleFields']['BUCKET_SIZE'] = '2'
+        for i in xrange(4):
+            record['mapFields']['r0_{0}'.format(i)] = {
+                'CURRENT_STATE': 'OFFLINE'}
+        self.assertTrue(self._accessor.set(key, record))
+        self.assertEqual(
+            sorted(self._accessor.get_children(key)), ['r0_p0-p1', 'r0_p2-p3'])
+        untouched = self._client.store[key['path'] + '/r0_p0-p1']
+
+        delta = znode.get_empty_znode('r0')
+        delta['simpleFields']['BUCKET_SIZE'] = '2'
+        delta['mapFields']['r0_3'] = {'CURRENT_STATE': 'ONLINE'}
+        self.assertTrue(self._accessor.update(key, delta))
+        self.assertTrue(
+            self._client.store[key['path'] + '/r0_p0-p1'] is untouched)
+        value = self._accessor.get(key)
+        self.assertEqual(len(value['mapFields']), 4)
+        self.assertEqual(
+            value['mapFields']['r0_3']['CURRENT_STATE'], 'ONLINE')
+        async_value = self._accessor.get_async_accessor().get(key).result()
+        self.assertEqual(async_value, value)
+
+        # drops don't carry the bucket size
+        drop = znode.get_empty_znode('r0')
+        drop['mapFields']['r0_0'] = {}
+        self.assertTrue(self._accessor.update(key, drop, sub=True))
+        self.assertEqual(
+            sorted(self._accessor.get(key)['mapFields'].keys()),
+            ['r0_1', 'r0_2', 'r0_3'])
+
+    def test_update_skips_no_op(self):
+        """
+        Test that an update that changes nothing is not written
+        """
+        key = self._builder.current_state('p0', 's0', 'r0')
+        delta = znode.get_empty_znode('r0')
+        delta['mapFields']['r0_0'] = {'CURRENT_STATE': 'ONLINE'}
+        self.assertTrue(self._accessor.update(key, delta))
+        self.assertTrue(self._accessor.update(key, delta))
+        stats = self._accessor.get_update_stats()[key['path']]
+        self.assertEqual(
+            (stats['updates'], stats['writes'], stats['skipped']), (2, 1, 1))
+
+    def test_update_stats_bounded(self):
+        """
+        Test that update counters are kept for the recently updated paths
+        """
+        self._accessor.MAX_UPDATE_STATS = 2
+        keys = [self._builder.current_state('p0', 's0', 'r{0}'.format(i))
+                for i in range(3)]
+        for key in keys:
+            self.assertTrue(self._accessor.update(
+                key, znode.get_empty_znode(key['path'])))
+        stats = self._accessor.get_update_stats()
+        self.assertEqual(
+            sorted(stats), sorted([keys[1]['path'], keys[2]['path']]))
+        self._accessor.remove(keys[1])
+        self.assertEqual(
+            self._accessor.get_update_stats().keys(), [keys[2]['path']])
+
+    def test_update_conflicts(self):
+        """
+        Test that conflicting updates are retried up to the limit
+        """
+        client = ConflictingKazooClient(2)
+        client.start()
+        conflicted = accessor.DataAccessor(
+            'mockcluster', client, max_update_retries=2)
+        key = self._builder.current_state('p0', 's0', 'r0')
+        delta = znode.get_empty_znode('r0')
+        delta['mapFields']['r0_0'] = {'CURRENT_STATE': 'ONLINE'}
+        conflicted.create(key, delta)
+        delta['mapFields']['r0_0'] = {'CURRENT_STATE': 'OFFLINE'}
+        self.assertTrue(conflicted.update(key, delta))
+        stats = conflicted.get_update_stats()[key['path']]
+        self.assertEqual((stats['conflicts'], stats['retries']), (2, 2))
+
+        client.conflicts = 3
+        delta['mapFields']['r0_0'] = {'CURRENT_STATE': 'ONLINE'}
+        self.assertFalse(conflicted.update(key, delta))
+        self.assertEqual(
+            conflicted.get_update_stats()[key['path']]['failures'], 1)
+
+    def tearDown(self):
+        self._client.stop()
@@ -0,0 +1,42 @@
+import unittest
+
+import pyhelix.bucketizer as bucketizer
+import pyhelix.znode as znode
+
+
+class TestBucketizer(unittest.TestCase):
+    """
+    These test methods check that records are split like Java Helix does
+    """
+
+    def test_bucket_name(self):
+        """
+        Test that partitions map to the bucket covering their number
+        """
+        b = bucketizer.ZNRecordBucketizer(10)
+        self.assertEqual(b.get_bucket_name('TestDB_0'), 'TestDB_p0-p9')
+        self.assertEqual(b.get_bucket_name('TestDB_12'), 'TestDB_p10-p19')
+        self.assertEqual(
+            b.get_bucket_name('my_db_105'), 'my_db_p100-p109')
+        self.assertRaises(ValueError, b.get_bucket_name, 'TestDB')
+
+    def test_bucketize(self):
+        """
+        Test that fields are split and simple fields are copied
+        """
+        record = znode.get_empty_znode('TestDB')
+        record['simpleFields'][bucketizer.BUCKET_SIZE_FIELD] = '2'
+        for i in xrange(5):
+            record['mapFields']['TestDB_{0}'.format(i)] = {'a': 'b'}
+        record['listFields']['TestDB_4'] = ['x']
+        buckets = bucketizer.ZNRecordBucketizer(2).bucketize(record)
+        self.assertEqual(
+            sorted(buckets.keys()),
+            ['TestDB_p0-p1', 'TestDB_p2-p3', 'TestDB_p4-p5'])
+        self.assertEqual(
+            sorted(buckets['TestDB_p2-p3']['mapFields'].keys()),
+            ['TestDB_2', 'TestDB_3'])
+        self.assertEqual(
+            buckets['TestDB_p4-p5']['listFields'], {'TestDB_4': ['x']})
+        self.assertEqual(
+            bucketizer.get_bucket_size(buckets['TestDB_p0-p1']), 2)
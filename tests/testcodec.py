@@ -0,0 +1,56 @@
+import unittest
+
+import pyhelix.codec as codec
+import pyhelix.znode as znode
+
+
+class TestCodec(unittest.TestCase):
+    """
+    These test methods check ZNRecord serialization formats
+    """
+
+    def setUp(self):
+        self._record = znode.get_empty_znode('myResource')
+        self._record['simpleFields']['STATE_MODEL_DEF'] = 'OnlineOffline'
+        for i in xrange(100):
+            self._record['mapFields']['myResource_{0}'.format(i)] = {
+                'CURRENT_STATE': 'ONLINE'}
+
+    def test_compact(self):
+        """
+        Test that compact JSON round trips and is smaller than indented JSON
+        """
+        compact = codec.COMPACT_CODEC.serialize(self._record)
+        pretty = codec.PRETTY_CODEC.serialize(self._record)
+        self.assertTrue(len(compact) < len(pretty))
+        self.assertEqual(
+            codec.COMPACT_CODEC.deserialize(compact), self._record)
+        self.assertEqual(codec.COMPACT_CODEC.deserialize(pretty), self._record)
+
+    def test_gzip(self):
+        """
+        Test that compressed records are marked and detected on read
+        """
+        gzip_codec = codec.GzipJsonCodec()
+        value = gzip_codec.serialize(self._record)
+        self.assertTrue(codec.is_compressed(value))
+        record = codec.COMPACT_CODEC.deserialize(value)
+        self.assertEqual(
+            record['simpleFields'][codec.COMPRESSION_FIELD], 'true')
+        self.assertEqual(record['mapFields'], self._record['mapFields'])
+        lazy_record = codec.COMPACT_CODEC.deserialize(value, lazy=True)
+        self.assertTrue(isinstance(lazy_record, znode.LazyZNRecord))
+        self.assertEqual(lazy_record, record)
+
+        # marked records stay compressed with any codec
+        self.assertTrue(
+            codec.is_compressed(codec.COMPACT_CODEC.serialize(record)))
+
+    def test_gzip_threshold(self):
+        """
+        Test that small records are not compressed
+        """
+        gzip_codec = codec.GzipJsonCodec(threshold=1024 * 1024)
+        value = gzip_codec.serialize(self._record)
+        self.assertFalse(codec.is_compressed(value))
+        self.assertEqual(gzip_codec.serialize(b''), b'')
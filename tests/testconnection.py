@@ -0,0 +1,134 @@
+import kazoo.client
+import unittest
+
+import pyhelix.connection as connection
+
+import mockclient
+
+
+class TestConnection(unittest.TestCase):
+    """
+    These test methods check sharing ZooKeeper sessions between owners
+    """
+
+    def setUp(self):
+        self._clients = []
+
+        def client_factory(zk_addrs):
+            client = mockclient.MockKazooClient()
+            self._clients.append(client)
+            return client
+        self._manager = connection.SessionManager(client_factory)
+
+    def test_normalize(self):
+        """
+        Test that equivalent connection strings normalize the same way
+        """
+        self.assertEqual(
+            connection.normalize_zk_addrs('zk2:2181, ZK1/helix/'),
+            'zk1:2181,zk2:2181/helix')
+        self.assertEqual(
+            connection.normalize_zk_addrs('zk1:2181,zk2:2181'),
+            connection.normalize_zk_addrs('zk2,zk1'))
+
+    def test_reference_counting(self):
+        """
+        Test that the session stays up until its last owner stops
+        """
+        first = self._manager.acquire('zk1:2181,zk2:2181')
+        second = self._manager.acquire('zk2,zk1')
+        other = self._manager.acquire('zk3')
+        self.assertEqual(len(self._clients), 2)
+        self.assertEqual(self._manager.get_sessions()['zk1:2181,zk2:2181'], 2)
+
+        first.start()
+        second.start()
+        first.stop()
+        self.assertTrue(second.connected)
+        self.assertFalse(first.connected)
+        second.stop()
+        self.assertFalse(self._clients[0].connected)
+
+        first.close()
+        second.close()
+        self.assertEqual(self._manager.get_sessions(), {'zk3:2181': 1})
+        other.close()
+        self.assertEqual(self._manager.get_sessions(), {})
+
+    def test_dispatch(self):
+        """
+        Test that state changes and watches only reach started owners
+        """
+        first = self._manager.acquire('zk1')
+        second = self._manager.acquire('zk1')
+        states = {first: [], second: []}
+        first.add_listener(states[first].append)
+        second.add_listener(states[second].append)
+        first.start()
+        second.start()
+
+        client = self._clients[0]
+        client._fire_state(kazoo.client.KazooState.SUSPENDED)
+        self.assertEqual(states[first], [kazoo.client.KazooState.SUSPENDED])
+        self.assertEqual(states[second], [kazoo.client.KazooState.SUSPENDED])
+
+        events = []
+        client.create('/node', 'data')
+        first.get('/node', watch=events.append)
+        second.stop()
+        self.assertEqual(states[second][-1], kazoo.client.KazooState.LOST)
+        client._fire_state(kazoo.client.KazooState.CONNECTED)
+        self.assertEqual(states[first][-1], kazoo.client.KazooState.CONNECTED)
+        self.assertEqual(states[second][-1], kazoo.client.KazooState.LOST)
+
+        first.stop()
+        client.set('/node', 'changed')
+        self.assertEqual(events, [])
+
+    def test_restart_after_close(self):
+        """
+        Test that a closed owner can be started again and gets state changes
+        """
+        first = self._manager.acquire('zk1')
+        second = self._manager.acquire('zk1')
+        states = []
+        first.add_listener(states.append)
+        first.start()
+        second.start()
+        first.close()
+        self.assertEqual(self._manager.get_sessions(), {'zk1:2181': 1})
+
+        first.start()
+        self.assertEqual(self._manager.get_sessions(), {'zk1:2181': 2})
+        self._clients[0]._fire_state(kazoo.client.KazooState.SUSPENDED)
+        self.assertEqual(states[-1], kazoo.client.KazooState.SUSPENDED)
+
+        # the last owner closing discards the session, so it is recreated
+        first.close()
+        second.close()
+        self.assertEqual(self._manager.get_sessions(), {})
+        first.start()
+        self.assertEqual(len(self._clients), 2)
+        self.assertTrue(first.connected)
+        self._clients[1]._fire_state(kazoo.client.KazooState.CONNECTED)
+        self.assertEqual(states[-1], kazoo.client.KazooState.CONNECTED)
+        first.close()
+        self.assertEqual(self._manager.get_sessions(), {})
+
+    def test_repeated_watch(self):
+        """
+        Test that watching a node twice with one callback fires it once
+        """
+        owner = self._manager.acquire('zk1')
+        owner.start()
+        client = self._clients[0]
+        client.create('/node', 'data')
+        events = []
+
+        def watch(event):
+            events.append(event)
+        owner.get('/node', watch=watch)
+        owner.get('/node', watch=watch)
+        client.set('/node', 'changed')
+        self.assertEqual(len(events), 1)
+        owner.close()
@@ -1,7 +1,12 @@
+import concurrent.futures as futures
+import os
+import threading
 import unittest
 
 import pyhelix.accessor as accessor
 import pyhelix.helixexec as helixexec
+import pyhelix.helixtask as helixtask
+import pyhelix.scheduler as scheduler
 import pyhelix.statemodel as statemodel
 import pyhelix.znode as znode
 
@@ -16,7 +21,56 @@ class MockStateModel(statemodel.StateModel):
         pass
 
 
-class MockStateModelFactory(statemodel.StateModel):
+class ProcessStateModel(statemodel.StateModel):
+    """
+    A state model that remembers where its transitions ran
+    """
+    def __init__(self):
+        statemodel.StateModel.__init__(self)
+        self.pids = []
+
+    def on_become_online_from_offline(self, message):
+        self.pids.append(os.getpid())
+
+    def on_become_offline_from_online(self, message):
+        raise ValueError('Failed transition, expected')
+
+
+class LockingStateModel(ProcessStateModel):
+    """
+    A state model that cannot be sent to a worker process
+    """
+    def __init__(self):
+        ProcessStateModel.__init__(self)
+        self.lock = threading.Lock()
+
+
+class DeferredStateModel(statemodel.StateModel):
+    """
+    A state model whose transitions finish when their futures do
+    """
+    def __init__(self):
+        statemodel.StateModel.__init__(self)
+        self.futures = []
+
+    def default_transition_handler(self, message):
+        future = futures.Future()
+        self.futures.append(future)
+        return future
+
+
+class StuckStateModel(statemodel.StateModel):
+    """
+    A state model whose transitions wait until they are cancelled
+    """
+    def default_transition_handler(self, message):
+        token = scheduler.current_cancellation_token()
+        cancelled = threading.Event()
+        token.add_callback(cancelled.set)
+        cancelled.wait(5)
+
+
+class MockStateModelFactory(statemodel.StateModelFactory):
     """
     A factory for a nop state model
     """
@@ -59,3 +113,367 @@ class TestExecutor(unittest.TestCase):
         accessor.create(message_key, message)
         self.executor.on_message([message])
         self.assertFalse(accessor.exists(message_key))
+
+    def test_batch_message(self):
+        """
+        Test that a batch message transitions each partition and is recorded
+        with a single current state update
+        """
+        session_id = self._p.get_session_id()
+        message = znode.get_empty_znode('MY_BATCH_ID')
+        message.msg_type = 'STATE_TRANSITION'
+        message.msg_state = 'NEW'
+        message.tgt_session_id = session_id
+        message.from_state = 'OFFLINE'
+        message.to_state = 'ONLINE'
+        message.resource_name = 'myResource'
+        message.state_model_def = 'OnlineOffline'
+        message.batch_message_mode = 'true'
+        partition_names = ['myResource_0', 'myResource_1', 'myResource_2']
+        message.list_fields['PARTITION_NAME'] = partition_names
+        accessor = self._p.get_accessor()
+        keybuilder = accessor.get_key_builder()
+        participant_id = self._p.get_participant_id()
+        message_key = keybuilder.message(participant_id, message.id)
+        accessor.create(message_key, message)
+        current_state_key = keybuilder.current_state(
+            participant_id, session_id, 'myResource')
+        updates = []
+        update = accessor.update
+
+        def counting_update(key, *args, **kwargs):
+            updates.append(key.type)
+            return update(key, *args, **kwargs)
+        accessor.update = counting_update
+
+        self.executor.on_message([message])
+        self.executor.shutdown()
+        self.assertFalse(accessor.exists(message_key))
+        self.assertEqual(updates, ['message', 'current_state'])
+        current_state = accessor.get(current_state_key)
+        for partition_name in partition_names:
+            self.assertEqual(
+                current_state.get_current_state(partition_name), 'ONLINE')
+
+    def test_versioned_read_marking(self):
+        """
+        Test that messages are marked read with one conditional write, and
+        re-read when they changed since they were fetched
+        """
+        session_id = self._p.get_session_id()
+        accessor = self._p.get_accessor()
+        keybuilder = accessor.get_key_builder()
+        participant_id = self._p.get_participant_id()
+        messages = []
+        for i in range(2):
+            message = znode.get_empty_znode('MY_MESSAGE_ID_{0}'.format(i))
+            message.msg_type = 'STATE_TRANSITION'
+            message.msg_state = 'NEW'
+            message.tgt_session_id = session_id
+            message.from_state = 'OFFLINE'
+            message.to_state = 'ONLINE'
+            message.resource_name = 'myResource'
+            message.partition_name = 'myResource_{0}'.format(i)
+            message.state_model_def = 'OnlineOffline'
+            message_key = keybuilder.message(participant_id, message.id)
+            accessor.create(message_key, message)
+            messages.append(accessor.get(message_key))
+        self.assertEqual(messages[0].version, 0)
+
+        # the second message is changed after it was fetched
+        changed = accessor.get(message_key)
+        changed.to_state = 'DROPPED'
+        self._p._client.set(
+            message_key.path, accessor.get_codec().serialize(changed))
+
+        writes = []
+        update = accessor.update
+        set_ = accessor.set
+
+        def counting_update(key, *args, **kwargs):
+            writes.append(('update', key.type))
+            return update(key, *args, **kwargs)
+
+        def counting_set(key, *args, **kwargs):
+            writes.append(('set', key.type))
+            return set_(key, *args, **kwargs)
+        accessor.update = counting_update
+        accessor.set = counting_set
+
+        self.executor.on_message(messages)
+        self.executor.shutdown()
+        self.assertEqual(
+            [write for write in writes if write[1] == 'message'],
+            [('set', 'message')] * 3)
+        current_state = accessor.get(keybuilder.current_state(
+            participant_id, session_id, 'myResource'))
+        self.assertEqual(
+            current_state.get_current_state('myResource_0'), 'ONLINE')
+        self.assertEqual(current_state.get_current_state('myResource_1'),
+                         None)
+
+    def test_combined_current_states(self):
+        """
+        Test that transitions finishing together share a current state write
+        """
+        session_id = self._p.get_session_id()
+        accessor = self._p.get_accessor()
+        keybuilder = accessor.get_key_builder()
+        participant_id = self._p.get_participant_id()
+        messages = []
+        for i in range(3):
+            message = znode.get_empty_znode('MY_MESSAGE_{0}'.format(i))
+            message.resource_name = 'myResource'
+            message.partition_name = 'myResource_{0}'.format(i)
+            message.state_model_def = 'OnlineOffline'
+            accessor.create(
+                keybuilder.message(participant_id, message.id), message)
+            messages.append(message)
+        updates = []
+        update = accessor.update
+
+        def counting_update(key, *args, **kwargs):
+            updates.append(key.type)
+            return update(key, *args, **kwargs)
+        accessor.update = counting_update
+        transaction = accessor.transaction
+
+        def counting_transaction():
+            txn = transaction()
+            commit = txn.commit
+
+            def counting_commit():
+                committed = commit()
+                if committed:
+                    updates.append('transaction')
+                return committed
+            txn.commit = counting_commit
+            return txn
+        accessor.transaction = counting_transaction
+
+        combiner = helixtask.CurrentStateCombiner(
+            self._p, 60, max_partitions=2)
+        combiner.add(messages[0], session_id, {'myResource_0': 'ONLINE'})
+        combiner.add(messages[1], session_id, {'myResource_1': 'ONLINE'})
+        # the first write creates the current state's parent
+        self.assertEqual(updates, ['current_state'])
+        combiner.add(messages[2], session_id, {'myResource_2': 'ONLINE'})
+        self.assertTrue(accessor.exists(
+            keybuilder.message(participant_id, messages[2].id)))
+        combiner.flush()
+        self.assertEqual(updates, ['current_state', 'transaction'])
+        for message in messages:
+            self.assertFalse(accessor.exists(
+                keybuilder.message(participant_id, message.id)))
+        current_state = accessor.get(keybuilder.current_state(
+            participant_id, session_id, 'myResource'))
+        self.assertEqual(
+            sorted(current_state.map_fields),
+            ['myResource_0', 'myResource_1', 'myResource_2'])
+
+    def test_error_in_transaction(self):
+        """
+        Test that a failed transition's error is written with its current
+        state
+        """
+        session_id = self._p.get_session_id()
+        accessor = self._p.get_accessor()
+        keybuilder = accessor.get_key_builder()
+        participant_id = self._p.get_participant_id()
+        updates = []
+        update = accessor.update
+
+        def counting_update(key, *args, **kwargs):
+            updates.append(key.type)
+            return update(key, *args, **kwargs)
+        accessor.update = counting_update
+        transaction = accessor.transaction
+
+        def counting_transaction():
+            txn = transaction()
+            commit = txn.commit
+
+            def counting_commit():
+                committed = commit()
+                if committed:
+                    updates.append('transaction')
+                return committed
+            txn.commit = counting_commit
+            return txn
+        accessor.transaction = counting_transaction
+
+        for i in range(2):
+            message = znode.get_empty_znode('MY_MESSAGE_{0}'.format(i))
+            message.from_state = 'ONLINE'
+            message.to_state = 'OFFLINE'
+            message.resource_name = 'myResource'
+            message.partition_name = 'myResource_{0}'.format(i)
+            message.state_model_def = 'OnlineOffline'
+            message_key = keybuilder.message(participant_id, message.id)
+            accessor.create(message_key, message)
+            del updates[:]
+            helixtask.HelixTask(message, ProcessStateModel(), self._p).call()
+            self.assertFalse(accessor.exists(message_key))
+        # the first failure creates the parents one write at a time
+        self.assertEqual(updates, ['transaction'])
+        error = accessor.get(keybuilder.error(
+            participant_id, session_id, 'myResource', 'myResource_1'))
+        self.assertEqual(
+            error.simple_fields['ERROR'], 'Failed transition, expected')
+        current_state = accessor.get(keybuilder.current_state(
+            participant_id, session_id, 'myResource'))
+        self.assertEqual(
+            current_state.map_fields['myResource_1']['CURRENT_STATE'],
+            'ERROR')
+
+    def test_process_pool(self):
+        """
+        Test that transitions can run in a worker process
+        """
+        session_id = self._p.get_session_id()
+        accessor = self._p.get_accessor()
+        keybuilder = accessor.get_key_builder()
+        participant_id = self._p.get_participant_id()
+        process_pool = futures.ProcessPoolExecutor(1)
+        state_model = ProcessStateModel()
+        for from_state, to_state in (('OFFLINE', 'ONLINE'),
+                                     ('ONLINE', 'OFFLINE')):
+            message = znode.get_empty_znode('MY_MESSAGE_ID')
+            message.from_state = from_state
+            message.to_state = to_state
+            message.resource_name = 'myResource'
+            message.partition_name = 'myResource_0'
+            message.state_model_def = 'OnlineOffline'
+            task = helixtask.HelixTask(
+                message, state_model, self._p, process_pool=process_pool)
+            task.call()
+        process_pool.shutdown()
+
+        # the worker's changes come back; its failures become errors
+        self.assertEqual(len(state_model.pids), 1)
+        self.assertNotEqual(state_model.pids[0], os.getpid())
+        self.assertEqual(state_model.get_current_state(), 'ERROR')
+        error = accessor.get(keybuilder.error(
+            participant_id, session_id, 'myResource', 'myResource_0'))
+        self.assertEqual(
+            error.simple_fields['ERROR'], 'Failed transition, expected')
+
+    def test_unpicklable_process_transition(self):
+        """
+        Test that a state model that cannot be pickled fails its transition
+        """
+        process_pool = futures.ProcessPoolExecutor(1)
+        state_model = LockingStateModel()
+        message = znode.get_empty_znode('MY_MESSAGE_ID')
+        message.from_state = 'OFFLINE'
+        message.to_state = 'ONLINE'
+        message.resource_name = 'myResource'
+        message.partition_name = 'myResource_0'
+        message.state_model_def = 'OnlineOffline'
+        task = helixtask.HelixTask(
+            message, state_model, self._p, process_pool=process_pool)
+        thread = threading.Thread(target=task.call)
+        thread.start()
+        thread.join(10)
+        process_pool.shutdown()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(state_model.pids, [])
+        self.assertEqual(state_model.get_current_state(), 'ERROR')
+
+    def test_late_process_result(self):
+        """
+        Test that a worker finishing after a timeout does not change the
+        state model
+        """
+        process_pool = futures.ProcessPoolExecutor(1)
+        state_model = ProcessStateModel()
+        message = znode.get_empty_znode('MY_MESSAGE_ID')
+        message.from_state = 'OFFLINE'
+        message.to_state = 'ONLINE'
+        message.resource_name = 'myResource'
+        message.partition_name = 'myResource_0'
+        message.state_model_def = 'OnlineOffline'
+        task = helixtask.HelixTask(
+            message, state_model, self._p, process_pool=process_pool)
+        task._session_id = self._p.get_session_id()
+        task.on_timeout()
+        task.call()
+        process_pool.shutdown()
+        self.assertEqual(state_model.pids, [])
+        self.assertEqual(state_model.get_current_state(), 'ERROR')
+
+    def test_deferred_transition(self):
+        """
+        Test that transitions returning futures finish when those do
+        """
+        session_id = self._p.get_session_id()
+        accessor = self._p.get_accessor()
+        keybuilder = accessor.get_key_builder()
+        participant_id = self._p.get_participant_id()
+        state_model = DeferredStateModel()
+        pool = futures.ThreadPoolExecutor(1)
+        results = []
+        for i, to_state in enumerate(('ONLINE', 'OFFLINE')):
+            message = znode.get_empty_znode('MY_MESSAGE_ID_{0}'.format(i))
+            message.from_state = 'OFFLINE'
+            message.to_state = to_state
+            message.resource_name = 'myResource'
+            message.partition_name = 'myResource_{0}'.format(i)
+            message.state_model_def = 'OnlineOffline'
+            message_key = keybuilder.message(participant_id, message.id)
+            accessor.create(message_key, message)
+            task = helixtask.HelixTask(
+                message, state_model, self._p, call_soon=pool.submit)
+            results.append(task.call())
+
+        # nothing is written until the futures are done
+        current_state_key = keybuilder.current_state(
+            participant_id, session_id, 'myResource')
+        self.assertFalse(accessor.exists(current_state_key))
+        state_model.futures[0].set_result(None)
+        state_model.futures[1].set_exception(ValueError('expected'))
+        for result in results:
+            result.result()
+        pool.shutdown()
+        current_state = accessor.get(current_state_key)
+        self.assertEqual(current_state.get_current_state('myResource_0'),
+                         'ONLINE')
+        self.assertEqual(current_state.get_current_state('myResource_1'),
+                         'ERROR')
+        self.assertFalse(accessor.exists(
+            keybuilder.message(participant_id, 'MY_MESSAGE_ID_0')))
+
+    def test_transition_timeout(self):
+        """
+        Test that a transition that overruns its TIMEOUT goes to ERROR
+        """
+        session_id = self._p.get_session_id()
+        accessor = self._p.get_accessor()
+        keybuilder = accessor.get_key_builder()
+        participant_id = self._p.get_participant_id()
+        factory = MockStateModelFactory()
+        state_model = StuckStateModel()
+        factory.put_state_model('myResource_0', state_model)
+        executor = helixexec.HelixExecutor(
+            {'OnlineOffline': factory}, self._p)
+        message = znode.get_empty_znode('MY_MESSAGE_ID')
+        message.msg_type = 'STATE_TRANSITION'
+        message.msg_state = 'NEW'
+        message.tgt_session_id = session_id
+        message.from_state = 'OFFLINE'
+        message.to_state = 'ONLINE'
+        message.resource_name = 'myResource'
+        message.partition_name = 'myResource_0'
+        message.state_model_def = 'OnlineOffline'
+        message.timeout = '50'
+        message_key = keybuilder.message(participant_id, message.id)
+        accessor.create(message_key, message)
+        executor.on_message([message])
+        executor.shutdown()
+
+        self.assertEqual(state_model.get_current_state(), 'ERROR')
+        self.assertFalse(accessor.exists(message_key))
+        error = accessor.get(keybuilder.error(
+            participant_id, session_id, 'myResource', 'myResource_0'))
+        self.assertEqual(error.simple_fields['ERROR'],
+                         'OFFLINE-ONLINE transition timed out')
@@ -0,0 +1,99 @@
+import pickle
+import unittest
+
+import pyhelix.keybuilder as keybuilder
+
+
+class TestKeyBuilder(unittest.TestCase):
+    """
+    These test methods check property keys and their reuse
+    """
+
+    def setUp(self):
+        self._builder = keybuilder.KeyBuilder('myCluster', max_keys=2)
+
+    def test_fields(self):
+        """
+        Test that keys carry the path and flags of the property
+        """
+        key = self._builder.message('node_1', 'msg_1')
+        self.assertEqual(
+            key.path, '/myCluster/INSTANCES/node_1/MESSAGES/msg_1')
+        self.assertEqual(key['path'], key.path)
+        self.assertEqual(key.type, 'message')
+        self.assertTrue(key.merge_on_update)
+        self.assertTrue(key['update_only_on_exists'])
+        self.assertFalse(key.ephemeral)
+        self.assertRaises(KeyError, lambda: key['other'])
+        self.assertEqual(pickle.loads(pickle.dumps(key, 2)), key)
+
+    def test_immutable(self):
+        """
+        Test that keys cannot be changed
+        """
+        key = self._builder.cluster_config()
+        self.assertRaises(AttributeError, setattr, key, 'path', '/other')
+        self.assertRaises(AttributeError, setattr, key, 'other', 1)
+
+    def test_reuse(self):
+        """
+        Test that keys are reused until they are evicted
+        """
+        first = self._builder.external_view('r0')
+        self.assertTrue(self._builder.external_view('r0') is first)
+        self._builder.external_view('r1')
+        self._builder.external_view('r2')
+        second = self._builder.external_view('r0')
+        self.assertFalse(second is first)
+        self.assertEqual(second, first)
+        self.assertTrue(
+            self._builder.current_states('node_1') is
+            self._builder.current_states('node_1'))
+        self.assertEqual(
+            self._builder.current_states('node_1', session_id='s1').path,
+            '/myCluster/INSTANCES/node_1/CURRENTSTATES/s1')
+
+    def test_bucket(self):
+        """
+        Test that bucket keys are neither cached nor bucketized
+        """
+        key = self._builder.ideal_state('r0')
+        bucket_key = self._builder.bucket(key, 'r0_p0-p1')
+        self.assertEqual(bucket_key.path, '/myCluster/IDEALSTATES/r0/r0_p0-p1')
+        self.assertFalse(bucket_key.cacheable)
+        self.assertFalse(bucket_key.bucketized)
+        self.assertTrue(key.cacheable)
+
+    def test_resolve(self):
+        """
+        Test that paths resolve back to their property type and parameters
+        """
+        key = self._builder.current_state('node_1', 'session_1', 'r0')
+        property_type, params, resolved = self._builder.resolve(key.path)
+        self.assertEqual(property_type, 'current_state')
+        self.assertEqual(params, {
+            'participant_id': 'node_1', 'session_id': 'session_1',
+            'resource_id': 'r0'})
+        self.assertEqual(resolved, key)
+
+        # optional parameters, buckets and the cluster inside a path
+        self.assertEqual(
+            self._builder.resolve('/myCluster/INSTANCES/node_1/CURRENTSTATES'),
+            ('current_states', {'participant_id': 'node_1'},
+             self._builder.current_states('node_1')))
+        property_type, params, resolved = self._builder.resolve(
+            '/myCluster/EXTERNALVIEW/r0/r0_p0-p1')
+        self.assertEqual(property_type, 'external_view')
+        self.assertEqual(
+            params, {'resource_id': 'r0', 'bucket_name': 'r0_p0-p1'})
+        self.assertFalse(resolved.bucketized)
+        self.assertEqual(
+            self._builder.resolve('/myCluster/CONFIGS/CLUSTER/myCluster')[0],
+            'cluster_config')
+
+        # unknown paths
+        self.assertTrue(
+            self._builder.resolve('/myCluster/CONFIGS/CLUSTER/other') is None)
+        self.assertTrue(self._builder.resolve('/other/IDEALSTATES') is None)
+        self.assertTrue(
+            self._builder.resolve('/myCluster/INSTANCES//MESSAGES') is None)
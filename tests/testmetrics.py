@@ -0,0 +1,113 @@
+import json
+import unittest
+
+import pyhelix.accessor as accessor
+import pyhelix.metrics as metrics
+import pyhelix.znode as znode
+
+import mockclient
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    These test methods check accessor instrumentation
+    """
+
+    def setUp(self):
+        self._client = mockclient.MockKazooClient()
+        self._client.start()
+        self._metrics = metrics.MetricsRegistry()
+        self._accessor = accessor.DataAccessor(
+            'mockcluster', self._client, metrics=self._metrics)
+        self._builder = self._accessor.get_key_builder()
+
+    def test_histogram(self):
+        """
+        Test that values land in the right buckets
+        """
+        histogram = metrics.Histogram()
+        for value in (0.1, 3, 3, 10000):
+            histogram.add(value)
+        snapshot = histogram.get_snapshot()
+        self.assertEqual(snapshot['count'], 4)
+        self.assertEqual((snapshot['min'], snapshot['max']), (0.1, 10000))
+        self.assertEqual(
+            snapshot['buckets'], {'0.5': 1, '5': 2, 'inf': 1})
+
+    def test_grouped_by_property_type(self):
+        """
+        Test that operations are recorded per property type
+        """
+        for message_id in ('m0', 'm1'):
+            key = self._builder.message('p0', message_id)
+            self._accessor.create(key, znode.get_empty_znode(message_id))
+            self._accessor.get(key)
+        self._accessor.exists(self._builder.live_instance('p0'))
+        self._accessor.get_async_accessor().get(
+            self._builder.message('p0', 'm0')).result()
+        snapshot = self._metrics.get_snapshot()
+        self.assertEqual(
+            sorted(snapshot.keys()), ['live_instance', 'message'])
+        message = snapshot['message']
+        self.assertEqual(message['latency']['create']['count'], 2)
+        self.assertEqual(message['latency']['get']['count'], 3)
+        self.assertEqual(
+            message['bytes_serialized'] * 3, message['bytes_deserialized'] * 2)
+        self.assertTrue('message' in json.loads(self._metrics.dump()))
+
+    def test_transaction(self):
+        """
+        Test that a transaction is timed once, when it is committed
+        """
+        self._accessor.create(self._builder.instance('p0'), b'')
+        txn = self._accessor.transaction()
+        txn.create(self._builder.messages('p0'), b'')
+        txn.create(self._builder.errors('p0'), b'')
+        self.assertTrue(txn.commit())
+        snapshot = self._metrics.get_snapshot()
+        for property_type in ('messages', 'errors'):
+            self.assertEqual(
+                snapshot[property_type]['latency'].keys(), ['multi'])
+            self.assertEqual(
+                snapshot[property_type]['latency']['multi']['count'], 1)
+
+    def test_transaction_retry(self):
+        """
+        Test that a transaction retried after a conflict records a retry
+        """
+        key = self._builder.current_state('p0', 's0', 'r0')
+        delta = znode.get_empty_znode('r0')
+        delta.map_fields['r0_0'] = {'CURRENT_STATE': 'ONLINE'}
+        self._accessor.create(key, delta)
+        get = self._client.get
+        interfered = []
+
+        def interfering_get(path, watch=None):
+            value, stat = get(path, watch)
+            if path == key.path and not interfered:
+                interfered.append(path)
+                self._client.set(path, value)
+            return value, stat
+        self._client.get = interfering_get
+        delta.map_fields['r0_0'] = {'CURRENT_STATE': 'OFFLINE'}
+        txn = self._accessor.transaction()
+        txn.update(key, delta)
+        txn.remove(self._builder.message('p0', 'm0'))
+        self._accessor.create(
+            self._builder.message('p0', 'm0'), znode.get_empty_znode('m0'))
+        self.assertTrue(txn.commit())
+        snapshot = self._metrics.get_snapshot()
+        self.assertEqual(snapshot[key.type]['cas_retries'], 1)
+        self.assertEqual(snapshot['message']['cas_retries'], 0)
+
+    def test_disabled(self):
+        """
+        Test that nothing is recorded without a registry
+        """
+        plain = accessor.DataAccessor('mockcluster', self._client)
+        plain.get(self._builder.message('p0', 'm0'))
+        self.assertTrue(plain.get_metrics() is None)
+        self.assertEqual(self._metrics.get_snapshot(), {})
+
+    def tearDown(self):
+        self._client.stop()
@@ -113,11 +113,11 @@ class TestMockKazooClient(unittest.TestCase):
         self.c.create('/one/two', 'twodata')
         self.c.create('/one/three', 'threedata')
         children = self.c.get_children('/one')
-        self.assertTrue('/one/two' in children)
-        self.assertTrue('/one/three' in children)
-        self.assertTrue('/one' not in children)
-        self.assertTrue('/outside' not in children)
-        self.assertTrue('/outside/a' not in children)
+        self.assertTrue('two' in children)
+        self.assertTrue('three' in children)
+        self.assertTrue('one' not in children)
+        self.assertTrue('outside' not in children)
+        self.assertTrue('a' not in children)
         self.assertEqual(len(children), 2)
 
     def test_basic_set(self):
@@ -139,20 +139,24 @@ class TestMockKazooClient(unittest.TestCase):
         """
         path = '/one'
         self.c.create(path, 'data')
-        self.c.set(path, 'updated', version=1)
+        self.assertEqual(self.c.get(path)[1].version, 0)
+        self.assertEqual(self.c.set(path, 'updated', version=0).version, 1)
         data, metadata = self.c.get(path)
         self.assertEqual(data, 'updated')
-        self.c.set(path, 'updated2', version=2)
+        self.assertEqual(metadata.version, 1)
+        self.c.set(path, 'updated2', version=1)
         data, metadata = self.c.get(path)
         self.assertEqual(data, 'updated2')
-        self.assertRaises(
-            kazoo.exceptions.BadVersionError, self.c.set, path, 'updated3',
-            version=1)
+        for version in (1, 3):
+            self.assertRaises(
+                kazoo.exceptions.BadVersionError, self.c.set, path,
+                'updated3', version=version)
         data, metadata = self.c.get(path)
         self.assertNotEqual(data, 'updated3')
         self.c.set(path, 'updated4', version=-1)
         data, metadata = self.c.get(path)
         self.assertEqual(data, 'updated4')
+        self.assertEqual(metadata.version, 3)
 
     def test_basic_delete(self):
         """
@@ -190,14 +194,14 @@ class TestMockKazooClient(unittest.TestCase):
         """
         path = '/one'
         self.c.create(path, 'data')
-        self.c.set(path, 'updated', version=2)
+        self.c.set(path, 'updated', version=0)
         self.assertRaises(
-            kazoo.exceptions.BadVersionError, self.c.delete, path, version=1)
-        self.c.delete(path, version=3)
+            kazoo.exceptions.BadVersionError, self.c.delete, path, version=0)
+        self.c.delete(path, version=1)
         self.assertFalse(self.c.exists(path))
         self.c.create(path, 'data')
-        self.c.set(path, 'updated', version=2)
-        self.c.delete(path, version=3)
+        self.assertEqual(self.c.get(path)[1].version, 0)
+        self.c.delete(path, version=0)
 
     def tearDown(self):
         self.c.stop()
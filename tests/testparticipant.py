@@ -1,6 +1,25 @@
 import unittest
 
 import pyhelix.participant as participant
+import pyhelix.statemodel as statemodel
+import pyhelix.znode as znode
+
+import mockparticipant
+
+
+class OnlineOfflineModel(statemodel.StateModel):
+    def on_become_online_from_offline(self, message):
+        pass
+
+    def on_become_offline_from_online(self, message):
+        pass
+
+
+class OnlineOfflineFactory(statemodel.StateModelFactory):
+    state_model_class = OnlineOfflineModel
+
+    def create_state_model(self, partition_name):
+        return OnlineOfflineModel()
 
 
 class TestParticipant(unittest.TestCase):
@@ -29,3 +48,133 @@ class TestParticipant(unittest.TestCase):
             'test-cluster', host, port, 'localhost:2181',
             participant_id=participant_id)
         self.assertEqual(p._participant_id, participant_id)
+
+    def test_atomic_bootstrap(self):
+        """
+        Test that participant znodes are created together when joining
+        """
+        p = mockparticipant.MockParticipant(
+            'test-cluster', 'localhost', 123, 'localhost:2181')
+        p.connect()
+        accessor = p.get_accessor()
+        builder = accessor.get_key_builder()
+        participant_id = p.get_participant_id()
+        cluster_config = znode.get_empty_znode('test-cluster')
+        cluster_config['simpleFields']['allowParticipantAutoJoin'] = 'true'
+        accessor.create(builder.cluster_config(), cluster_config)
+        accessor.create(builder.participant_configs(), b'')
+        accessor.create(
+            builder.instance('other'), b'')  # creates INSTANCES
+        self.assertTrue(p._ensure_participant_config())
+        config = accessor.get(builder.participant_config(participant_id))
+        self.assertEqual(config['simpleFields']['HELIX_HOST'], 'localhost')
+        self.assertTrue(accessor.exists(builder.messages(participant_id)))
+        self.assertTrue(
+            accessor.exists(builder.status_updates(participant_id)))
+
+    def test_state_model_validation(self):
+        """
+        Test that registered callbacks are checked against the definition
+        """
+        p = mockparticipant.MockParticipant(
+            'test-cluster', 'localhost', 123, 'localhost:2181')
+        p.connect()
+        accessor = p.get_accessor()
+        builder = accessor.get_key_builder()
+        factory = OnlineOfflineFactory()
+        self.assertFalse(p._validate_state_model_fty('OnlineOffline', factory))
+        state_model_def = znode.get_empty_znode('OnlineOffline')
+        state_model_def.list_fields['STATE_TRANSITION_PRIORITYLIST'] = [
+            'OFFLINE-ONLINE', 'ONLINE-OFFLINE']
+        accessor.create(builder.state_model('OnlineOffline'), state_model_def)
+        self.assertTrue(p._validate_state_model_fty('OnlineOffline', factory))
+        state_model_def.list_fields['STATE_TRANSITION_PRIORITYLIST'].append(
+            'OFFLINE-DROPPED')
+        accessor.set(builder.state_model('OnlineOffline'), state_model_def)
+        self.assertFalse(p._validate_state_model_fty('OnlineOffline', factory))
+
+    def test_bootstrap_fallback(self):
+        """
+        Test that a partially bootstrapped participant is completed
+        """
+        p = mockparticipant.MockParticipant(
+            'test-cluster', 'localhost', 123, 'localhost:2181')
+        p.connect()
+        accessor = p.get_accessor()
+        builder = accessor.get_key_builder()
+        participant_id = p.get_participant_id()
+        cluster_config = znode.get_empty_znode('test-cluster')
+        cluster_config['simpleFields']['allowParticipantAutoJoin'] = 'true'
+        accessor.create(builder.cluster_config(), cluster_config)
+        accessor.create(builder.messages(participant_id), b'')
+        self.assertTrue(p._ensure_participant_config())
+        self.assertTrue(
+            accessor.exists(builder.participant_config(participant_id)))
+        self.assertTrue(accessor.exists(builder.errors(participant_id)))
+
+    def test_message_diffing(self):
+        """
+        Test that each message is read once, for all callbacks
+        """
+        p = mockparticipant.MockParticipant(
+            'test-cluster', 'localhost', 123, 'localhost:2181')
+        p.connect()
+        accessor = p.get_accessor()
+        builder = accessor.get_key_builder()
+        participant_id = p.get_participant_id()
+        for message_id in ('m0', 'm1', 'm2'):
+            accessor.create(
+                builder.message(participant_id, message_id),
+                znode.get_empty_znode(message_id))
+        reads = []
+        get_async = p._client.get_async
+
+        def counting_get_async(path, *args, **kwargs):
+            reads.append(path)
+            return get_async(path, *args, **kwargs)
+        p._client.get_async = counting_get_async
+        first = []
+        second = []
+        p._register_message_callback(
+            lambda messages: first.append([m.id for m in messages]))
+        p._register_message_callback(
+            lambda messages: second.append([m.id for m in messages]))
+
+        p._message_handler(['m0', 'm1'])
+        p._message_handler(['m0', 'm1', 'm2', 'missing'])
+        p._message_handler(['m2'])
+        self.assertEqual(first, [['m0', 'm1'], ['m2']])
+        self.assertEqual(second, first)
+        self.assertEqual(len(reads), 4)
+
+        # removed and unreadable messages are read again if they come back
+        p._message_handler(['m0', 'missing'])
+        self.assertEqual(first[-1], ['m0'])
+        self.assertEqual(len(reads), 6)
+
+    def test_failed_message_callback(self):
+        """
+        Test that messages whose callbacks fail are delivered again
+        """
+        p = mockparticipant.MockParticipant(
+            'test-cluster', 'localhost', 123, 'localhost:2181')
+        p.connect()
+        accessor = p.get_accessor()
+        builder = accessor.get_key_builder()
+        participant_id = p.get_participant_id()
+        for message_id in ('bad', 'good'):
+            accessor.create(
+                builder.message(participant_id, message_id),
+                znode.get_empty_znode(message_id))
+        delivered = []
+
+        def callback(messages):
+            if not delivered:
+                delivered.append(None)
+                raise KeyError('bad')
+            delivered.append([m.id for m in messages])
+        p._register_message_callback(callback)
+
+        self.assertRaises(KeyError, p._message_handler, ['bad', 'good'])
+        p._message_handler(['bad', 'good'])
+        self.assertEqual(delivered[-1], ['bad', 'good'])
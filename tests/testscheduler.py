@@ -0,0 +1,175 @@
+import concurrent.futures as futures
+import functools
+import threading
+import unittest
+
+import pyhelix.scheduler as scheduler
+
+
+class TestScheduler(unittest.TestCase):
+    """
+    These test methods check ordering and fairness of scheduled tasks
+    """
+
+    def test_round_robin(self):
+        """
+        Test that partitions take turns and keep their own order
+        """
+        s = scheduler.PartitionScheduler(1)
+        release = threading.Event()
+        order = []
+        s.submit('r', 'A', lambda: (release.wait(), order.append('A1')))
+        for name in ('A2', 'A3'):
+            s.submit('r', 'A', functools.partial(order.append, name))
+        for name in ('B1', 'B2'):
+            s.submit('r', 'B', functools.partial(order.append, name))
+        release.set()
+        s.shutdown()
+        self.assertEqual(order, ['A1', 'B1', 'A2', 'B2', 'A3'])
+
+    def test_one_task_per_partition(self):
+        """
+        Test that tasks of a partition never overlap
+        """
+        s = scheduler.PartitionScheduler(4)
+        lock = threading.Lock()
+        running = {}
+        overlaps = []
+        order = []
+
+        def task(partition_name, i):
+            with lock:
+                if running.get(partition_name):
+                    overlaps.append(partition_name)
+                running[partition_name] = True
+            order.append((partition_name, i))
+            with lock:
+                running[partition_name] = False
+            return i
+        results = [
+            s.submit('r', partition_name,
+                     functools.partial(task, partition_name, i))
+            for i in range(50) for partition_name in ('p0', 'p1')]
+        s.shutdown()
+        self.assertEqual(overlaps, [])
+        self.assertEqual(
+            [i for partition_name, i in order if partition_name == 'p0'],
+            range(50))
+        self.assertEqual(results[-1].result(), 49)
+        self.assertRaises(RuntimeError, s.submit, 'r', 'p0', lambda: None)
+
+    def test_failed_task(self):
+        """
+        Test that a failing task does not stop its partition
+        """
+        s = scheduler.PartitionScheduler(2)
+        failed = s.submit('r', 'p0', lambda: 1 / 0)
+        succeeded = s.submit('r', 'p0', lambda: 'ok')
+        s.shutdown()
+        self.assertTrue(isinstance(failed.exception(), ZeroDivisionError))
+        self.assertEqual(succeeded.result(), 'ok')
+
+    def test_deferred_task(self):
+        """
+        Test that a task returning a future frees its thread, not its partition
+        """
+        s = scheduler.PartitionScheduler(1)
+        pending = futures.Future()
+        order = []
+        first = s.submit('r', 'A', lambda: pending)
+        second = s.submit('r', 'A', functools.partial(order.append, 'A2'))
+        other = s.submit('r', 'B', functools.partial(order.append, 'B1'))
+        other.result()
+        self.assertEqual(order, ['B1'])
+        self.assertEqual(s.get_stats()['deferred'], 1)
+        pending.set_result('done')
+        second.result()
+        s.shutdown()
+        self.assertEqual(order, ['B1', 'A2'])
+        self.assertEqual(first.result(), 'done')
+
+    def test_timeout(self):
+        """
+        Test that a task that overruns its timeout gives up its partition
+        """
+        s = scheduler.PartitionScheduler(1)
+        release = threading.Event()
+        tokens = []
+        timed_out = threading.Event()
+
+        def stuck():
+            tokens.append(scheduler.current_cancellation_token())
+            release.wait()
+        first = s.submit('r', 'A', stuck, timeout=0.05,
+                         on_timeout=timed_out.set)
+        second = s.submit('r', 'A', lambda: 'next', timeout=5)
+        self.assertEqual(second.result(5), 'next')
+        self.assertTrue(
+            isinstance(first.exception(), futures.TimeoutError))
+        self.assertTrue(timed_out.wait(5))
+        self.assertTrue(tokens[0].is_cancelled())
+        self.assertEqual(scheduler.current_cancellation_token(), None)
+        release.set()
+        s.shutdown()
+
+    def test_priorities_and_caps(self):
+        """
+        Test that higher priorities go first and busy resources wait
+        """
+        policy = scheduler.SchedulingPolicy(
+            priorities={(None, 'ERROR-OFFLINE'): 10,
+                        ('MasterSlave', None): 5},
+            resource_caps={'capped': 1})
+        self.assertEqual(policy.get_priority('X', 'error', 'offline'), 10)
+        self.assertEqual(policy.get_priority('MasterSlave', 'A', 'B'), 5)
+        self.assertEqual(policy.get_priority('X', 'A', 'B'), 0)
+
+        s = scheduler.PartitionScheduler(2, policy=policy)
+        release = threading.Event()
+        order = []
+        s.submit('other', 'p', lambda: release.wait())
+        s.submit('capped', 'p0', lambda: release.wait())
+        s.submit('capped', 'p1', functools.partial(order.append, 'capped'))
+        s.submit('other', 'low', functools.partial(order.append, 'low'))
+        s.submit('other', 'high', functools.partial(order.append, 'high'),
+                 priority=10)
+        stats = s.get_stats()
+        self.assertEqual(stats['running'], 2)
+        self.assertEqual(stats['queued'], 3)
+        self.assertEqual(stats['queued_by_resource'],
+                         {'capped': 1, 'other': 2})
+        release.set()
+        s.shutdown()
+        self.assertEqual(order.index('high'), 0)
+        self.assertEqual(s.get_stats()['wait_time'][10]['count'], 1)
+        self.assertEqual(s.get_stats()['wait_time'][0]['count'], 4)
+
+    def test_adaptive_concurrency(self):
+        """
+        Test that concurrency follows queueing within its bounds
+        """
+        adaptive = scheduler.AdaptiveConcurrency(2, 10, interval=0)
+        self.assertEqual(adaptive.adjust(4, 10), 4)
+
+        # tasks waited longer than they ran
+        adaptive.record_wait(1.0)
+        adaptive.record_run(0.1, 4)
+        self.assertEqual(adaptive.adjust(4, 10), 5)
+        for i in range(3):
+            adaptive.record_wait(1.0)
+            adaptive.record_run(0.1, 10)
+            self.assertEqual(adaptive.adjust(10, 10), 10)
+
+        # fewer tasks ran than allowed
+        adaptive.record_wait(0.0)
+        adaptive.record_run(0.1, 1)
+        self.assertEqual(adaptive.adjust(3, 0), 2)
+        adaptive.record_run(0.1, 1)
+        self.assertEqual(adaptive.adjust(2, 0), 2)
+
+        s = scheduler.PartitionScheduler(
+            4, adaptive=scheduler.AdaptiveConcurrency(2, 10, interval=0))
+        s.submit('r', 'p0', lambda: None).result()
+        s.shutdown()
+        self.assertEqual(s.get_concurrency(), 3)
+        self.assertEqual(s.get_stats()['concurrency'], 3)
@@ -0,0 +1,122 @@
+import concurrent.futures as futures
+import json
+import os
+import unittest
+
+import pyhelix.helixtask as helixtask
+import pyhelix.statemodel as statemodel
+import pyhelix.znode as znode
+
+import mockparticipant
+
+
+class CompactModel(statemodel.CompactStateModel):
+    __slots__ = ()
+
+    def on_become_online_from_offline(self, message):
+        pass
+
+
+class ResettingModel(statemodel.CompactStateModel):
+    __slots__ = ('resets',)
+
+    def __init__(self):
+        statemodel.CompactStateModel.__init__(self)
+        self.resets = 0
+
+    def reset(self):
+        self.resets += 1
+
+
+class ProcessModel(CompactModel):
+    __slots__ = ('pids',)
+
+    def __init__(self):
+        CompactModel.__init__(self)
+        self.pids = []
+
+    def on_become_online_from_offline(self, message):
+        self.pids.append(os.getpid())
+
+
+class CompactFactory(statemodel.CompactStateModelFactory):
+    state_model_class = CompactModel
+
+    def create_state_model(self, partition_name):
+        return CompactModel()
+
+
+class TestCompactStateModel(unittest.TestCase):
+    """
+    These test methods check state models for many partitions
+    """
+
+    def test_slots_and_interning(self):
+        """
+        Test that compact state models share their state strings
+        """
+        first = CompactModel()
+        second = CompactModel()
+        self.assertFalse(hasattr(first, '__dict__'))
+        first._current_state = json.loads('"ONLINE"')
+        second._current_state = json.loads('"ONLINE"')
+        self.assertEqual(first.get_current_state(), 'ONLINE')
+        self.assertTrue(
+            first.get_current_state() is second.get_current_state())
+        self.assertTrue(isinstance(first.get_current_state(), str))
+
+    def test_transition(self):
+        """
+        Test that transitions of compact state models are recorded
+        """
+        p = mockparticipant.MockParticipant(
+            'mockcluster', 'localhost', 1234, 'localhost:2181')
+        p.connect()
+        factory = CompactFactory()
+        factory.put_state_model(u'myResource_0', factory.create_state_model(
+            u'myResource_0'))
+        state_model = factory.get_state_model('myResource_0')
+        message = znode.get_empty_znode('MY_MESSAGE_ID')
+        message.from_state = u'OFFLINE'
+        message.to_state = u'ONLINE'
+        message.resource_name = u'myResource'
+        message.partition_name = u'myResource_0'
+        message.state_model_def = u'OnlineOffline'
+        helixtask.HelixTask(message, state_model, p).call()
+        self.assertEqual(state_model.get_current_state(), 'ONLINE')
+        self.assertEqual(factory._state_models.keys(), ['myResource_0'])
+        self.assertTrue(isinstance(factory._state_models.keys()[0], str))
+
+    def test_process_pool(self):
+        """
+        Test that compact state models can transition in a worker process
+        """
+        p = mockparticipant.MockParticipant(
+            'mockcluster', 'localhost', 1234, 'localhost:2181')
+        p.connect()
+        process_pool = futures.ProcessPoolExecutor(1)
+        state_model = ProcessModel()
+        message = znode.get_empty_znode('MY_MESSAGE_ID')
+        message.from_state = 'OFFLINE'
+        message.to_state = 'ONLINE'
+        message.resource_name = 'myResource'
+        message.partition_name = 'myResource_0'
+        message.state_model_def = 'OnlineOffline'
+        helixtask.HelixTask(
+            message, state_model, p, process_pool=process_pool).call()
+        process_pool.shutdown()
+        self.assertEqual(state_model.get_current_state(), 'ONLINE')
+        self.assertEqual(len(state_model.pids), 1)
+        self.assertNotEqual(state_model.pids[0], os.getpid())
+
+    def test_reset(self):
+        """
+        Test that reset drops all state models, calling only custom resets
+        """
+        factory = CompactFactory()
+        factory.put_state_model('p0', CompactModel())
+        resetting = ResettingModel()
+        factory.put_state_model('p1', resetting)
+        factory.reset()
+        self.assertEqual(factory.get_state_model('p0'), None)
+        self.assertEqual(resetting.resets, 1)
@@ -1,6 +1,7 @@
 import unittest
 
 import pyhelix.statemodel as statemodel
+import pyhelix.znode as znode
 
 
 class MockStateModel(statemodel.StateModel):
@@ -49,3 +50,29 @@ class TestStateModelParser(unittest.TestCase):
             self._state_model, 'offliNE', 'onLIne')
         method(None)
         self.assertTrue(self._state_model.existing_invoked)
+
+    def test_dispatch_table(self):
+        """
+        Callbacks are compiled once per class and bound to the state model
+        """
+        table = statemodel.get_dispatch_table(MockStateModel)
+        self.assertEqual(
+            table, {('offline', 'online'): 'on_become_online_from_offline'})
+        self.assertTrue(statemodel.get_dispatch_table(MockStateModel) is table)
+        other = MockStateModel()
+        method = statemodel.get_transition_handler(other, 'OFFLINE', 'ONLINE')
+        method(None)
+        self.assertTrue(other.existing_invoked)
+        self.assertFalse(self._state_model.existing_invoked)
+
+    def test_validate_transitions(self):
+        """
+        Missing and illegal callbacks are found from the definition
+        """
+        state_model_def = znode.get_empty_znode('OnlineOffline')
+        state_model_def.list_fields['STATE_TRANSITION_PRIORITYLIST'] = [
+            'OFFLINE-DROPPED', 'ONLINE-OFFLINE']
+        missing, illegal = statemodel.validate_transitions(
+            MockStateModel, state_model_def)
+        self.assertEqual(missing, ['OFFLINE-DROPPED', 'ONLINE-OFFLINE'])
+        self.assertEqual(illegal, ['OFFLINE-ONLINE'])
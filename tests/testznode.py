@@ -0,0 +1,116 @@
+import json
+import pickle
+import unittest
+
+import pyhelix.znode as znode
+
+
+class TestZNRecord(unittest.TestCase):
+    """
+    These test methods check the ZNRecord type and its dictionary view
+    """
+
+    def setUp(self):
+        self._record = znode.get_empty_znode('MY_MESSAGE_ID')
+        self._record.msg_type = 'STATE_TRANSITION'
+        self._record.partition_name = 'myResource_0'
+        self._record.map_fields['myResource_0'] = {'CURRENT_STATE': 'ONLINE'}
+
+    def test_typed_fields(self):
+        """
+        Test that typed accessors read and write simple fields
+        """
+        self.assertEqual(
+            self._record['simpleFields']['MSG_TYPE'], 'STATE_TRANSITION')
+        self.assertEqual(self._record.partition_name, 'myResource_0')
+        self.assertTrue(self._record.to_state is None)
+        self.assertEqual(
+            self._record.get_current_state('myResource_0'), 'ONLINE')
+        self.assertTrue(self._record.get_current_state('other') is None)
+
+    def test_dict_view(self):
+        """
+        Test that the record can be used like its dictionary form
+        """
+        self.assertEqual(self._record['id'], 'MY_MESSAGE_ID')
+        self.assertTrue('mapFields' in self._record)
+        self.assertFalse('other' in self._record)
+        self.assertRaises(KeyError, lambda: self._record['other'])
+        self._record['simpleFields'] = {'MSG_STATE': 'NEW'}
+        self.assertEqual(self._record.msg_state, 'NEW')
+        self.assertEqual(dict(self._record), self._record.to_dict())
+        self.assertEqual(self._record, self._record.to_dict())
+
+    def test_serialization(self):
+        """
+        Test that JSON and pickle round trips preserve the record
+        """
+        value = self._record.to_json()
+        self.assertEqual(json.loads(value), self._record.to_dict())
+        self.assertEqual(znode.ZNRecord.from_json(value), self._record)
+        for protocol in (0, 2):
+            self.assertEqual(
+                pickle.loads(pickle.dumps(self._record, protocol)),
+                self._record)
+
+
+class TestLazyZNRecord(unittest.TestCase):
+    """
+    These test methods check on-demand decoding of map and list fields
+    """
+
+    def setUp(self):
+        self._record = znode.get_empty_znode('myResource')
+        self._record.simple_fields['BUCKET_SIZE'] = '0'
+        for i in range(20):
+            partition = 'myResource_{0}'.format(i)
+            self._record.map_fields[partition] = {'node_1': 'ONLINE'}
+            self._record.list_fields[partition] = ['node_1', 'node_2']
+
+    def test_single_fields(self):
+        """
+        Test that single fields are decoded without decoding the rest
+        """
+        for value in (self._record.to_json(),
+                      json.dumps(self._record.to_dict(), indent=2)):
+            record = znode.LazyZNRecord(value)
+            self.assertEqual(record.id, 'myResource')
+            self.assertEqual(record.simple_fields, {'BUCKET_SIZE': '0'})
+            self.assertEqual(
+                record.get_map_field('myResource_3'), {'node_1': 'ONLINE'})
+            self.assertEqual(
+                record.get_list_field('myResource_3'), ['node_1', 'node_2'])
+            self.assertTrue(record.get_map_field('myResource_99') is None)
+            self.assertTrue(record._map_fields is None)
+            self.assertEqual(record, self._record)
+
+    def test_many_lookups(self):
+        """
+        Test that repeated lookups fall back to decoding all fields
+        """
+        record = znode.LazyZNRecord(self._record.to_json())
+        for i in range(20):
+            partition = 'myResource_{0}'.format(i)
+            self.assertEqual(
+                record.get_map_field(partition), {'node_1': 'ONLINE'})
+        self.assertEqual(record.map_fields, self._record.map_fields)
+
+    def test_ambiguous_names(self):
+        """
+        Test records whose fields are named like top-level keys
+        """
+        self._record.map_fields['simpleFields'] = {'id': 'x'}
+        self._record.simple_fields['mapFields'] = 'y'
+        record = znode.LazyZNRecord(self._record.to_json())
+        self.assertEqual(record.get_map_field('simpleFields'), {'id': 'x'})
+        self.assertEqual(record.simple_fields['mapFields'], 'y')
+        self.assertEqual(record, self._record)
+
+    def test_pickle(self):
+        """
+        Test that a lazy record pickles as a plain record
+        """
+        record = znode.LazyZNRecord(self._record.to_json())
+        copy = pickle.loads(pickle.dumps(record, 2))
+        self.assertEqual(type(copy), znode.ZNRecord)
+        self.assertEqual(copy, self._record)